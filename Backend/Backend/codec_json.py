@@ -0,0 +1,71 @@
+"""
+Codec JSON compartido por el WebSocket de colaboración y la API REST.
+
+Usa orjson si está instalado y JSON_CODEC no lo desactiva; si no, la
+librería estándar. La salida es JSON compacto UTF-8 en ambos casos.
+"""
+import json
+
+from django.conf import settings
+from rest_framework import renderers, parsers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # dependencia opcional
+    orjson = None
+
+CODEC = getattr(settings, 'JSON_CODEC', 'orjson')
+USA_ORJSON = orjson is not None and CODEC == 'orjson'
+
+# Tipos que orjson no serializa (Decimal, textos lazy, ...) pasan por el encoder de DRF
+_por_defecto = JSONEncoder().default
+
+
+def dumps_bytes(dato):
+    if USA_ORJSON:
+        return orjson.dumps(dato, default=_por_defecto, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(dato, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(dato):
+    """Como json.dumps, pero con el codec configurado."""
+    if USA_ORJSON:
+        return dumps_bytes(dato).decode('utf-8')
+    return json.dumps(dato, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+def loads(contenido):
+    """
+    Acepta str o bytes.
+
+    Raises:
+        ValueError: si el contenido no es JSON válido
+    """
+    if USA_ORJSON:
+        return orjson.loads(contenido)
+    return json.loads(contenido)
+
+
+class RendererJSON(renderers.JSONRenderer):
+    """JSONRenderer con el codec configurado; con indentación (p. ej. la API navegable) usa el de DRF."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not USA_ORJSON or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps_bytes(data)
+
+
+class ParserJSON(parsers.JSONParser):
+    """JSONParser con el codec configurado."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if not USA_ORJSON:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
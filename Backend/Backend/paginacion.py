@@ -0,0 +1,25 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class PaginacionCursor(CursorPagination):
+    """
+    Paginación por cursor (keyset) usada por defecto en los listados.
+
+    Cada página filtra por `clave > ultimo_valor` sobre una columna indexada
+    en lugar de usar OFFSET, así que el coste no crece con la página pedida y
+    las inserciones concurrentes no duplican ni saltan resultados.
+
+    Cada vista puede fijar su clave con el atributo `orden_cursor`; debe ser
+    única (o casi) e inmutable, p. ej. el id.
+    """
+    page_size = getattr(settings, 'API_TAMANO_PAGINA', 50)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_TAMANO_PAGINA_MAXIMO', 200)
+    ordering = '-id'
+
+    def get_ordering(self, request, queryset, view):
+        orden = getattr(view, 'orden_cursor', None)
+        if orden is not None:
+            return (orden,) if isinstance(orden, str) else tuple(orden)
+        return super().get_ordering(request, queryset, view)
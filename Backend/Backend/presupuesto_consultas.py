@@ -0,0 +1,104 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class ConsultasFueraDePresupuesto(AssertionError):
+    """La vista ejecutó más consultas SQL de las declaradas en su presupuesto."""
+
+
+class MedicionConsultas:
+    """
+    execute_wrapper que cuenta las consultas SQL y suma su tiempo.
+    No depende de DEBUG (connection.queries), así que sirve también en producción.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.tiempo = 0.0
+        self.vista = None
+        self.presupuesto = None
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.tiempo += time.perf_counter() - inicio
+            self.total += 1
+
+    @property
+    def excedido(self):
+        return self.presupuesto is not None and self.total > self.presupuesto
+
+
+def presupuesto_de(vista, metodo):
+    """
+    Presupuesto declarado en la vista con `presupuesto_consultas`: un entero
+    para todos los métodos o un dict {'GET': n, 'POST': m}. None si no hay.
+    """
+    presupuesto = getattr(vista, 'presupuesto_consultas', None)
+    if isinstance(presupuesto, dict):
+        return presupuesto.get(metodo)
+    return presupuesto
+
+
+def verificar_presupuesto(response):
+    """
+    Helper para tests (unittest o pytest): falla si la petición superó el
+    presupuesto de su vista.
+    """
+    medicion = getattr(response, 'consultas_sql', None)
+    if medicion is None:
+        raise AssertionError('La respuesta no tiene medición de consultas (¿falta el middleware?)')
+    if medicion.excedido:
+        raise ConsultasFueraDePresupuesto(
+            f'{medicion.vista}: {medicion.total} consultas SQL, presupuesto {medicion.presupuesto}'
+        )
+    return medicion
+
+
+class PresupuestoConsultasMiddleware:
+    """
+    Mide consultas SQL y tiempo de BD por petición y los compara con el
+    presupuesto declarado en la vista DRF (`presupuesto_consultas`).
+
+    Si se supera se registra un warning; con PRESUPUESTO_CONSULTAS_ESTRICTO
+    (pensado para tests) se lanza ConsultasFueraDePresupuesto.
+    La medición queda en `response.consultas_sql`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._vista_presupuesto = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None)
+
+    def __call__(self, request):
+        medicion = MedicionConsultas()
+        with connection.execute_wrapper(medicion):
+            response = self.get_response(request)
+
+        vista = getattr(request, '_vista_presupuesto', None)
+        if vista is not None:
+            medicion.vista = vista.__name__
+            medicion.presupuesto = presupuesto_de(vista, request.method)
+        response.consultas_sql = medicion
+
+        if medicion.excedido:
+            mensaje = (
+                f"⚠️ {medicion.vista} {request.method} {request.path}: {medicion.total} consultas SQL "
+                f"({medicion.tiempo * 1000:.1f} ms), presupuesto {medicion.presupuesto}"
+            )
+            if getattr(settings, 'PRESUPUESTO_CONSULTAS_ESTRICTO', False):
+                raise ConsultasFueraDePresupuesto(mensaje)
+            logger.warning(mensaje)
+        else:
+            logger.debug(
+                f"{medicion.vista} {request.method}: {medicion.total} consultas SQL ({medicion.tiempo * 1000:.1f} ms)"
+            )
+        return response
@@ -14,6 +14,7 @@ from pathlib import Path
 
 import os
 from dotenv import load_dotenv
+from corsheaders.defaults import default_headers
 from datetime import timedelta
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,6 +40,9 @@ ALLOWED_HOSTS = [h.strip() for h in os.getenv('ALLOWED_HOSTS', 'localhost,127.0.
 CORS_ALLOWED_ORIGINS = os.getenv('CORS_ALLOWED_ORIGINS', 'http://localhost:5173').split(',')
 CORS_ALLOWED_ORIGINS = [u.strip() for u in CORS_ALLOWED_ORIGINS if u.strip()]
 CORS_ALLOW_CREDENTIALS = True
+# If-Match / If-None-Match / ETag: concurrencia optimista y GET condicional
+CORS_ALLOW_HEADERS = (*default_headers, 'if-match', 'if-none-match')
+CORS_EXPOSE_HEADERS = ['ETag']
 
 CSRF_TRUSTED_ORIGINS = [u.strip() for u in os.getenv('CSRF_TRUSTED_ORIGINS', 'http://localhost:5173').split(',') if u.strip()]
 
@@ -72,7 +76,11 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Cuenta consultas SQL por vista y avisa si superan su `presupuesto_consultas`
+    'Backend.presupuesto_consultas.PresupuestoConsultasMiddleware',
 ]
+# Con True, superar el presupuesto lanza una excepción en lugar de solo registrar un warning
+PRESUPUESTO_CONSULTAS_ESTRICTO = os.getenv('PRESUPUESTO_CONSULTAS_ESTRICTO', 'False') == 'True'
 
 ROOT_URLCONF = 'Backend.urls'
 
@@ -98,6 +106,9 @@ WSGI_APPLICATION = 'Backend.wsgi.application'
 ASGI_APPLICATION = os.getenv('ASGI_APPLICATION', 'Backend.asgi.application')
 
 # Use Redis Channel Layer if REDIS_URL is provided (recommended for production/multi-worker)
+# Con varios workers, cada sala de diagrama (estado en memoria) vive en uno solo:
+# el balanceador debe enrutar las conexiones de un mismo diagrama al mismo worker;
+# las que lleguen a otro se rechazan mientras el dueño la tenga abierta.
 REDIS_URL = os.getenv('REDIS_URL', None)
 if REDIS_URL:
     CHANNEL_LAYERS = {
@@ -116,6 +127,37 @@ else:
         }
     }
 
+# Colaboración en tiempo real: segundos que se acumulan cambios en memoria
+# antes de escribir DiagramaClase.estructura en la BD
+COLABORACION_INTERVALO_PERSISTENCIA = float(os.getenv('COLABORACION_INTERVALO_PERSISTENCIA', '2.0'))
+# Registro de CambioDiagrama: se inserta en lote al llegar a N cambios o tras N segundos
+COLABORACION_CAMBIOS_LOTE_MAXIMO = int(os.getenv('COLABORACION_CAMBIOS_LOTE_MAXIMO', '100'))
+COLABORACION_CAMBIOS_INTERVALO = float(os.getenv('COLABORACION_CAMBIOS_INTERVALO', '0.25'))
+# Resincronización incremental: hueco máximo (en cambios) antes de enviar la estructura completa
+COLABORACION_MAX_CAMBIOS_RESINCRONIZACION = int(os.getenv('COLABORACION_MAX_CAMBIOS_RESINCRONIZACION', '500'))
+# Movimientos de un mismo nodo dentro de esta ventana (segundos) se agrupan en uno
+COLABORACION_VENTANA_MOVIMIENTOS = float(os.getenv('COLABORACION_VENTANA_MOVIMIENTOS', '0.033'))
+# Presencia de usuarios: 'memoria' (un solo worker) o 'redis'; por defecto redis si hay REDIS_URL
+COLABORACION_PRESENCIA_BACKEND = os.getenv('COLABORACION_PRESENCIA_BACKEND') or None
+# Segundos sin ping tras los que una conexión deja de contar como presente
+COLABORACION_PRESENCIA_TTL = int(os.getenv('COLABORACION_PRESENCIA_TTL', '90'))
+# Cada cuántos segundos se vuelca la actividad a ConexionUsuario y se cierran las conexiones sin ping
+# (sólo en workers con conexiones; manage.py cerrar_conexiones_inactivas lo hace desde cron)
+COLABORACION_INTERVALO_ACTIVIDAD = float(os.getenv('COLABORACION_INTERVALO_ACTIVIDAD', '15'))
+# Lotes salientes (clientes que conectan con ?lotes=1): los mensajes de grupo se envían
+# juntos en un frame 'lote' tras la ventana (segundos) o al llegar al máximo de mensajes
+COLABORACION_LOTE_VENTANA = float(os.getenv('COLABORACION_LOTE_VENTANA', '0.05'))
+COLABORACION_LOTE_MAXIMO = int(os.getenv('COLABORACION_LOTE_MAXIMO', '100'))
+# Mensajes acumulados entre dos envíos de una conexión (ráfaga) a partir de los cuales se
+# descartan y se pide resincronizar; no mide lo que el cliente aún no leyó
+COLABORACION_LOTE_LIMITE = int(os.getenv('COLABORACION_LOTE_LIMITE', '2000'))
+# Compactación del historial (manage.py compactar_historial): los CambioDiagrama con más de
+# N días se resumen en una instantánea y se borran, en lotes de este tamaño
+COLABORACION_HISTORIAL_RETENCION_DIAS = int(os.getenv('COLABORACION_HISTORIAL_RETENCION_DIAS', '30'))
+COLABORACION_HISTORIAL_LOTE = int(os.getenv('COLABORACION_HISTORIAL_LOTE', '1000'))
+# Cada cuántas revisiones la sala guarda una instantánea del diagrama (0 desactiva)
+COLABORACION_INSTANTANEA_CADA = int(os.getenv('COLABORACION_INSTANTANEA_CADA', '200'))
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -208,7 +250,23 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    # Listados paginados por cursor (sin OFFSET); ver Backend/paginacion.py
+    'DEFAULT_PAGINATION_CLASS': 'Backend.paginacion.PaginacionCursor',
+    # JSON con orjson si está instalado (ver Backend/codec_json.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'Backend.codec_json.RendererJSON',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'Backend.codec_json.ParserJSON',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
+# Codec JSON de la API y el WebSocket: 'orjson' (si está instalado) o 'json' (librería estándar)
+JSON_CODEC = os.getenv('JSON_CODEC', 'orjson')
+API_TAMANO_PAGINA = int(os.getenv('API_TAMANO_PAGINA', 50))
+API_TAMANO_PAGINA_MAXIMO = int(os.getenv('API_TAMANO_PAGINA_MAXIMO', 200))
 
 # Si tu clase se llama UsuarioPersonalizado en app 'usuario':
 AUTH_USER_MODEL = 'usuario.UsuarioPersonalizado'
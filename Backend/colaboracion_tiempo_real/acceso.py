@@ -0,0 +1,33 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+
+def grupo_acceso_proyecto(proyecto_id):
+    """Grupo al que se unen los consumers de todos los diagramas de un proyecto."""
+    return f'acceso_proyecto_{proyecto_id}'
+
+
+def notificar_cambio_acceso(proyecto_id, usuario_id=None):
+    """
+    Avisa a los consumers del proyecto que deben volver a verificar el acceso.
+
+    Con usuario_id=None se invalida el acceso cacheado de todos los usuarios
+    del proyecto (p. ej. al reemplazar la lista de colaboradores).
+    """
+    try:
+        channel_layer = get_channel_layer()
+        if channel_layer:
+            async_to_sync(channel_layer.group_send)(
+                grupo_acceso_proyecto(proyecto_id),
+                {
+                    'type': 'acceso.actualizado',
+                    'proyecto_id': proyecto_id,
+                    'usuario_id': usuario_id,
+                }
+            )
+    except Exception:
+        logger.exception('Error notificando cambio de acceso al proyecto %s', proyecto_id)
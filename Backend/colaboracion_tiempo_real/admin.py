@@ -2,7 +2,7 @@ from django.contrib import admin
 
 # Register your models here.
 from django.contrib import admin
-from .models import SesionColaborativa, ConexionUsuario, CambioDiagrama
+from .models import SesionColaborativa, ConexionUsuario, CambioDiagrama, InstantaneaDiagrama
 
 @admin.register(SesionColaborativa)
 class SesionColaborativaAdmin(admin.ModelAdmin):
@@ -20,4 +20,10 @@ class ConexionUsuarioAdmin(admin.ModelAdmin):
 class CambioDiagramaAdmin(admin.ModelAdmin):
     list_display = ['id', 'usuario', 'tipo_cambio', 'timestamp', 'sincronizado']
     list_filter = ['tipo_cambio', 'sincronizado', 'timestamp']
-    search_fields = ['usuario__nombre', 'sesion__diagrama__nombre']
\ No newline at end of file
+    search_fields = ['usuario__nombre', 'sesion__diagrama__nombre']
+
+@admin.register(InstantaneaDiagrama)
+class InstantaneaDiagramaAdmin(admin.ModelAdmin):
+    list_display = ['id', 'diagrama', 'revision', 'fecha_creacion']
+    list_filter = ['fecha_creacion']
+    search_fields = ['diagrama__nombre']
@@ -1,22 +1,58 @@
-import json
+import asyncio
 import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
+from . import metricas
+from .acceso import grupo_acceso_proyecto
+from .salas import grupo_diagrama
+from .protocolo import (
+    FORMATO_JSON,
+    argumentos_send,
+    codificar,
+    codificar_difusion,
+    decodificar,
+    negociar_formato,
+    negociar_lotes,
+)
 from .diagrama_db import (
     verificar_acceso_diagrama,
-    obtener_o_crear_sesion,
-    obtener_sesion_activa,
-    registrar_conexion_usuario,
-    desregistrar_conexion_usuario,
-    obtener_usuarios_conectados,
+    resolver_acceso_diagrama,
     obtener_estado_diagrama,
-    aplicar_cambio_diagrama,
-    registrar_cambio_diagrama,
+    obtener_cambios_desde,
     obtener_timestamp_actual
 )
+from .services.escritor_cambios import escritor_cambios
+from .services.estado_diagrama import registro_estados, MAX_CAMBIOS_RESINCRONIZACION, SalaEnOtroProceso
+from .services.actividad_conexiones import registro_actividad
+from .services.cola_salida import ColaSalida, VENTANA_LOTE
+from .services.presencia import presencia, info_usuario
 
 logger = logging.getLogger(__name__)
 
+# Ventana (segundos) en la que se agrupan los movimientos de un mismo nodo
+VENTANA_MOVIMIENTOS = getattr(settings, 'COLABORACION_VENTANA_MOVIMIENTOS', 0.033)
+# Cierre de una conexión cuya sala está abierta en otro worker: el cliente
+# espera antes de reintentar en lugar de reconectar de inmediato
+CODIGO_SALA_EN_OTRO_PROCESO = 4009
+
+
+# Claves que el cliente añade a `datos` sin ser contenido del nodo
+METADATOS_CAMBIO = frozenset({'id', 'timestamp'})
+
+
+def es_movimiento_nodo(cambio):
+    """True si el cambio sólo actualiza la posición de un nodo."""
+    datos = cambio.get('datos')
+    return (
+        cambio.get('tipo') == 'actualizar_nodo'
+        and isinstance(datos, dict)
+        and 'position' in datos
+        and set(datos) - METADATOS_CAMBIO == {'position'}
+    )
+
+
 class DiagramaConsumer(AsyncWebsocketConsumer):
     """
     Consumer WebSocket para colaboración en tiempo real en diagramas UML.
@@ -29,8 +65,22 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
         """
         try:
             self.diagrama_id = self.scope['url_route']['kwargs']['diagrama_id']
-            self.grupo_diagrama = f'diagrama_{self.diagrama_id}'
+            self.grupo_diagrama = grupo_diagrama(self.diagrama_id)
             self.usuario = self.scope["user"]
+            self.estado_diagrama = None
+            self.movimientos_pendientes = {}
+            self._tarea_movimientos = None
+            # Los movimientos agrupados y el resto de cambios se aplican de uno en uno
+            self._lock_cambios = asyncio.Lock()
+            # Decisión de acceso cacheada; None obliga a verificarla de nuevo
+            self.tiene_acceso = None
+            self.grupo_acceso = None
+            # JSON por defecto; MessagePack si el cliente lo negoció
+            self.formato, subprotocolo = negociar_formato(self.scope)
+            # Mensajes de grupo agrupados en frames 'lote' si el cliente los acepta
+            self.cola_salida = None
+            if negociar_lotes(self.scope) and VENTANA_LOTE > 0:
+                self.cola_salida = ColaSalida(self.enviar_frame_directo, self.formato)
 
             print(f"🔍 DEBUG: Usuario en scope: {self.usuario}")
             print(f"🔍 DEBUG: Headers: {self.scope.get('headers', [])}")
@@ -40,21 +90,52 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
                 print("⚠️  Usuario anónimo, permitiendo temporalmente para pruebas")
                 # Continuar sin cerrar la conexión para pruebas
 
-            # Resto del código sin cambios...
+            # Resolver el acceso una sola vez; los cambios de colaboradores
+            # llegan por el grupo de acceso del proyecto
+            if not isinstance(self.usuario, AnonymousUser):
+                proyecto_id, self.tiene_acceso = await resolver_acceso_diagrama(self.diagrama_id, self.usuario)
+                if proyecto_id is not None:
+                    self.grupo_acceso = grupo_acceso_proyecto(proyecto_id)
+                    await self.channel_layer.group_add(self.grupo_acceso, self.channel_name)
+
+            # Estado en memoria compartido por las conexiones de este diagrama
+            self.estado_diagrama = await registro_estados.adquirir(self.diagrama_id)
+            self.generacion = self.estado_diagrama.generacion
+            # Las difusiones se codifican sólo en los formatos de la sala
+            self.estado_diagrama.formatos[self.formato] += 1
+
             await self.channel_layer.group_add(
                 self.grupo_diagrama,
                 self.channel_name
             )
 
-            await self.accept()
+            await self.accept(subprotocolo)
             print("✅ Conexión WebSocket aceptada")
 
             # Enviar mensaje de prueba
-            await self.send(text_data=json.dumps({
+            await self.enviar_mensaje({
                 'tipo': 'conexion_establecida',
                 'mensaje': 'Conexión WebSocket exitosa'
-            }))
+            })
 
+            # Registrar presencia y avisar al resto de la sala
+            if not isinstance(self.usuario, AnonymousUser):
+                await presencia.registrar(
+                    self.diagrama_id, self.channel_name, info_usuario(self.usuario, timezone.now())
+                )
+                registro_actividad.conectar(self.diagrama_id, self.usuario.id, self.channel_name)
+                await self.difundir('notificar_usuario_conectado', {
+                    'tipo': 'usuario_conectado',
+                    'usuario_id': self.usuario.id,
+                    'usuario_nombre': f"{self.usuario.nombre} {self.usuario.apellido}",
+                    'usuarios_conectados': await presencia.usuarios(self.diagrama_id)
+                }, usuario_id=self.usuario.id)
+
+        except SalaEnOtroProceso:
+            logger.warning(f"⚠️ Diagrama {self.diagrama_id} abierto en otro worker; se rechaza la conexión")
+            # Rechazar el handshake no llega al cliente con código: se acepta y se cierra
+            await self.accept(subprotocolo)
+            await self.close(code=CODIGO_SALA_EN_OTRO_PROCESO)
         except Exception as e:
             print(f"❌ Error en conexión: {e}")
             await self.close()
@@ -68,41 +149,58 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
         try:
             logger.info(f"Desconectando WebSocket para usuario {getattr(self.usuario, 'id', 'anon')}, código: {close_code}")
 
-            # Desregistrar conexión de usuario
-            sesion = await obtener_sesion_activa(self.diagrama_id)
-            if sesion:
-                await desregistrar_conexion_usuario(sesion, self.usuario)
+            # Quitar la conexión de la presencia
+            if hasattr(self, 'diagrama_id'):
+                await presencia.eliminar(self.diagrama_id, self.channel_name)
+            registro_actividad.desconectar(self.channel_name)
+            if getattr(self, 'cola_salida', None) is not None:
+                self.cola_salida.cerrar()
 
-            # Salir del grupo del diagrama
+            # Aplicar los movimientos que quedaron en la ventana de agrupación
+            if getattr(self, '_tarea_movimientos', None) is not None:
+                self._tarea_movimientos.cancel()
+            if getattr(self, 'movimientos_pendientes', None):
+                await self.vaciar_movimientos(confirmar=False)
+
+            # Salir del grupo del diagrama antes de dejar de contar su formato
             if hasattr(self, 'grupo_diagrama'):
                 await self.channel_layer.group_discard(
                     self.grupo_diagrama,
                     self.channel_name
                 )
 
+            # Liberar el estado en memoria (la última conexión lo persiste)
+            if getattr(self, 'estado_diagrama', None) is not None:
+                self.estado_diagrama.formatos[self.formato] -= 1
+                await registro_estados.liberar(self.diagrama_id)
+                self.estado_diagrama = None
+                if registro_estados.obtener(self.diagrama_id) is None:
+                    await escritor_cambios.vaciar()
+
+            if getattr(self, 'grupo_acceso', None):
+                await self.channel_layer.group_discard(self.grupo_acceso, self.channel_name)
+
             # Notificar a otros usuarios sobre la desconexión (solo si estaba autenticado)
             if not isinstance(self.usuario, AnonymousUser) and hasattr(self, 'grupo_diagrama'):
-                usuarios_conectados = await obtener_usuarios_conectados(self.diagrama_id)
-                
-                await self.channel_layer.group_send(
-                    self.grupo_diagrama,
-                    {
-                        'type': 'notificar_usuario_desconectado',
-                        'usuario_id': self.usuario.id,
-                        'usuario_nombre': f"{self.usuario.nombre} {self.usuario.apellido}",
-                        'usuarios_conectados': usuarios_conectados
-                    }
-                )
+                usuarios_conectados = await presencia.usuarios(self.diagrama_id)
+
+                await self.difundir('notificar_usuario_desconectado', {
+                    'tipo': 'usuario_desconectado',
+                    'usuario_id': self.usuario.id,
+                    'usuario_nombre': f"{self.usuario.nombre} {self.usuario.apellido}",
+                    'usuarios_conectados': usuarios_conectados
+                })
 
         except Exception as e:
             logger.error(f"Error en desconexión WebSocket: {e}")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
-        Maneja los mensajes recibidos a través del WebSocket.
+        Maneja los mensajes recibidos a través del WebSocket
+        (texto JSON o binario MessagePack).
         """
         try:
-            data = json.loads(text_data)
+            data = decodificar(text_data, bytes_data)
             tipo_evento = data.get('tipo')
             
             logger.debug(f"Mensaje recibido: {tipo_evento} de usuario {self.usuario.id}")
@@ -112,15 +210,19 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
             elif tipo_evento == 'usuario_editando':
                 await self.procesar_usuario_editando(data)
             elif tipo_evento == 'sincronizar_estado':
-                await self.sincronizar_estado_diagrama()
+                await self.sincronizar_estado_diagrama(data.get('revision'))
             elif tipo_evento == 'ping':
+                await presencia.latido(self.diagrama_id, self.channel_name)
+                if not await presencia.renovar_sala(self.diagrama_id):
+                    logger.warning(f"⚠️ Este worker ya no es dueño de la sala del diagrama {self.diagrama_id}")
+                registro_actividad.latido(self.channel_name)
                 await self.enviar_pong()
             else:
                 await self.enviar_error(f'Tipo de evento no reconocido: {tipo_evento}')
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decodificando JSON: {e}")
-            await self.enviar_error('Formato JSON inválido')
+        except ValueError as e:
+            logger.error(f"Error decodificando mensaje: {e}")
+            await self.enviar_error('Formato de mensaje inválido')
         except Exception as e:
             logger.error(f"Error procesando mensaje: {e}")
             await self.enviar_error('Error interno del servidor')
@@ -129,7 +231,7 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
         # Validar payload mínimo
         cambio = data.get('cambio')
         if not cambio:
-            await self.send(text_data=json.dumps({"tipo": "error", "mensaje": "Payload inválido: falta campo 'cambio'"}))
+            await self.enviar_mensaje({"tipo": "error", "mensaje": "Payload inválido: falta campo 'cambio'"})
             return
 
         # Obtener usuario autenticado desde el scope
@@ -138,44 +240,115 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
 
         # Requerir usuario autenticado
         if usuario is None or getattr(usuario, "is_anonymous", True):
-            await self.send(text_data=json.dumps({"tipo": "error", "mensaje": "No autorizado para realizar cambios"}))
+            await self.enviar_mensaje({"tipo": "error", "mensaje": "No autorizado para realizar cambios"})
+            return
+
+        # Los movimientos de nodo se agrupan y sólo se procesa el último por nodo
+        if es_movimiento_nodo(cambio):
+            self.encolar_movimiento(cambio)
             return
 
-        # Verificar permisos/accseso al diagrama
+        # Cualquier otro cambio se procesa después de los movimientos pendientes,
+        # también de los que el temporizador esté aplicando en ese momento
+        async with self._lock_cambios:
+            await self._aplicar_movimientos()
+
+            if not await self.verificar_permiso_cambios(usuario):
+                return
+            await self.aplicar_y_propagar_cambio(cambio, usuario)
+
+    async def verificar_permiso_cambios(self, usuario, notificar=True):
+        """
+        Verifica el acceso al diagrama; envía el error al cliente si no lo tiene.
+        Sólo consulta la BD si la decisión cacheada fue invalidada.
+        """
         try:
-            tiene_acceso = await verificar_acceso_diagrama(self.diagrama_id, usuario)
+            if self.tiene_acceso is None:
+                self.tiene_acceso = await verificar_acceso_diagrama(self.diagrama_id, usuario)
+            tiene_acceso = self.tiene_acceso
         except Exception as e:
             logger.exception("Error verificando acceso al diagrama")
-            await self.send(text_data=json.dumps({"tipo": "error", "mensaje": "Error interno verificando permisos"}))
-            return
+            if notificar:
+                await self.enviar_mensaje({"tipo": "error", "mensaje": "Error interno verificando permisos"})
+            return False
 
         if not tiene_acceso:
-            await self.send(text_data=json.dumps({"tipo": "error", "mensaje": "No autorizado para realizar cambios en este diagrama"}))
-            return
+            if notificar:
+                await self.enviar_mensaje({"tipo": "error", "mensaje": "No autorizado para realizar cambios en este diagrama"})
+            return False
+        return True
 
-        # Aplicar cambio en BD
-        aplicado = await aplicar_cambio_diagrama(self.diagrama_id, cambio, usuario)
-        if not aplicado:
-            await self.send(text_data=json.dumps({"tipo": "error", "mensaje": "No se pudo aplicar el cambio al diagrama"}))
+    async def aplicar_y_propagar_cambio(self, cambio, usuario, confirmar=True):
+        """
+        Aplica el cambio en memoria, lo encola para registro y lo propaga al grupo.
+        """
+        # Aplicar cambio sobre el estado en memoria (se persiste en diferido)
+        if self.estado_diagrama is None:
+            if confirmar:
+                await self.enviar_mensaje({"tipo": "error", "mensaje": "No se pudo aplicar el cambio al diagrama"})
+            return
+        if not self.estado_diagrama.aplicar_cambio(cambio):
+            # Sin efecto (duplicado, elemento inexistente o tipo desconocido):
+            # no se registra ni se propaga
+            if confirmar:
+                await self.enviar_mensaje({"tipo": "cambio_confirmado", "cambio_id": None, "sin_efecto": True})
             return
 
-        # Registrar cambio y obtener id
-        cambio_id = await registrar_cambio_diagrama(self.diagrama_id, cambio, usuario)
+        # La revisión asignada en memoria identifica el cambio; el registro
+        # en BD se inserta en lote sin bloquear la confirmación
+        cambio_id = self.estado_diagrama.revision
+        escritor_cambios.encolar(self.diagrama_id, cambio_id, cambio, usuario.id)
 
         # Confirmar al emisor
-        await self.send(text_data=json.dumps({"tipo": "cambio_confirmado", "cambio_id": cambio_id}))
+        if confirmar:
+            await self.enviar_mensaje({"tipo": "cambio_confirmado", "cambio_id": cambio_id, "revision": cambio_id})
 
         # Propagar a grupo para otros clientes (usar nombre de grupo consistente)
-        await self.channel_layer.group_send(
-            self.grupo_diagrama,
-            {
-                "type": "propagar_cambio_diagrama",
-                "usuario_id": usuario.id,
-                "usuario_nombre": getattr(usuario, "nombre", str(usuario)),
-                "cambio": cambio,
-                "cambio_id": cambio_id
-            }
-        )
+        await self.difundir("propagar_cambio_diagrama", {
+            "tipo": "cambio_recibido",
+            "usuario_nombre": getattr(usuario, "nombre", str(usuario)),
+            "cambio": cambio,
+            "cambio_id": cambio_id,
+            "revision": cambio_id
+        }, usuario_id=usuario.id)
+
+    # ========== AGRUPACIÓN DE MOVIMIENTOS ==========
+
+    def encolar_movimiento(self, cambio):
+        """
+        Guarda el movimiento hasta que termine la ventana; si el nodo ya tenía
+        uno pendiente, éste lo reemplaza.
+        """
+        nodo_id = cambio['datos'].get('id')
+        if nodo_id in self.movimientos_pendientes:
+            metricas.incrementar('movimientos_fusionados')
+        self.movimientos_pendientes[nodo_id] = cambio
+        if self._tarea_movimientos is None or self._tarea_movimientos.done():
+            self._tarea_movimientos = asyncio.ensure_future(self._vaciar_movimientos_diferido())
+
+    async def _vaciar_movimientos_diferido(self):
+        await asyncio.sleep(VENTANA_MOVIMIENTOS)
+        try:
+            await self.vaciar_movimientos()
+        except Exception as e:
+            logger.exception(f"Error procesando movimientos agrupados: {e}")
+
+    async def vaciar_movimientos(self, confirmar=True):
+        """Procesa el último movimiento pendiente de cada nodo."""
+        async with self._lock_cambios:
+            await self._aplicar_movimientos(confirmar)
+
+    async def _aplicar_movimientos(self, confirmar=True):
+        if not self.movimientos_pendientes:
+            return
+        cambios = list(self.movimientos_pendientes.values())
+        self.movimientos_pendientes = {}
+
+        usuario = self.scope.get("user", None)
+        if not await self.verificar_permiso_cambios(usuario, notificar=confirmar):
+            return
+        for cambio in cambios:
+            await self.aplicar_y_propagar_cambio(cambio, usuario, confirmar=confirmar)
 
     async def procesar_usuario_editando(self, data):
         """
@@ -185,61 +358,104 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
             elemento_id = data.get('elemento_id')
             editando = data.get('editando', False)
             
-            await self.channel_layer.group_send(
-                self.grupo_diagrama,
-                {
-                    'type': 'propagar_estado_edicion',
-                    'elemento_id': elemento_id,
-                    'usuario_id': self.usuario.id,
-                    'usuario_nombre': f"{self.usuario.nombre} {self.usuario.apellido}",
-                    'editando': editando
-                }
-            )
+            await self.difundir('propagar_estado_edicion', {
+                'tipo': 'usuario_editando',
+                'elemento_id': elemento_id,
+                'usuario_id': self.usuario.id,
+                'usuario_nombre': f"{self.usuario.nombre} {self.usuario.apellido}",
+                'editando': editando
+            }, usuario_id=self.usuario.id)
 
         except Exception as e:
             logger.error(f"Error procesando estado de edición: {e}")
 
-    async def sincronizar_estado_diagrama(self):
+    async def sincronizar_estado_diagrama(self, revision_cliente=None):
         """
         Sincroniza el estado actual del diagrama con el usuario.
+
+        Si el cliente indica la última revisión que vio, se le envían sólo
+        los cambios posteriores; la estructura completa se envía cuando no
+        la indica o el hueco supera MAX_CAMBIOS_RESINCRONIZACION.
         """
         try:
-            estado_diagrama = await obtener_estado_diagrama(self.diagrama_id)
-            usuarios_conectados = await obtener_usuarios_conectados(self.diagrama_id)
-            
-            await self.send(text_data=json.dumps({
+            # Si la cola de salida se saturó, el cliente vuelve a recibir mensajes de grupo
+            if self.cola_salida is not None:
+                self.cola_salida.reanudar()
+
+            usuarios_conectados = await presencia.usuarios(self.diagrama_id)
+
+            cambios = await self.obtener_cambios_pendientes(revision_cliente)
+            if cambios is not None:
+                await self.enviar_mensaje({
+                    'tipo': 'estado_sincronizado',
+                    'revision': self.estado_diagrama.revision,
+                    'cambios': cambios,
+                    'usuarios_conectados': usuarios_conectados
+                })
+                return
+
+            if self.estado_diagrama is not None:
+                estado_diagrama = self.estado_diagrama.estructura
+                revision = self.estado_diagrama.revision
+            else:
+                estado_diagrama = await obtener_estado_diagrama(self.diagrama_id)
+                revision = None
+
+            await self.enviar_mensaje({
                 'tipo': 'estado_sincronizado',
+                'revision': revision,
                 'estructura': estado_diagrama,
                 'usuarios_conectados': usuarios_conectados
-            }))
+            })
         except Exception as e:
             logger.error(f"Error sincronizando estado: {e}")
             await self.enviar_error('Error sincronizando estado')
 
+    async def obtener_cambios_pendientes(self, revision_cliente):
+        """
+        Cambios que le faltan a un cliente en `revision_cliente`, primero
+        desde memoria y si no alcanza desde CambioDiagrama. None si hay
+        que enviar la estructura completa.
+        """
+        estado = self.estado_diagrama
+        if estado is None or isinstance(revision_cliente, bool) or not isinstance(revision_cliente, int):
+            return None
+        hueco = estado.revision - revision_cliente
+        if hueco < 0 or hueco > MAX_CAMBIOS_RESINCRONIZACION or revision_cliente < estado.revision_minima:
+            return None
+
+        cambios = estado.cambios_desde(revision_cliente)
+        if cambios is not None:
+            return cambios
+
+        # Los cambios aún en el buffer del escritor deben estar en BD antes de consultar
+        revision_actual = estado.revision
+        await escritor_cambios.vaciar()
+        cambios = await obtener_cambios_desde(self.diagrama_id, revision_cliente, hueco)
+        if cambios is None or len(cambios) != hueco or revision_actual != estado.revision:
+            return None
+        return cambios
+
     async def enviar_pong(self):
         """Responde a un ping con pong."""
-        await self.send(text_data=json.dumps({
+        await self.enviar_mensaje({
             'tipo': 'pong',
             'timestamp': await obtener_timestamp_actual()
-        }))
+        })
 
     # ========== HANDLERS PARA EVENTOS DE GRUPO ==========
 
+    # Los mensajes de grupo llegan ya codificados (ver `difundir`): cada
+    # handler sólo decide si el frame le corresponde y lo envía.
+
     async def propagar_cambio_diagrama(self, event):
         """
         Propaga un cambio a todos los usuarios excepto al remitente.
         """
-        # Evitar enviar el cambio de vuelta al remitente
         try:
             if event.get("usuario_id") == getattr(self.usuario, "id", None):
                 return
-
-            await self.send(text_data=json.dumps({
-                "tipo": "cambio_recibido",
-                "usuario_nombre": event.get("usuario_nombre"),
-                "cambio": event.get("cambio"),
-                "cambio_id": event.get("cambio_id")
-            }))
+            await self.enviar_frame(event['frames'])
         except Exception as e:
             logger.exception(f"Error propagando cambio: {e}")
 
@@ -249,23 +465,13 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
         """
         # No notificar al usuario que se acaba de conectar
         if event['usuario_id'] != self.usuario.id:
-            await self.send(text_data=json.dumps({
-                'tipo': 'usuario_conectado',
-                'usuario_id': event['usuario_id'],
-                'usuario_nombre': event['usuario_nombre'],
-                'usuarios_conectados': event['usuarios_conectados']
-            }))
+            await self.enviar_frame(event['frames'])
 
     async def notificar_usuario_desconectado(self, event):
         """
         Notifica sobre un usuario desconectado.
         """
-        await self.send(text_data=json.dumps({
-            'tipo': 'usuario_desconectado',
-            'usuario_id': event['usuario_id'],
-            'usuario_nombre': event['usuario_nombre'],
-            'usuarios_conectados': event['usuarios_conectados']
-        }))
+        await self.enviar_frame(event['frames'])
 
     async def propagar_estado_edicion(self, event):
         """
@@ -273,19 +479,79 @@ class DiagramaConsumer(AsyncWebsocketConsumer):
         """
         # Solo enviar a otros usuarios
         if event['usuario_id'] != self.usuario.id:
-            await self.send(text_data=json.dumps({
-                'tipo': 'usuario_editando',
-                'elemento_id': event['elemento_id'],
-                'usuario_id': event['usuario_id'],
-                'usuario_nombre': event['usuario_nombre'],
-                'editando': event['editando']
-            }))
+            await self.enviar_frame(event['frames'])
+
+    async def acceso_actualizado(self, event):
+        """
+        Invalida el acceso cacheado cuando cambian los colaboradores del proyecto.
+        """
+        if event.get('usuario_id') in (None, getattr(self.usuario, 'id', None)):
+            self.tiene_acceso = None
+
+    async def estructura_modificada(self, event):
+        """
+        La estructura se escribió por la API REST: la sala la adopta y, si
+        el contenido cambió, el cliente recibe la estructura completa.
+        """
+        estado = self.estado_diagrama
+        if estado is None:
+            return
+        try:
+            await estado.recargar(event['version'])
+            if estado.generacion != self.generacion:
+                self.generacion = estado.generacion
+                await self.sincronizar_estado_diagrama()
+        except Exception as e:
+            logger.exception(f"Error recargando el diagrama {self.diagrama_id}: {e}")
 
     # ========== MÉTODOS AUXILIARES ==========
 
+    async def enviar_mensaje(self, mensaje):
+        """Envía el mensaje en el formato negociado con el cliente."""
+        # Lo encolado antes sale primero, para no alterar el orden
+        if getattr(self, 'cola_salida', None) is not None:
+            await self.cola_salida.vaciar()
+        await self.send(**codificar(mensaje, getattr(self, 'formato', FORMATO_JSON)))
+
+    async def enviar_frame(self, frames):
+        """
+        Envía el frame pre-codificado que corresponde al formato de esta
+        conexión, o lo encola si la conexión recibe lotes.
+        """
+        frame = frames.get(getattr(self, 'formato', FORMATO_JSON))
+        if frame is None:
+            # Difusión codificada justo antes de que esta conexión entrara en la
+            # sala: no incluye su formato, el cliente recupera el mensaje resincronizando
+            await self.enviar_mensaje({'tipo': 'resincronizar', 'motivo': 'formato'})
+            return
+        if getattr(self, 'cola_salida', None) is not None:
+            self.cola_salida.encolar(frame)
+        else:
+            await self.enviar_frame_directo(frame)
+
+    async def enviar_frame_directo(self, frame):
+        await self.send(**argumentos_send(frame, getattr(self, 'formato', FORMATO_JSON)))
+
+    async def difundir(self, tipo_evento, mensaje, **extra):
+        """
+        Envía `mensaje` al grupo del diagrama codificándolo una sola vez en
+        cada formato negociado por sus conexiones; `extra` viaja en el evento
+        para filtrar destinatarios.
+
+        La sala vive en un solo proceso, así que sus conexiones son las del
+        grupo; sin sala abierta no queda nadie a quien enviar.
+        """
+        estado = registro_estados.obtener(self.diagrama_id)
+        if estado is None:
+            return
+        await self.channel_layer.group_send(
+            self.grupo_diagrama,
+            {'type': tipo_evento, 'frames': codificar_difusion(mensaje, estado.formatos_activos()), **extra}
+        )
+
     async def enviar_error(self, mensaje):
         """Envía un mensaje de error al cliente."""
-        await self.send(text_data=json.dumps({
+        await self.enviar_mensaje({
             "tipo": "error",
             "mensaje": mensaje
-        }))
\ No newline at end of file
+        })
\ No newline at end of file
@@ -1,24 +1,38 @@
-from channels.db import database_sync_to_async
 from django.db import transaction
+from django.db.models import Exists, F, OuterRef
 from django.utils import timezone  # ← AGREGAR ESTA LÍNEA
 import logging
 
 from proyecto.models import DiagramaClase
-from .models import SesionColaborativa, ConexionUsuario, CambioDiagrama
+from .metricas import database_sync_to_async_medido
+from .models import SesionColaborativa, ConexionUsuario, CambioDiagrama, InstantaneaDiagrama
+from .services.historial import HistorialIncompleto, reconstruir_diagrama, ultima_revision
 
 
 logger = logging.getLogger(__name__)
 
 
-@database_sync_to_async
+@database_sync_to_async_medido
 def verificar_acceso_diagrama(diagrama_id, usuario):
+    return DiagramaClase.objects.accesibles_por(usuario).filter(id=diagrama_id).exists()
+
+@database_sync_to_async_medido
+def resolver_acceso_diagrama(diagrama_id, usuario):
+    """
+    Devuelve (proyecto_id, tiene_acceso) para cachear la decisión en el consumer.
+    proyecto_id es None si el diagrama no existe.
+    """
     try:
-        diagrama = DiagramaClase.objects.get(id=diagrama_id)
-        return diagrama.usuario_tiene_acceso(usuario)
+        return tuple(
+            DiagramaClase.objects.filter(id=diagrama_id)
+            .anotar_acceso(usuario)
+            .values_list('proyecto_id', 'tiene_acceso')
+            .get()
+        )
     except DiagramaClase.DoesNotExist:
-        return False
+        return None, False
 
-@database_sync_to_async
+@database_sync_to_async_medido
 def obtener_o_crear_sesion(diagrama_id):
     diagrama = DiagramaClase.objects.get(id=diagrama_id)
     sesion, creada = SesionColaborativa.objects.get_or_create(
@@ -27,60 +41,71 @@ def obtener_o_crear_sesion(diagrama_id):
     )
     return sesion
 
-@database_sync_to_async
+@database_sync_to_async_medido
 def obtener_sesion_activa(diagrama_id):
     try:
         return SesionColaborativa.objects.get(diagrama_id=diagrama_id, activa=True)
     except SesionColaborativa.DoesNotExist:
         return None
 
-@database_sync_to_async
-def registrar_conexion_usuario(sesion, usuario, channel_name):
-    conexion, creada = ConexionUsuario.objects.update_or_create(
-        sesion=sesion,
-        usuario=usuario,
-        defaults={
-            'canal_id': channel_name,
-            'desconectado': False
-        }
+@database_sync_to_async_medido
+def volcar_actividad_conexiones(registros):
+    """
+    Escribe en lote la actividad acumulada en memoria: crea las sesiones que
+    falten, reactiva las que tienen usuarios conectados y hace un único
+    upsert de ConexionUsuario por (sesion, usuario).
+    """
+    diagrama_ids = set(
+        DiagramaClase.objects.filter(id__in={r['diagrama_id'] for r in registros}).values_list('id', flat=True)
     )
-    return conexion
+    registros = [r for r in registros if r['diagrama_id'] in diagrama_ids]
+    if not registros:
+        return 0
 
-@database_sync_to_async
-def desregistrar_conexion_usuario(sesion, usuario):
-    try:
-        conexion = ConexionUsuario.objects.get(
-            sesion=sesion,
-            usuario=usuario,
-            desconectado=False
+    with transaction.atomic():
+        SesionColaborativa.objects.bulk_create(
+            [SesionColaborativa(diagrama_id=d) for d in diagrama_ids], ignore_conflicts=True
         )
-        conexion.desconectado = True
-        conexion.save()
-        return True
-    except ConexionUsuario.DoesNotExist:
-        return False
-
-@database_sync_to_async
-def obtener_usuarios_conectados(diagrama_id):
-    try:
-        sesion = SesionColaborativa.objects.get(diagrama_id=diagrama_id, activa=True)
-        conexiones = ConexionUsuario.objects.filter(
-            sesion=sesion,
-            desconectado=False
-        ).select_related('usuario')
-        return [
-            {
-                'id': conexion.usuario.id,
-                'nombre': f"{conexion.usuario.nombre} {conexion.usuario.apellido}",
-                'correo': conexion.usuario.correo_electronico,
-                'fecha_conexion': conexion.fecha_conexion.isoformat()
-            }
-            for conexion in conexiones
-        ]
-    except SesionColaborativa.DoesNotExist:
-        return []
+        sesiones = dict(
+            SesionColaborativa.objects.filter(diagrama_id__in=diagrama_ids).values_list('diagrama_id', 'id')
+        )
+        con_conectados = {sesiones[r['diagrama_id']] for r in registros if not r['desconectado']}
+        SesionColaborativa.objects.filter(id__in=con_conectados, activa=False).update(activa=True)
+
+        ConexionUsuario.objects.bulk_create(
+            [
+                ConexionUsuario(
+                    sesion_id=sesiones[r['diagrama_id']],
+                    usuario_id=r['usuario_id'],
+                    canal_id=r['canal_id'],
+                    fecha_ultima_actividad=r['ultima_actividad'],
+                    desconectado=r['desconectado'],
+                )
+                for r in registros
+            ],
+            update_conflicts=True,
+            unique_fields=['sesion', 'usuario'],
+            update_fields=['canal_id', 'fecha_ultima_actividad', 'desconectado'],
+        )
+    return len(registros)
+
+@database_sync_to_async_medido
+def cerrar_conexiones_inactivas(limite):
+    """
+    Marca como desconectadas las conexiones sin actividad desde `limite` y
+    desactiva las sesiones activas sin conexiones abiertas.
 
-@database_sync_to_async
+    Returns:
+        tuple: (conexiones cerradas, sesiones desactivadas)
+    """
+    conexiones = ConexionUsuario.objects.filter(
+        desconectado=False, fecha_ultima_actividad__lt=limite
+    ).update(desconectado=True)
+    abiertas = ConexionUsuario.objects.filter(sesion=OuterRef('pk'), desconectado=False)
+    sesiones = SesionColaborativa.objects.filter(activa=True).exclude(Exists(abiertas)).update(activa=False)
+    return conexiones, sesiones
+
+@database_sync_to_async_medido
 def obtener_estado_diagrama(diagrama_id):
     try:
         diagrama = DiagramaClase.objects.get(id=diagrama_id)
@@ -88,88 +113,133 @@ def obtener_estado_diagrama(diagrama_id):
     except DiagramaClase.DoesNotExist:
         return {'nodos': [], 'relaciones': []}
 
-@database_sync_to_async
-def aplicar_cambio_diagrama(diagrama_id, cambio, usuario):
+@database_sync_to_async_medido
+def cargar_estado_diagrama(diagrama_id):
     """
-    Aplica un cambio al diagrama en la base de datos.
+    Estructura, última revisión registrada y versión de la fila del
+    diagrama, para inicializar el estado en memoria de la sala.
+
+    Si la estructura guardada quedó en una revisión anterior (el proceso
+    terminó antes de persistirla), se recuperan sólo los cambios que le
+    faltan a partir de ella o de la instantánea más cercana.
+
+    La estructura puede ir por delante del registro (lote de CambioDiagrama
+    aún sin insertar): la numeración sigue desde la mayor de las dos para
+    no repetir revisiones ya entregadas a los clientes.
     """
     try:
-        logger.info(f"🔧 Aplicando cambio al diagrama {diagrama_id}: {cambio.get('tipo')}")
-        
-        # Import defensivo/local para evitar NameError si hay diferencias de carga
-        from django.utils import timezone as _timezone
-
-        with transaction.atomic():
-            diagrama = DiagramaClase.objects.get(id=diagrama_id)
-            
-            # Inicializar estructura si no existe
-            if not diagrama.estructura:
-                diagrama.estructura = {'nodos': [], 'relaciones': []}
-            
-            # Aplicar cambio según el tipo
-            tipo_cambio = cambio.get('tipo')
-            datos = cambio.get('datos', {})
-            
-            if tipo_cambio == 'crear_nodo':
-                if 'nodos' not in diagrama.estructura:
-                    diagrama.estructura['nodos'] = []
-                
-                # Verificar que el nodo no exista ya
-                nodo_existente = next((n for n in diagrama.estructura['nodos'] if n.get('id') == datos.get('id')), None)
-                if not nodo_existente:
-                    diagrama.estructura['nodos'].append(datos)
-                    logger.info(f"✅ Nodo creado: {datos.get('id')}")
-                else:
-                    logger.warning(f"⚠️  Nodo ya existe: {datos.get('id')}")
-            
-            # ... otros casos ...
-
-            # Actualizar timestamp
-            diagrama.estructura['ultima_modificacion'] = _timezone.now().isoformat()
-            diagrama.fecha_actualizacion = _timezone.now()
-            
-            diagrama.save()
-            logger.info(f"✅ Diagrama {diagrama_id} guardado exitosamente")
-            return True
-            
+        estructura, version = DiagramaClase.objects.values_list('estructura', 'version').get(id=diagrama_id)
     except DiagramaClase.DoesNotExist:
-        logger.warning(f"Diagrama {diagrama_id} no existe")
-        return False
-    except Exception as e:
-        logger.exception(f"Error aplicando cambio al diagrama {diagrama_id}: {e}")
-        return False
+        estructura, version = None, 0
+    estructura = estructura or {'nodos': [], 'relaciones': []}
+    revision = ultima_revision(diagrama_id)
+
+    # Sin `revision` la estructura se guardó por la API REST y es la vigente
+    guardada = estructura.get('revision')
+    if isinstance(guardada, int) and guardada < revision:
+        try:
+            estructura, _ = reconstruir_diagrama(diagrama_id, revision, base=(estructura, guardada))
+            logger.info(f"♻️ Diagrama {diagrama_id} recuperado de la revisión {guardada} a la {revision}")
+        except HistorialIncompleto as e:
+            logger.warning(f"⚠️ No se pudo recuperar el diagrama {diagrama_id}: {e}")
+    elif isinstance(guardada, int) and guardada > revision:
+        revision = guardada
+    return estructura, revision, version
+
+@database_sync_to_async_medido
+def leer_estructura_diagrama(diagrama_id):
+    """(estructura, version) guardadas del diagrama, o None si ya no existe."""
+    fila = DiagramaClase.objects.filter(id=diagrama_id).values_list('estructura', 'version').first()
+    if fila is None:
+        return None
+    return fila[0] or {'nodos': [], 'relaciones': []}, fila[1]
 
-@database_sync_to_async
-def registrar_cambio_diagrama(diagrama_id, cambio, usuario):
+@database_sync_to_async_medido
+def guardar_instantanea_diagrama(diagrama_id, revision, estructura, reemplazar=False):
     """
-    Registra un cambio en el diagrama en la base de datos.
-    Devuelve el id del cambio registrado (int) o None en fallo.
+    Registra la estructura del diagrama en `revision`. Con `reemplazar` la
+    instantánea existente se sustituye (contenido escrito fuera de la sala
+    sin revisión propia).
     """
-    try:
-        # Obtener o crear sesión (usar diagrama_id o diagrama según su modelo)
-        # Usamos la opción segura con objeto DiagramaClase
-        diagrama = DiagramaClase.objects.get(id=diagrama_id)
-        sesion, creada = SesionColaborativa.objects.get_or_create(
-            diagrama=diagrama,
-            defaults={'activa': True}
+    if reemplazar:
+        InstantaneaDiagrama.objects.update_or_create(
+            diagrama_id=diagrama_id, revision=revision, defaults={'estructura': estructura}
         )
-        
-        cambio_obj = CambioDiagrama.objects.create(
-            sesion=sesion,
-            usuario=usuario,
-            tipo_cambio=cambio.get('tipo', 'actualizar_nodo'),
-            datos_cambio=cambio
+    else:
+        InstantaneaDiagrama.objects.get_or_create(
+            diagrama_id=diagrama_id, revision=revision, defaults={'estructura': estructura}
         )
-        
-        logger.info(f"📊 Cambio registrado en BD: {cambio_obj.id}")
-        # Devolver solo el id para evitar problemas de transporte/serialización
-        return cambio_obj.id
-        
-    except Exception as e:
-        logger.exception(f"❌ Error registrando cambio: {e}")
+
+@database_sync_to_async_medido
+def guardar_estructura_diagrama(diagrama_id, estructura, version):
+    """
+    Persiste la estructura completa mantenida en memoria con un único UPDATE
+    condicionado a `version`, la última que la sala leyó o escribió.
+
+    Devuelve False si otra escritura (API REST) cambió la fila entretanto o
+    el diagrama ya no existe: la sala debe rehacer sus cambios sobre ella.
+    """
+    actualizados = DiagramaClase.objects.filter(id=diagrama_id, version=version).update(
+        estructura=estructura,
+        version=F('version') + 1,
+        fecha_actualizacion=timezone.now()
+    )
+    return actualizados > 0
+
+@database_sync_to_async_medido
+def insertar_cambios_diagrama(registros):
+    """
+    Inserta en bloque los cambios acumulados por EscritorCambios.
+
+    Resuelve las sesiones de todos los diagramas del lote con una consulta
+    (creando las que falten) y escribe los CambioDiagrama con bulk_create.
+    """
+    diagrama_ids = {int(registro['diagrama_id']) for registro in registros}
+    sesiones = dict(
+        SesionColaborativa.objects.filter(diagrama_id__in=diagrama_ids).values_list('diagrama_id', 'id')
+    )
+    sin_sesion = diagrama_ids - set(sesiones)
+    if sin_sesion:
+        for diagrama_id in DiagramaClase.objects.filter(id__in=sin_sesion).values_list('id', flat=True):
+            sesion, _ = SesionColaborativa.objects.get_or_create(
+                diagrama_id=diagrama_id,
+                defaults={'activa': True}
+            )
+            sesiones[diagrama_id] = sesion.id
+
+    cambios = [
+        CambioDiagrama(
+            sesion_id=sesiones[int(registro['diagrama_id'])],
+            usuario_id=registro['usuario_id'],
+            tipo_cambio=registro['cambio'].get('tipo', 'actualizar_nodo'),
+            datos_cambio=registro['cambio'],
+            revision=registro['revision'],
+        )
+        for registro in registros
+        if int(registro['diagrama_id']) in sesiones
+    ]
+    if len(cambios) < len(registros):
+        logger.warning(f"Se descartan {len(registros) - len(cambios)} cambios de diagramas inexistentes")
+    CambioDiagrama.objects.bulk_create(cambios)
+    return len(cambios)
+
+@database_sync_to_async_medido
+def obtener_cambios_desde(diagrama_id, revision, limite):
+    """
+    Cambios registrados del diagrama con revisión posterior a `revision`,
+    en orden. Devuelve None si hay más de `limite` (conviene enviar la
+    estructura completa).
+    """
+    cambios = list(
+        CambioDiagrama.objects.filter(
+            sesion__diagrama_id=diagrama_id,
+            revision__gt=revision
+        ).order_by('revision').values('revision', 'datos_cambio')[:limite + 1]
+    )
+    if len(cambios) > limite:
         return None
+    return [{'revision': c['revision'], 'cambio': c['datos_cambio']} for c in cambios]
 
-@database_sync_to_async
-def obtener_timestamp_actual():
-    from django.utils import timezone
+async def obtener_timestamp_actual():
+    # Sólo lee el reloj: no necesita el hilo de BD
     return timezone.now().isoformat()
\ No newline at end of file
@@ -0,0 +1,25 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from colaboracion_tiempo_real.services.actividad_conexiones import RegistroActividad
+from colaboracion_tiempo_real.services.presencia import TTL_PRESENCIA
+
+
+class Command(BaseCommand):
+    help = (
+        "Marca como desconectadas las ConexionUsuario sin actividad y desactiva las "
+        "sesiones que quedan vacías. Cada worker lo hace mientras tiene conexiones; "
+        "esto cubre los periodos sin ninguna (p. ej. tras caerse todos). Pensado "
+        "para ejecutarse periódicamente (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--inactividad', type=int, default=TTL_PRESENCIA,
+            help='Segundos sin latido tras los que una conexión se da por cerrada'
+        )
+
+    def handle(self, *args, **opciones):
+        registro = RegistroActividad(inactividad=opciones['inactividad'])
+        conexiones, sesiones = async_to_sync(registro.recolectar)()
+        self.stdout.write(f"{conexiones} conexiones cerradas, {sesiones} sesiones desactivadas")
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from Backend import codec_json
+from colaboracion_tiempo_real.services.historial import CompactadorHistorial, RETENCION_DIAS, TAMANO_LOTE
+
+
+class Command(BaseCommand):
+    help = (
+        "Resume en instantáneas los CambioDiagrama más antiguos que la retención "
+        "y los borra en lotes acotados. Pensado para ejecutarse periódicamente (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=RETENCION_DIAS, help='Retención del historial en días')
+        parser.add_argument('--lote', type=int, default=TAMANO_LOTE, help='Filas borradas por transacción')
+        parser.add_argument('--pausa', type=float, default=0, help='Segundos de espera entre lotes')
+        parser.add_argument('--max-diagramas', type=int, default=None, help='Diagramas a procesar en esta ejecución')
+        parser.add_argument('--archivo', help='Archivar los cambios borrados en este fichero (JSON por línea)')
+
+    def handle(self, *args, **opciones):
+        archivo = open(opciones['archivo'], 'a', encoding='utf-8') if opciones['archivo'] else None
+        try:
+            archivar = None
+            if archivo is not None:
+                def archivar(filas):
+                    archivo.writelines(codec_json.dumps(fila) + '\n' for fila in filas)
+                    archivo.flush()
+
+            resumen = CompactadorHistorial(
+                retencion_dias=opciones['dias'],
+                lote=opciones['lote'],
+                pausa=opciones['pausa'],
+                archivar=archivar,
+            ).ejecutar(max_diagramas=opciones['max_diagramas'])
+        finally:
+            if archivo is not None:
+                archivo.close()
+
+        self.stdout.write(
+            f"{resumen['diagramas']} diagramas, {resumen['instantaneas']} instantáneas creadas, "
+            f"{resumen['eliminados']} cambios eliminados"
+        )
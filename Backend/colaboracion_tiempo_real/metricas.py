@@ -0,0 +1,57 @@
+import functools
+import threading
+import time
+from collections import Counter
+
+from channels.db import database_sync_to_async
+
+# Contadores por proceso de la colaboración en tiempo real (p. ej. para logs o un endpoint de estado)
+_contadores = Counter()
+_lock = threading.Lock()
+
+
+def incrementar(nombre, cantidad=1):
+    """Suma `cantidad` (puede ser negativa) y devuelve el valor resultante."""
+    with _lock:
+        _contadores[nombre] += cantidad
+        return _contadores[nombre]
+
+
+def maximo(nombre, valor):
+    """Guarda `valor` si supera el máximo registrado."""
+    with _lock:
+        if valor > _contadores[nombre]:
+            _contadores[nombre] = valor
+
+
+def obtener():
+    """Instantánea de todos los contadores."""
+    with _lock:
+        return dict(_contadores)
+
+
+def database_sync_to_async_medido(funcion):
+    """
+    database_sync_to_async que mide la ocupación del executor de BD:
+
+    - bd_en_curso / bd_en_curso_max: llamadas esperando o ejecutándose
+    - bd_llamadas, bd_espera_ms: llamadas y tiempo total en cola antes de
+      que el hilo de BD las tome; una espera media creciente indica saturación
+    """
+    @functools.wraps(funcion)
+    def en_hilo(encolada, *args, **kwargs):
+        incrementar('bd_espera_ms', round((time.perf_counter() - encolada) * 1000))
+        return funcion(*args, **kwargs)
+
+    asincrona = database_sync_to_async(en_hilo)
+
+    @functools.wraps(funcion)
+    async def envoltura(*args, **kwargs):
+        maximo('bd_en_curso_max', incrementar('bd_en_curso'))
+        incrementar('bd_llamadas')
+        try:
+            return await asincrona(time.perf_counter(), *args, **kwargs)
+        finally:
+            incrementar('bd_en_curso', -1)
+
+    return envoltura
@@ -1,6 +1,5 @@
 # colaboracion_tiempo_real/middleware.py
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
 from django.conf import settings
@@ -10,6 +9,8 @@ import logging
 from rest_framework_simplejwt.tokens import UntypedToken
 from rest_framework_simplejwt.backends import TokenBackend
 
+from .metricas import database_sync_to_async_medido
+
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
@@ -59,7 +60,7 @@ class JWTAuthMiddleware(BaseMiddleware):
                 user_id = payload.get('user_id') or payload.get('user') or payload.get('sub')
                 if user_id:
                     try:
-                        user = await database_sync_to_async(User.objects.get)(id=user_id)
+                        user = await database_sync_to_async_medido(User.objects.get)(id=user_id)
                         scope['user'] = user
                     except Exception:
                         logger.debug("JWTAuthMiddleware: usuario no encontrado para id=%s", user_id)
@@ -4,6 +4,7 @@ from django.db import models
 
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from proyecto.models import DiagramaClase
 
 class SesionColaborativa(models.Model):
@@ -38,13 +39,25 @@ class ConexionUsuario(models.Model):
     usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     canal_id = models.CharField(max_length=255)  # ID del canal WebSocket
     fecha_conexion = models.DateTimeField(auto_now_add=True)
-    fecha_ultima_actividad = models.DateTimeField(auto_now=True)
+    # Último latido visto en memoria (RegistroActividadConexiones); sin auto_now para
+    # que el volcado en lote no lo reemplace por la hora de escritura
+    fecha_ultima_actividad = models.DateTimeField(default=timezone.now)
     desconectado = models.BooleanField(default=False)
 
     class Meta:
         verbose_name = "Conexión de Usuario"
         verbose_name_plural = "Conexiones de Usuario"
         unique_together = ['sesion', 'usuario']
+        indexes = [
+            # Conexiones abiertas de una sesión (EXISTS del recolector de sesiones vacías)
+            models.Index(fields=['sesion', 'desconectado'], name='conexion_sesion_desconect_idx'),
+            # Recolector: conexiones abiertas sin actividad reciente
+            models.Index(
+                fields=['fecha_ultima_actividad'],
+                condition=models.Q(desconectado=False),
+                name='conexion_abierta_actividad_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.usuario} en {self.sesion}"
@@ -68,11 +81,37 @@ class CambioDiagrama(models.Model):
     datos_cambio = models.JSONField()  # Datos específicos del cambio
     timestamp = models.DateTimeField(auto_now_add=True)
     sincronizado = models.BooleanField(default=False)
+    # Número de secuencia del cambio dentro del diagrama (asignado en memoria)
+    revision = models.PositiveBigIntegerField(null=True, blank=True)
 
     class Meta:
         verbose_name = "Cambio de Diagrama"
         verbose_name_plural = "Cambios de Diagrama"
         ordering = ['-timestamp']
+        indexes = [
+            # Resincronización incremental: cambios de una sesión posteriores a una revisión
+            models.Index(fields=['sesion', 'revision'], name='cambio_sesion_revision_idx'),
+            # Historial de una sesión en el orden por defecto (-timestamp)
+            models.Index(fields=['sesion', '-timestamp'], name='cambio_sesion_timestamp_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.usuario} - {self.tipo_cambio} - {self.timestamp}"
\ No newline at end of file
+        return f"{self.usuario} - {self.tipo_cambio} - {self.timestamp}"
+
+class InstantaneaDiagrama(models.Model):
+    """
+    Estructura de un diagrama tal como quedó tras una revisión (checkpoint).
+    La compactación del historial resume aquí los CambioDiagrama antiguos.
+    """
+    diagrama = models.ForeignKey(DiagramaClase, on_delete=models.CASCADE, related_name='instantaneas')
+    revision = models.PositiveBigIntegerField()
+    estructura = models.JSONField()
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Instantánea de Diagrama"
+        verbose_name_plural = "Instantáneas de Diagrama"
+        unique_together = ['diagrama', 'revision']
+
+    def __str__(self):
+        return f"{self.diagrama_id} @ {self.revision}"
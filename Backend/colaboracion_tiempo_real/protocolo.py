@@ -0,0 +1,157 @@
+"""
+Codificación de los mensajes del WebSocket de diagramas.
+
+JSON (texto) es el formato por defecto. Un cliente puede negociar
+MessagePack (frames binarios) con el subprotocolo `diagrama.msgpack` o con
+`?formato=msgpack` en la URL; en ese formato los mensajes frecuentes
+(`cambio_recibido`, `usuario_editando`) usan claves cortas. Si msgpack no
+está instalado se sigue usando JSON.
+
+Con `?lotes=1` el cliente acepta frames `{"tipo": "lote", "mensajes": [...]}`
+que agrupan varios mensajes de grupo (ver services/cola_salida.py).
+"""
+from urllib.parse import parse_qs
+
+from Backend import codec_json
+
+try:
+    import msgpack
+except ImportError:  # dependencia opcional
+    msgpack = None
+
+FORMATO_JSON = 'json'
+FORMATO_MSGPACK = 'msgpack'
+SUBPROTOCOLO_MSGPACK = 'diagrama.msgpack'
+
+# Claves cortas por tipo de mensaje (sólo en MessagePack)
+CLAVES_CORTAS = {
+    'cambio_recibido': {
+        'tipo': 't',
+        'usuario_nombre': 'n',
+        'cambio': 'c',
+        'cambio_id': 'i',
+        'revision': 'r',
+    },
+    'usuario_editando': {
+        'tipo': 't',
+        'elemento_id': 'e',
+        'usuario_id': 'u',
+        'usuario_nombre': 'n',
+        'editando': 'x',
+    },
+}
+# El propio tipo también se abrevia
+TIPOS_CORTOS = {'cambio_recibido': 'cr', 'usuario_editando': 'ue'}
+# Dentro de `cambio` sólo se abrevian las claves del sobre; `datos` va tal cual
+CLAVES_CAMBIO = {'tipo': 't', 'datos': 'd'}
+
+
+def negociar_formato(scope):
+    """
+    Devuelve (formato, subprotocolo a aceptar o None) según lo que pidió el cliente.
+    """
+    if msgpack is None:
+        return FORMATO_JSON, None
+    if SUBPROTOCOLO_MSGPACK in scope.get('subprotocols', []):
+        return FORMATO_MSGPACK, SUBPROTOCOLO_MSGPACK
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('formato', [FORMATO_JSON])[0] == FORMATO_MSGPACK:
+        return FORMATO_MSGPACK, None
+    return FORMATO_JSON, None
+
+
+def negociar_lotes(scope):
+    """True si el cliente pidió recibir los mensajes de grupo en lotes."""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('lotes', ['0'])[0] in ('1', 'true')
+
+
+def abreviar(mensaje):
+    """Aplica las claves cortas si el tipo de mensaje las tiene."""
+    tipo = mensaje.get('tipo')
+    claves = CLAVES_CORTAS.get(tipo)
+    if claves is None:
+        return mensaje
+    corto = {claves.get(clave, clave): valor for clave, valor in mensaje.items()}
+    corto[claves['tipo']] = TIPOS_CORTOS[tipo]
+    cambio = mensaje.get('cambio')
+    if isinstance(cambio, dict):
+        corto[claves['cambio']] = {CLAVES_CAMBIO.get(clave, clave): valor for clave, valor in cambio.items()}
+    return corto
+
+
+def codificar(mensaje, formato=FORMATO_JSON):
+    """
+    Codifica el mensaje para `send`.
+
+    Returns:
+        dict: {'text_data': str} en JSON o {'bytes_data': bytes} en MessagePack
+    """
+    if formato == FORMATO_MSGPACK:
+        return {'bytes_data': msgpack.packb(abreviar(mensaje), use_bin_type=True)}
+    return {'text_data': codec_json.dumps(mensaje)}
+
+
+def codificar_difusion(mensaje, formatos=None):
+    """
+    Codifica un mensaje de grupo una sola vez por formato, para incluirlo en
+    el evento del channel layer; cada consumer sólo elige su frame y lo envía.
+
+    Args:
+        formatos: formatos de las conexiones que lo recibirán (None: todos)
+
+    Returns:
+        dict: {formato: str | bytes}
+    """
+    if formatos is None:
+        formatos = [FORMATO_JSON] if msgpack is None else [FORMATO_JSON, FORMATO_MSGPACK]
+    frames = {}
+    if FORMATO_JSON in formatos:
+        frames[FORMATO_JSON] = codec_json.dumps(mensaje)
+    if FORMATO_MSGPACK in formatos:
+        frames[FORMATO_MSGPACK] = codificar(mensaje, FORMATO_MSGPACK)['bytes_data']
+    return frames
+
+
+def argumentos_send(frame, formato=FORMATO_JSON):
+    """Argumentos de `send` para un frame ya codificado."""
+    if formato == FORMATO_MSGPACK:
+        return {'bytes_data': frame}
+    return {'text_data': frame}
+
+
+def codificar_lote(frames, formato=FORMATO_JSON):
+    """
+    Une frames ya codificados en un único mensaje `lote` sin volver a
+    serializarlos: en JSON se concatena el texto y en MessagePack se escribe
+    la cabecera del mapa y del arreglo delante de los bytes.
+    """
+    if formato == FORMATO_MSGPACK:
+        packer = msgpack.Packer(use_bin_type=True)
+        return b''.join([
+            packer.pack_map_header(2),
+            packer.pack('tipo'),
+            packer.pack('lote'),
+            packer.pack('mensajes'),
+            packer.pack_array_header(len(frames)),
+            *frames,
+        ])
+    return '{"tipo":"lote","mensajes":[' + ','.join(frames) + ']}'
+
+
+def decodificar(text_data=None, bytes_data=None):
+    """
+    Decodifica un mensaje del cliente: texto como JSON (con el codec de
+    Backend.codec_json) y binario como MessagePack (siempre con claves completas).
+
+    Raises:
+        ValueError: si el contenido no es válido
+    """
+    if bytes_data is not None:
+        if msgpack is None:
+            raise ValueError('Formato binario no soportado')
+        try:
+            return msgpack.unpackb(bytes_data, raw=False)
+        except Exception as e:
+            raise ValueError(f'MessagePack inválido: {e}') from e
+    return codec_json.loads(text_data)
@@ -0,0 +1,32 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+
+def grupo_diagrama(diagrama_id):
+    """Grupo al que se unen los consumers abiertos sobre un diagrama."""
+    return f'diagrama_{diagrama_id}'
+
+
+def notificar_estructura_modificada(diagrama_id, version):
+    """
+    Avisa a la sala del diagrama que su estructura se escribió fuera de ella
+    (API REST) y quedó en `version`: la sala la adopta antes de su próxima
+    escritura y reenvía la estructura completa a los clientes.
+    """
+    try:
+        channel_layer = get_channel_layer()
+        if channel_layer:
+            async_to_sync(channel_layer.group_send)(
+                grupo_diagrama(diagrama_id),
+                {
+                    'type': 'estructura.modificada',
+                    'diagrama_id': diagrama_id,
+                    'version': version,
+                }
+            )
+    except Exception:
+        logger.exception('Error notificando la modificación del diagrama %s', diagrama_id)
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .. import metricas
+from .presencia import TTL_PRESENCIA
+
+logger = logging.getLogger(__name__)
+
+# Cada cuántos segundos se vuelca la actividad a ConexionUsuario y se
+# cierran las conexiones sin latido
+INTERVALO_ACTIVIDAD = getattr(settings, 'COLABORACION_INTERVALO_ACTIVIDAD', 15.0)
+
+
+class RegistroActividad:
+    """
+    Última actividad de cada conexión WebSocket de este proceso.
+
+    connect/ping/disconnect sólo tocan memoria; cada `intervalo` segundos
+    las conexiones con actividad se vuelcan a ConexionUsuario en un único
+    upsert y se ejecuta el recolector, que marca como desconectadas las
+    filas sin actividad durante `inactividad` segundos (p. ej. de un worker
+    caído) y desactiva las sesiones que quedan vacías.
+
+    El ciclo sólo corre mientras el proceso tiene conexiones; el comando
+    `cerrar_conexiones_inactivas` ejecuta el recolector sin depender de ellas.
+    """
+
+    def __init__(self, volcar=None, cerrar_inactivas=None, intervalo=INTERVALO_ACTIVIDAD, inactividad=TTL_PRESENCIA):
+        self._volcar = volcar
+        self._cerrar_inactivas = cerrar_inactivas
+        self._intervalo = intervalo
+        self._inactividad = inactividad
+        self._conexiones = {}
+        self._modificadas = set()
+        self._tarea = None
+
+    def _funciones_bd(self):
+        if self._volcar is None or self._cerrar_inactivas is None:
+            # Import diferido: diagrama_db depende de los modelos
+            from colaboracion_tiempo_real.diagrama_db import volcar_actividad_conexiones, cerrar_conexiones_inactivas
+            self._volcar = self._volcar or volcar_actividad_conexiones
+            self._cerrar_inactivas = self._cerrar_inactivas or cerrar_conexiones_inactivas
+        return self._volcar, self._cerrar_inactivas
+
+    def conectar(self, diagrama_id, usuario_id, canal):
+        self._conexiones[canal] = {
+            'diagrama_id': int(diagrama_id),
+            'usuario_id': usuario_id,
+            'canal_id': canal,
+            'ultima_actividad': timezone.now(),
+            'desconectado': False,
+        }
+        self._modificadas.add(canal)
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.ensure_future(self._ciclo())
+
+    def latido(self, canal):
+        conexion = self._conexiones.get(canal)
+        if conexion is not None:
+            conexion['ultima_actividad'] = timezone.now()
+            self._modificadas.add(canal)
+
+    def desconectar(self, canal):
+        conexion = self._conexiones.get(canal)
+        if conexion is not None:
+            conexion['desconectado'] = True
+            self._modificadas.add(canal)
+
+    def _registros_pendientes(self):
+        """
+        Una fila por (diagrama, usuario) con actividad: ConexionUsuario es
+        única por sesión y usuario, así que varias pestañas se combinan y la
+        fila sigue conectada mientras quede alguna abierta.
+        """
+        pares = {
+            (c['diagrama_id'], c['usuario_id'])
+            for canal in self._modificadas
+            if (c := self._conexiones.get(canal)) is not None
+        }
+        registros = {}
+        for conexion in self._conexiones.values():
+            par = (conexion['diagrama_id'], conexion['usuario_id'])
+            if par not in pares:
+                continue
+            # Prioridad: conexiones abiertas y, entre ellas, la más reciente
+            clave = (not conexion['desconectado'], conexion['ultima_actividad'])
+            actual = registros.get(par)
+            if actual is None or clave > actual[0]:
+                registros[par] = (clave, conexion)
+        return [dict(conexion) for _, conexion in registros.values()]
+
+    async def vaciar(self):
+        """Vuelca la actividad pendiente. Devuelve el número de filas escritas."""
+        registros = self._registros_pendientes()
+        # Las desconexiones ya registradas salen de memoria
+        for canal in self._modificadas:
+            if self._conexiones.get(canal, {}).get('desconectado'):
+                del self._conexiones[canal]
+        self._modificadas = set()
+        if not registros:
+            return 0
+        volcar, _ = self._funciones_bd()
+        try:
+            await volcar(registros)
+            return len(registros)
+        except Exception as e:
+            logger.exception(f"❌ Error volcando actividad de {len(registros)} conexiones: {e}")
+            return 0
+
+    async def recolectar(self):
+        """Cierra conexiones sin actividad reciente y sesiones vacías."""
+        _, cerrar_inactivas = self._funciones_bd()
+        limite = timezone.now() - timedelta(seconds=self._inactividad)
+        try:
+            conexiones, sesiones = await cerrar_inactivas(limite)
+        except Exception as e:
+            logger.exception(f"❌ Error cerrando conexiones inactivas: {e}")
+            return 0, 0
+        if conexiones or sesiones:
+            metricas.incrementar('conexiones_cerradas_por_inactividad', conexiones)
+            metricas.incrementar('sesiones_desactivadas', sesiones)
+            logger.info(f"🧹 {conexiones} conexiones inactivas cerradas, {sesiones} sesiones desactivadas")
+        return conexiones, sesiones
+
+    async def _ciclo(self):
+        # Se ejecuta mientras este proceso tenga conexiones registradas
+        while self._conexiones:
+            await asyncio.sleep(self._intervalo)
+            await self.vaciar()
+            await self.recolectar()
+
+
+registro_actividad = RegistroActividad()
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .. import metricas
+from ..protocolo import FORMATO_JSON, codificar_difusion, codificar_lote
+
+logger = logging.getLogger(__name__)
+
+VENTANA_LOTE = getattr(settings, 'COLABORACION_LOTE_VENTANA', 0.05)
+MAXIMO_LOTE = getattr(settings, 'COLABORACION_LOTE_MAXIMO', 100)
+LIMITE_COLA = getattr(settings, 'COLABORACION_LOTE_LIMITE', 2000)
+
+# Aviso al cliente cuyos mensajes pendientes se descartaron (un frame por formato)
+FRAMES_RESINCRONIZAR = codificar_difusion({'tipo': 'resincronizar', 'motivo': 'cola_saturada'})
+
+
+class ColaSalida:
+    """
+    Cola de mensajes de grupo salientes de una conexión WebSocket.
+
+    Los frames (ya codificados en el formato de la conexión) se acumulan
+    durante `ventana` segundos, o hasta `maximo` frames, y se envían juntos
+    en un único frame `lote`.
+
+    Si entre dos envíos se acumulan más de `limite` frames (una ráfaga de
+    mensajes de grupo más rápida de lo que el ciclo llega a enviarla), se
+    descartan: el cliente recibe un único `resincronizar` y, hasta que pida
+    `sincronizar_estado`, no se le encola nada más; recupera el estado con
+    la resincronización incremental en lugar de con todos los mensajes
+    intermedios.
+
+    No es contrapresión del cliente: `send` entrega el frame al servidor
+    ASGI sin esperar a que el cliente lo lea, así que lo que un cliente
+    lento no consume se acumula en el buffer del servidor, no aquí.
+    """
+
+    def __init__(self, enviar, formato=FORMATO_JSON, ventana=VENTANA_LOTE, maximo=MAXIMO_LOTE, limite=LIMITE_COLA):
+        # enviar: corrutina que recibe un frame codificado (str o bytes)
+        self._enviar = enviar
+        self._formato = formato
+        self._ventana = ventana
+        self._maximo = maximo
+        self._limite = limite
+        self._frames = []
+        self._desbordada = False
+        self._aviso_pendiente = False
+        self._lleno = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._tarea = None
+
+    def encolar(self, frame):
+        if self._desbordada:
+            metricas.incrementar('lote_frames_descartados')
+            return
+        self._frames.append(frame)
+        if len(self._frames) > self._limite:
+            metricas.incrementar('lote_frames_descartados', len(self._frames))
+            metricas.incrementar('lote_colas_saturadas')
+            logger.warning(f"⚠️ Cola de salida saturada ({len(self._frames)} mensajes); se pide resincronizar")
+            self._frames = []
+            self._desbordada = True
+            self._aviso_pendiente = True
+            self._lleno.set()
+        elif len(self._frames) >= self._maximo:
+            self._lleno.set()
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.ensure_future(self._ciclo())
+
+    def reanudar(self):
+        """El cliente pidió resincronizar: se vuelven a encolar sus mensajes."""
+        self._desbordada = False
+
+    async def vaciar(self):
+        """Envía lo pendiente; devuelve el número de mensajes enviados."""
+        async with self._lock:
+            frames, self._frames = self._frames, []
+            aviso, self._aviso_pendiente = self._aviso_pendiente, False
+            self._lleno.clear()
+            if aviso:
+                await self._enviar(FRAMES_RESINCRONIZAR[self._formato])
+            if not frames:
+                return 0
+            if len(frames) == 1:
+                await self._enviar(frames[0])
+            else:
+                metricas.incrementar('lotes_enviados')
+                await self._enviar(codificar_lote(frames, self._formato))
+            metricas.incrementar('lote_mensajes_enviados', len(frames))
+            return len(frames)
+
+    async def _ciclo(self):
+        # Mientras haya mensajes: esperar la ventana (o a que se llene) y enviar
+        try:
+            while self._frames or self._aviso_pendiente:
+                if not self._lleno.is_set():
+                    try:
+                        await asyncio.wait_for(self._lleno.wait(), self._ventana)
+                    except asyncio.TimeoutError:
+                        pass
+                await self.vaciar()
+        except Exception as e:
+            logger.exception(f"❌ Error enviando lote de mensajes: {e}")
+
+    def cerrar(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+        self._frames = []
@@ -0,0 +1,114 @@
+class DiagramaIndexado:
+    """
+    Estructura de un diagrama indexada por id de nodo y de relación.
+
+    Mantiene además, por cada nodo, el conjunto de relaciones que llegan o
+    salen de él, de modo que todas las operaciones de cambio son O(1) y al
+    eliminar un nodo se eliminan sus relaciones sin recorrer la lista.
+
+    Los dicts de nodos y relaciones nunca se modifican en sitio (se
+    reemplazan), por lo que `a_estructura()` devuelve una instantánea
+    segura aunque el diagrama siga cambiando después.
+    """
+
+    CLAVES_ESTRUCTURA = ('nodos', 'relaciones')
+
+    def __init__(self, estructura=None):
+        estructura = estructura or {}
+        self.nodos = {}
+        self.relaciones = {}
+        self._relaciones_por_nodo = {}
+        # Claves adicionales del JSON (p. ej. 'ultima_modificacion') se conservan tal cual
+        self.extras = {
+            clave: valor for clave, valor in estructura.items()
+            if clave not in self.CLAVES_ESTRUCTURA
+        }
+
+        for nodo in estructura.get('nodos') or []:
+            self.nodos.setdefault(nodo.get('id'), nodo)
+        for relacion in estructura.get('relaciones') or []:
+            if relacion.get('id') not in self.relaciones:
+                self._indexar_relacion(relacion)
+
+    def a_estructura(self):
+        """Serializa al formato {'nodos': [...], 'relaciones': [...]} guardado en BD."""
+        return {
+            **self.extras,
+            'nodos': list(self.nodos.values()),
+            'relaciones': list(self.relaciones.values()),
+        }
+
+    def relaciones_de_nodo(self, nodo_id):
+        """Ids de las relaciones que tienen al nodo como origen o destino."""
+        return frozenset(self._relaciones_por_nodo.get(nodo_id, ()))
+
+    # ========== NODOS ==========
+
+    def crear_nodo(self, datos_nodo):
+        nodo_id = datos_nodo.get('id')
+        if nodo_id in self.nodos:
+            return False
+        self.nodos[nodo_id] = datos_nodo
+        return True
+
+    def actualizar_nodo(self, datos_nodo):
+        nodo_id = datos_nodo.get('id')
+        nodo = self.nodos.get(nodo_id)
+        if nodo is None:
+            return False
+        self.nodos[nodo_id] = {**nodo, **datos_nodo}
+        return True
+
+    def eliminar_nodo(self, datos_nodo):
+        """Elimina el nodo y, en cascada, las relaciones que lo referencian."""
+        nodo_id = datos_nodo.get('id')
+        if self.nodos.pop(nodo_id, None) is None:
+            return False
+        for relacion_id in self._relaciones_por_nodo.pop(nodo_id, set()):
+            self._desindexar_relacion(self.relaciones.pop(relacion_id))
+        return True
+
+    # ========== RELACIONES ==========
+
+    def crear_relacion(self, datos_relacion):
+        if datos_relacion.get('id') in self.relaciones:
+            return False
+        self._indexar_relacion(datos_relacion)
+        return True
+
+    def actualizar_relacion(self, datos_relacion):
+        relacion_id = datos_relacion.get('id')
+        relacion = self.relaciones.get(relacion_id)
+        if relacion is None:
+            return False
+        self._desindexar_relacion(relacion)
+        self._indexar_relacion({**relacion, **datos_relacion})
+        return True
+
+    def eliminar_relacion(self, datos_relacion):
+        relacion = self.relaciones.pop(datos_relacion.get('id'), None)
+        if relacion is None:
+            return False
+        self._desindexar_relacion(relacion)
+        return True
+
+    # ========== AUXILIARES ==========
+
+    @staticmethod
+    def _extremos(relacion):
+        return {relacion.get('source'), relacion.get('target')} - {None}
+
+    def _indexar_relacion(self, relacion):
+        relacion_id = relacion.get('id')
+        self.relaciones[relacion_id] = relacion
+        for nodo_id in self._extremos(relacion):
+            self._relaciones_por_nodo.setdefault(nodo_id, set()).add(relacion_id)
+
+    def _desindexar_relacion(self, relacion):
+        relacion_id = relacion.get('id')
+        for nodo_id in self._extremos(relacion):
+            incidentes = self._relaciones_por_nodo.get(nodo_id)
+            if incidentes is not None:
+                incidentes.discard(relacion_id)
+                if not incidentes:
+                    del self._relaciones_por_nodo[nodo_id]
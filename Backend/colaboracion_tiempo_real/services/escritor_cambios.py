@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from collections import deque
+
+from django.conf import settings
+
+from colaboracion_tiempo_real import metricas
+
+logger = logging.getLogger(__name__)
+
+# Se inserta un lote al alcanzar este número de cambios o al pasar el intervalo (segundos)
+LOTE_MAXIMO = getattr(settings, 'COLABORACION_CAMBIOS_LOTE_MAXIMO', 100)
+INTERVALO_ESCRITURA = getattr(settings, 'COLABORACION_CAMBIOS_INTERVALO', 0.25)
+# Espera máxima (segundos) entre reintentos de un lote que falló al insertarse
+ESPERA_MAXIMA_REINTENTO = 30.0
+# Registros descartados que se conservan en memoria para inspeccionarlos
+MAXIMO_DESCARTADOS = 1000
+
+
+class EscritorCambios:
+    """
+    Buffer por proceso de los CambioDiagrama pendientes de insertar.
+
+    El consumer encola el cambio (con la revisión ya asignada por el estado
+    en memoria) y confirma al cliente sin esperar a la BD; los registros se
+    insertan con un único bulk_create por lote.
+
+    Si la inserción falla el lote vuelve a la cola y se reintenta con espera
+    creciente: esas revisiones ya se entregaron a los clientes y sin su
+    registro la resincronización y la reconstrucción tendrían huecos.
+    Si sigue fallando con la espera máxima, el lote se inserta por mitades
+    para aislar los registros que fallan por sí mismos; ésos se descartan
+    (quedan en el log y en `descartados`) y el resto se escribe.
+    """
+
+    def __init__(self, insertar=None, lote_maximo=LOTE_MAXIMO, intervalo=INTERVALO_ESCRITURA,
+                 espera_maxima=ESPERA_MAXIMA_REINTENTO):
+        self._insertar = insertar
+        self._lote_maximo = lote_maximo
+        self._intervalo = intervalo
+        self._espera_maxima = espera_maxima
+        self._pendientes = []
+        self._tarea = None
+        self._espera = intervalo
+        self.descartados = deque(maxlen=MAXIMO_DESCARTADOS)
+
+    @property
+    def pendientes(self):
+        return len(self._pendientes)
+
+    def _funcion_insertar(self):
+        if self._insertar is None:
+            # Import diferido: diagrama_db depende de los modelos
+            from colaboracion_tiempo_real.diagrama_db import insertar_cambios_diagrama
+            self._insertar = insertar_cambios_diagrama
+        return self._insertar
+
+    def encolar(self, diagrama_id, revision, cambio, usuario_id):
+        self._pendientes.append({
+            'diagrama_id': diagrama_id,
+            'revision': revision,
+            'usuario_id': usuario_id,
+            'cambio': cambio,
+        })
+        # Mientras se reintenta un lote fallido no se fuerzan escrituras inmediatas
+        if len(self._pendientes) >= self._lote_maximo and self._espera == self._intervalo:
+            asyncio.ensure_future(self.vaciar())
+        else:
+            self._programar()
+
+    def _programar(self):
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.ensure_future(self._vaciar_diferido())
+
+    async def _vaciar_diferido(self):
+        # Sigue mientras quede algo: un lote reencolado se reintenta tras `self._espera`
+        while self._pendientes:
+            await asyncio.sleep(self._espera)
+            await self.vaciar()
+
+    async def vaciar(self):
+        """Inserta todo lo pendiente. Devuelve el número de registros escritos."""
+        if not self._pendientes:
+            return 0
+        lote, self._pendientes = self._pendientes, []
+        try:
+            await self._funcion_insertar()(lote)
+        except Exception as e:
+            if self._espera >= self._espera_maxima:
+                # Último reintento agotado: se separan los registros que no se pueden escribir
+                logger.exception(f"❌ El lote de {len(lote)} cambios sigue fallando; se inserta por partes: {e}")
+                escritos = await self._aislar(lote, e)
+                self._espera = self._intervalo
+                return escritos
+            self._pendientes = lote + self._pendientes
+            self._espera = min(self._espera * 2, self._espera_maxima)
+            logger.exception(f"❌ Error registrando lote de {len(lote)} cambios; reintento en {self._espera}s: {e}")
+            self._programar()
+            return 0
+        self._espera = self._intervalo
+        logger.debug(f"📊 {len(lote)} cambios registrados en BD")
+        return len(lote)
+
+    async def _aislar(self, lote, error):
+        """
+        Inserta por mitades un lote que falló; el registro que falla solo
+        se descarta. Devuelve el número de registros escritos.
+        """
+        if len(lote) == 1:
+            self._descartar(lote[0], error)
+            return 0
+        escritos = 0
+        mitad = len(lote) // 2
+        for parte in (lote[:mitad], lote[mitad:]):
+            try:
+                await self._funcion_insertar()(parte)
+                escritos += len(parte)
+            except Exception as e:
+                escritos += await self._aislar(parte, e)
+        return escritos
+
+    def _descartar(self, registro, error):
+        metricas.incrementar('cambios_descartados')
+        self.descartados.append(registro)
+        logger.error(
+            f"🗑️ Cambio descartado del diagrama {registro['diagrama_id']} (revisión {registro['revision']}): "
+            f"{error}; {registro['cambio']}"
+        )
+
+
+escritor_cambios = EscritorCambios()
@@ -0,0 +1,367 @@
+import asyncio
+import contextlib
+import logging
+from collections import Counter, deque
+
+from django.conf import settings
+from django.utils import timezone
+
+from .diagrama_indexado import DiagramaIndexado
+from .presencia import presencia
+from .sincronizacion import ServicioSincronizacion
+
+logger = logging.getLogger(__name__)
+
+# Segundos entre la primera modificación pendiente y su escritura en BD.
+INTERVALO_PERSISTENCIA = getattr(settings, 'COLABORACION_INTERVALO_PERSISTENCIA', 2.0)
+# Máximo de cambios que se reenvían en una resincronización incremental;
+# con un hueco mayor se envía la estructura completa.
+MAX_CAMBIOS_RESINCRONIZACION = getattr(settings, 'COLABORACION_MAX_CAMBIOS_RESINCRONIZACION', 500)
+# Cada cuántas revisiones se guarda una InstantaneaDiagrama (0 desactiva)
+INSTANTANEA_CADA = getattr(settings, 'COLABORACION_INSTANTANEA_CADA', 200)
+# Escrituras que se intentan si otro escritor cambia la fila entre una y otra
+REINTENTOS_PERSISTENCIA = 3
+
+
+def aplicar_cambio_en_modelo(modelo, cambio):
+    """
+    Aplica un cambio sobre un DiagramaIndexado en memoria, sin tocar la BD.
+
+    Returns:
+        bool: True si el diagrama se modificó
+    """
+    if not ServicioSincronizacion.aplicar_en_modelo(modelo, cambio):
+        logger.debug(f"Cambio sin efecto: {cambio.get('tipo')} {(cambio.get('datos') or {}).get('id')}")
+        return False
+    modelo.extras['ultima_modificacion'] = timezone.now().isoformat()
+    return True
+
+
+class SalaEnOtroProceso(Exception):
+    """Otro worker tiene la sala del diagrama en memoria."""
+
+
+class EstadoDiagrama:
+    """
+    Estado autoritativo en memoria de un diagrama con una sala abierta.
+
+    Los cambios se aplican sobre `modelo` (indexado por id) y se marcan como
+    pendientes; la escritura en BD se agrupa en una sola cada `intervalo`
+    segundos. La estructura guarda su revisión en la clave `revision`, y
+    cada `cada_instantanea` revisiones se registra una instantánea.
+
+    La escritura está condicionada a `version`: si otro escritor (API REST)
+    cambió la fila, los cambios aún no persistidos se rehacen sobre lo que
+    dejó y, si el contenido difiere, la revisión avanza sin cambio asociado
+    (`revision_minima`) y `generacion` aumenta para que las conexiones
+    reenvíen la estructura completa.
+    """
+
+    def __init__(self, diagrama_id, estructura, guardar, intervalo=INTERVALO_PERSISTENCIA, revision=0,
+                 guardar_instantanea=None, cada_instantanea=INSTANTANEA_CADA, version=0, leer=None):
+        self.diagrama_id = diagrama_id
+        self.modelo = DiagramaIndexado(estructura)
+        # Revisión del último cambio aplicado; crece de uno en uno
+        self.revision = revision
+        # Versión de la fila en BD sobre la que se escribe la próxima vez
+        self.version = version
+        # Revisión ya escrita en BD; si la estructura guardada va por detrás
+        # (recuperada del historial) sus cambios no están en memoria
+        guardada = self.modelo.extras.get('revision')
+        self.revision_persistida = min(guardada, revision) if isinstance(guardada, int) else revision
+        # Los clientes anteriores a esta revisión necesitan la estructura completa
+        self.revision_minima = 0
+        # Aumenta cada vez que el contenido se reemplaza desde fuera de la sala
+        self.generacion = 0
+        # Últimos cambios aplicados, para resincronizar sin ir a la BD
+        self.cambios_recientes = deque(maxlen=MAX_CAMBIOS_RESINCRONIZACION)
+        self.conexiones = 0
+        # Conexiones por formato negociado (json / msgpack)
+        self.formatos = Counter()
+        self.pendiente = False
+        self._guardar = guardar
+        self._leer = leer
+        self._intervalo = intervalo
+        self._tarea_persistencia = None
+        self._guardar_instantanea = guardar_instantanea
+        self._cada_instantanea = cada_instantanea
+        self._tarea_instantanea = None
+        self._lock_bd = asyncio.Lock()
+
+    @property
+    def estructura(self):
+        return self.modelo.a_estructura()
+
+    def formatos_activos(self):
+        """Formatos en los que hay que codificar una difusión a la sala."""
+        return [formato for formato, conexiones in self.formatos.items() if conexiones > 0]
+
+    def aplicar_cambio(self, cambio):
+        """
+        Aplica el cambio en memoria y programa la persistencia diferida.
+        Si el cambio tiene efecto se le asigna la siguiente revisión.
+
+        Returns:
+            bool: True si el cambio modificó el diagrama
+        """
+        modificado = aplicar_cambio_en_modelo(self.modelo, cambio)
+        if modificado:
+            self._avanzar_revision(cambio)
+            if self._guardar_instantanea and self._cada_instantanea and self.revision % self._cada_instantanea == 0:
+                self._tarea_instantanea = asyncio.ensure_future(self._registrar_instantanea(self.revision, self.estructura))
+        return modificado
+
+    def _avanzar_revision(self, cambio):
+        self.revision += 1
+        # Permite saber, al recargar, qué cambios registrados faltan en la estructura guardada
+        self.modelo.extras['revision'] = self.revision
+        self.cambios_recientes.append({'revision': self.revision, 'cambio': cambio})
+        self.pendiente = True
+        self._programar_persistencia()
+
+    def marcar_modificacion_externa(self):
+        """
+        El contenido cambió fuera de la sala con ella abierta: se le asigna
+        una revisión sin CambioDiagrama (no se reenvía por cambios), que se
+        registra como instantánea para que el historial no tenga huecos, y
+        se persiste para que esa revisión quede ligada a este contenido.
+        """
+        self._avanzar_revision(None)
+        self.revision_minima = self.revision
+        self.generacion += 1
+        if self._guardar_instantanea:
+            self._tarea_instantanea = asyncio.ensure_future(self._registrar_instantanea(self.revision, self.estructura))
+        logger.info(f"🔄 Diagrama {self.diagrama_id} modificado fuera de la sala (revisión {self.revision})")
+
+    async def _registrar_instantanea(self, revision, estructura):
+        try:
+            await self._guardar_instantanea(self.diagrama_id, revision, estructura)
+            logger.info(f"📸 Instantánea del diagrama {self.diagrama_id} en la revisión {revision}")
+        except Exception as e:
+            logger.exception(f"Error guardando instantánea del diagrama {self.diagrama_id}: {e}")
+
+    def _registrados_desde(self, revision):
+        if revision >= self.revision:
+            return []
+        if not self.cambios_recientes or self.cambios_recientes[0]['revision'] > revision + 1:
+            return None
+        inicio = revision + 1 - self.cambios_recientes[0]['revision']
+        return list(self.cambios_recientes)[inicio:]
+
+    def cambios_desde(self, revision):
+        """
+        Cambios posteriores a `revision` guardados en memoria, o None si
+        no cubren todo el hueco (hay que consultar la BD) o el cliente es
+        anterior a una modificación externa.
+        """
+        if revision < self.revision_minima:
+            return None
+        return self._registrados_desde(revision)
+
+    def _programar_persistencia(self):
+        if self._tarea_persistencia is None or self._tarea_persistencia.done():
+            self._tarea_persistencia = asyncio.ensure_future(self._persistir_diferido())
+
+    async def _persistir_diferido(self):
+        await asyncio.sleep(self._intervalo)
+        await self.persistir()
+
+    async def persistir(self):
+        """
+        Escribe la estructura en BD si hay cambios pendientes.
+
+        `a_estructura()` es una instantánea, así que los cambios que lleguen
+        mientras el hilo de BD serializa el JSON no alteran lo que se escribe.
+        Si la versión de la fila ya no es la de la sala, se rehace el trabajo
+        pendiente sobre la estructura actual y se reintenta.
+        """
+        async with self._lock_bd:
+            for _ in range(REINTENTOS_PERSISTENCIA):
+                if not self.pendiente:
+                    return False
+                self.pendiente = False
+                revision = self.revision
+                instantanea = self.estructura
+                # Permite reconocer al cargar una estructura escrita fuera de la sala
+                instantanea['version'] = self.version + 1
+                try:
+                    guardado = await self._guardar(self.diagrama_id, instantanea, self.version)
+                except Exception as e:
+                    self.pendiente = True
+                    logger.exception(f"Error persistiendo diagrama {self.diagrama_id}: {e}")
+                    return False
+                if guardado:
+                    self.version += 1
+                    self.revision_persistida = revision
+                    logger.info(f"💾 Diagrama {self.diagrama_id} persistido desde memoria")
+                    return True
+                self.pendiente = True
+                if not await self._rebasar():
+                    return False
+            logger.warning(f"⚠️ Diagrama {self.diagrama_id}: la versión en BD cambió en cada reintento")
+            return False
+
+    async def recargar(self, version):
+        """Adopta una escritura hecha fuera de la sala que dejó la fila en `version`."""
+        async with self._lock_bd:
+            if self.version >= version:
+                return
+            await self._rebasar()
+
+    async def _rebasar(self):
+        """
+        Rehace los cambios no persistidos sobre la estructura guardada por
+        otro escritor. Devuelve False si no se puede escribir (sin lector o
+        diagrama eliminado).
+        """
+        if self._leer is None:
+            logger.error(f"Diagrama {self.diagrama_id}: versión en BD distinta y sin forma de releerla")
+            return False
+        leida = await self._leer(self.diagrama_id)
+        if leida is None:
+            self.pendiente = False
+            logger.warning(f"⚠️ Diagrama {self.diagrama_id} eliminado con la sala abierta")
+            return False
+        estructura, version = leida
+        self.version = version
+
+        pendientes = self._registrados_desde(self.revision_persistida)
+        if pendientes is None:
+            # Los cambios sin persistir ya no están todos en memoria: se conservan
+            # los de la sala y se pierde la escritura externa
+            logger.error(f"Diagrama {self.diagrama_id}: no se pudo rehacer la sala sobre la escritura externa")
+            self.pendiente = True
+            self._programar_persistencia()
+            return True
+
+        modelo = DiagramaIndexado(estructura)
+        for registrado in pendientes:
+            if registrado['cambio'] is not None:
+                aplicar_cambio_en_modelo(modelo, registrado['cambio'])
+        actual = self.estructura
+        rebasada = modelo.a_estructura()
+        if (rebasada['nodos'], rebasada['relaciones']) == (actual['nodos'], actual['relaciones']):
+            return True
+        self.modelo = modelo
+        self.marcar_modificacion_externa()
+        return True
+
+    async def cerrar(self):
+        """Escribe lo pendiente y cancela la persistencia programada."""
+        await self.persistir()
+        tarea = self._tarea_persistencia
+        self._tarea_persistencia = None
+        if tarea is not None and not tarea.done():
+            tarea.cancel()
+
+
+class RegistroEstadosDiagrama:
+    """
+    Registro por proceso de los diagramas con al menos una conexión abierta.
+
+    El primer consumer que se conecta carga la estructura desde BD; el
+    último en desconectarse escribe lo pendiente y libera la memoria.
+    Cada sala vive en un único proceso: con varios workers la propiedad se
+    reclama en `salas` y las conexiones que lleguen a otro worker se
+    rechazan con SalaEnOtroProceso (el balanceador debe enrutar por diagrama).
+    """
+
+    def __init__(self, cargar=None, guardar=None, intervalo=INTERVALO_PERSISTENCIA, guardar_instantanea=None,
+                 leer=None, salas=None):
+        self._estados = {}
+        self._cargar = cargar
+        self._guardar = guardar
+        self._leer = leer
+        self._guardar_instantanea = guardar_instantanea
+        self._intervalo = intervalo
+        self._salas = salas or presencia
+        # clave -> [lock, tareas que lo usan o esperan]; se borra al quedar sin uso
+        self._locks = {}
+
+    def _funciones_bd(self):
+        if self._cargar is None or self._guardar is None:
+            # Import diferido: diagrama_db depende de los modelos
+            from colaboracion_tiempo_real.diagrama_db import (
+                cargar_estado_diagrama,
+                guardar_estructura_diagrama,
+                guardar_instantanea_diagrama,
+                leer_estructura_diagrama,
+            )
+            self._cargar = self._cargar or cargar_estado_diagrama
+            self._guardar = self._guardar or guardar_estructura_diagrama
+            self._leer = self._leer or leer_estructura_diagrama
+            self._guardar_instantanea = self._guardar_instantanea or guardar_instantanea_diagrama
+        return self._cargar, self._guardar
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, clave):
+        entrada = self._locks.setdefault(clave, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self._locks[clave]
+
+    def obtener(self, diagrama_id):
+        return self._estados.get(str(diagrama_id))
+
+    async def adquirir(self, diagrama_id):
+        """
+        Devuelve el estado del diagrama, cargándolo si es la primera conexión.
+
+        Raises:
+            SalaEnOtroProceso: la sala está abierta en otro worker
+        """
+        clave = str(diagrama_id)
+        async with self._lock(clave):
+            estado = self._estados.get(clave)
+            if estado is None:
+                if not await self._salas.tomar_sala(clave):
+                    raise SalaEnOtroProceso(diagrama_id)
+                try:
+                    estado = await self._cargar_estado(diagrama_id)
+                except Exception:
+                    await self._salas.soltar_sala(clave)
+                    raise
+                self._estados[clave] = estado
+            estado.conexiones += 1
+            return estado
+
+    async def _cargar_estado(self, diagrama_id):
+        cargar, guardar = self._funciones_bd()
+        estructura, revision, version = await cargar(diagrama_id)
+        estado = EstadoDiagrama(
+            diagrama_id, estructura, guardar, self._intervalo, revision,
+            guardar_instantanea=self._guardar_instantanea, version=version, leer=self._leer,
+        )
+        externa = estructura.get('version') != version
+        if externa:
+            # Creada o escrita por la API REST desde la última escritura de la
+            # sala: no se gasta una revisión, este contenido pasa a ser el de la
+            # revisión de partida y quien ya la tenía recibe la estructura completa
+            estado.modelo.extras['revision'] = revision
+            estado.revision_minima = revision + 1
+        if self._guardar_instantanea:
+            # Punto de partida del historial para las revisiones que genere la sala
+            await self._guardar_instantanea(diagrama_id, revision, estado.estructura, reemplazar=externa)
+        return estado
+
+    async def liberar(self, diagrama_id):
+        """Resta una conexión; con la última se persiste y se descarta el estado."""
+        clave = str(diagrama_id)
+        async with self._lock(clave):
+            estado = self._estados.get(clave)
+            if estado is None:
+                return
+            estado.conexiones -= 1
+            if estado.conexiones > 0:
+                return
+            await estado.cerrar()
+            del self._estados[clave]
+            await self._salas.soltar_sala(clave)
+
+
+registro_estados = RegistroEstadosDiagrama()
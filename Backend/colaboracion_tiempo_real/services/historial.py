@@ -0,0 +1,195 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from proyecto.models import DiagramaClase
+from ..models import CambioDiagrama, InstantaneaDiagrama, SesionColaborativa
+from .diagrama_indexado import DiagramaIndexado
+from .sincronizacion import ServicioSincronizacion
+
+logger = logging.getLogger(__name__)
+
+RETENCION_DIAS = getattr(settings, 'COLABORACION_HISTORIAL_RETENCION_DIAS', 30)
+TAMANO_LOTE = getattr(settings, 'COLABORACION_HISTORIAL_LOTE', 1000)
+
+# Columnas que se guardan al archivar un cambio antes de borrarlo
+CAMPOS_ARCHIVO = ('id', 'sesion__diagrama_id', 'usuario_id', 'tipo_cambio', 'datos_cambio', 'timestamp', 'revision')
+
+
+class HistorialIncompleto(Exception):
+    """No hay instantánea o faltan cambios para llegar a la revisión pedida."""
+
+
+def reproducir_cambios(estructura, cambios):
+    """
+    Aplica `cambios` (en orden de revisión) sobre `estructura` con las mismas
+    operaciones que el estado en memoria. No modifica `estructura`.
+    """
+    modelo = DiagramaIndexado(estructura)
+    for cambio in cambios:
+        ServicioSincronizacion.aplicar_en_modelo(modelo, cambio)
+    return modelo.a_estructura()
+
+
+def ultima_revision(diagrama_id):
+    """Última revisión registrada, en CambioDiagrama o (si se compactó) en una instantánea."""
+    cambios = CambioDiagrama.objects.filter(sesion__diagrama_id=diagrama_id).aggregate(ultima=Max('revision'))
+    instantaneas = InstantaneaDiagrama.objects.filter(diagrama_id=diagrama_id).aggregate(ultima=Max('revision'))
+    return max(cambios['ultima'] or 0, instantaneas['ultima'] or 0)
+
+
+def reconstruir_diagrama(diagrama_id, revision=None, base=None):
+    """
+    Estructura del diagrama en `revision` (la última si es None): parte de la
+    instantánea anterior más cercana, o de `base` = (estructura, revisión) si
+    está más cerca, y reproduce sólo los cambios posteriores.
+
+    Returns:
+        tuple: (estructura, revision)
+
+    Raises:
+        HistorialIncompleto: sin punto de partida o con cambios ausentes
+    """
+    if revision is None:
+        revision = ultima_revision(diagrama_id)
+    instantanea = (
+        InstantaneaDiagrama.objects.filter(diagrama_id=diagrama_id, revision__lte=revision)
+        .order_by('-revision').values_list('estructura', 'revision').first()
+    )
+    candidatos = [c for c in (instantanea, base) if c is not None and c[1] <= revision]
+    if not candidatos:
+        raise HistorialIncompleto(f'Sin instantánea del diagrama {diagrama_id} anterior a la revisión {revision}')
+    estructura, desde = max(candidatos, key=lambda candidato: candidato[1])
+    if desde == revision:
+        return estructura, revision
+
+    cambios = list(
+        CambioDiagrama.objects.filter(
+            sesion__diagrama_id=diagrama_id, revision__gt=desde, revision__lte=revision
+        ).order_by('revision').values_list('datos_cambio', flat=True)
+    )
+    if len(cambios) != revision - desde:
+        raise HistorialIncompleto(f'Faltan cambios del diagrama {diagrama_id} entre {desde} y {revision}')
+    return {**reproducir_cambios(estructura, cambios), 'revision': revision}, revision
+
+
+class CompactadorHistorial:
+    """
+    Resume en InstantaneaDiagrama los CambioDiagrama con más de
+    `retencion_dias` y los borra (o los entrega a `archivar` antes).
+
+    Cada diagrama se procesa por separado y los borrados van en lotes de
+    `lote` filas, cada uno en su propia transacción, para no mantener
+    bloqueos largos sobre la tabla.
+
+    La instantánea de la última revisión antigua se obtiene reproduciendo
+    los cambios sobre la instantánea anterior. Si no hay ninguna, sólo se
+    puede tomar la estructura guardada, y únicamente cuando todo el
+    historial es antiguo y no hay sala abierta (la estructura corresponde
+    entonces a la última revisión); si no, los cambios se conservan.
+    """
+
+    def __init__(self, retencion_dias=RETENCION_DIAS, lote=TAMANO_LOTE, pausa=0, archivar=None):
+        self.retencion = timedelta(days=retencion_dias)
+        self.lote = lote
+        self.pausa = pausa
+        # archivar: callable que recibe una lista de dicts (CAMPOS_ARCHIVO) antes de borrarlos
+        self.archivar = archivar
+
+    def ejecutar(self, max_diagramas=None):
+        """
+        Returns:
+            dict: diagramas procesados, instantáneas creadas y cambios eliminados
+        """
+        limite = timezone.now() - self.retencion
+        diagrama_ids = (
+            CambioDiagrama.objects.filter(timestamp__lt=limite)
+            .order_by('sesion__diagrama_id')
+            .values_list('sesion__diagrama_id', flat=True)
+            .distinct()
+        )
+        if max_diagramas:
+            diagrama_ids = diagrama_ids[:max_diagramas]
+
+        resumen = {'diagramas': 0, 'instantaneas': 0, 'eliminados': 0}
+        for diagrama_id in list(diagrama_ids):
+            creada, eliminados = self.compactar_diagrama(diagrama_id, limite)
+            resumen['diagramas'] += 1
+            resumen['instantaneas'] += int(creada)
+            resumen['eliminados'] += eliminados
+        return resumen
+
+    def compactar_diagrama(self, diagrama_id, limite):
+        """Returns: (bool instantánea creada, cambios eliminados)"""
+        cambios = CambioDiagrama.objects.filter(sesion__diagrama_id=diagrama_id)
+        antiguos = cambios.filter(timestamp__lt=limite)
+        ultima_antigua = antiguos.aggregate(ultima=Max('revision'))['ultima']
+
+        creada = False
+        plegada = None
+        if ultima_antigua is not None:
+            plegada, creada = self._instantanea_hasta(diagrama_id, ultima_antigua, cambios)
+
+        # Se borran los cambios antiguos ya contenidos en una instantánea y los
+        # que no tienen revisión (anteriores a la numeración, no reproducibles)
+        condicion = Q(revision__isnull=True)
+        if plegada is not None:
+            condicion |= Q(revision__lte=plegada)
+        eliminados = self._eliminar_en_lotes(antiguos.filter(condicion))
+        if eliminados:
+            logger.info(f"🗜️ Diagrama {diagrama_id}: {eliminados} cambios compactados (revisión {plegada})")
+        return creada, eliminados
+
+    def _instantanea_hasta(self, diagrama_id, revision, cambios):
+        """
+        Asegura una instantánea en `revision`. Devuelve (revisión de la
+        instantánea utilizable o None, bool creada).
+        """
+        anterior = (
+            InstantaneaDiagrama.objects.filter(diagrama_id=diagrama_id, revision__lte=revision)
+            .order_by('-revision').values_list('revision', flat=True).first()
+        )
+        if anterior == revision:
+            return revision, False
+
+        if anterior is not None:
+            try:
+                estructura, _ = reconstruir_diagrama(diagrama_id, revision)
+            except HistorialIncompleto as e:
+                logger.warning(f"⚠️ {e}; se conservan")
+                return anterior, False
+        else:
+            sala_abierta = SesionColaborativa.objects.filter(diagrama_id=diagrama_id, activa=True).exists()
+            if sala_abierta or cambios.filter(revision__gt=revision).exists():
+                return None, False
+            try:
+                estructura = DiagramaClase.objects.values_list('estructura', flat=True).get(id=diagrama_id)
+            except DiagramaClase.DoesNotExist:
+                return None, False
+            estructura = estructura or {'nodos': [], 'relaciones': []}
+
+        InstantaneaDiagrama.objects.get_or_create(
+            diagrama_id=diagrama_id, revision=revision, defaults={'estructura': estructura}
+        )
+        return revision, True
+
+    def _eliminar_en_lotes(self, queryset):
+        total = 0
+        while True:
+            ids = list(queryset.order_by('id').values_list('id', flat=True)[:self.lote])
+            if not ids:
+                return total
+            with transaction.atomic():
+                if self.archivar is not None:
+                    self.archivar(list(
+                        CambioDiagrama.objects.filter(id__in=ids).order_by('id').values(*CAMPOS_ARCHIVO)
+                    ))
+                CambioDiagrama.objects.filter(id__in=ids).delete()
+            total += len(ids)
+            if self.pausa:
+                time.sleep(self.pausa)
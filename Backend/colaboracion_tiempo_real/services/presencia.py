@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Segundos sin latido tras los que una conexión deja de contar como presente.
+# El cliente envía 'ping' cada 30 s, así que se toleran dos latidos perdidos.
+TTL_PRESENCIA = getattr(settings, 'COLABORACION_PRESENCIA_TTL', 90)
+
+# Identifica a este worker como dueño de las salas que tiene en memoria
+PROCESO = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _unicos_por_usuario(infos):
+    """Un usuario con varias pestañas abiertas aparece una sola vez."""
+    usuarios = {}
+    for info in infos:
+        usuarios.setdefault(info.get('id'), info)
+    return list(usuarios.values())
+
+
+def info_usuario(usuario, fecha_conexion):
+    """Datos de presencia que se envían a los clientes en `usuarios_conectados`."""
+    return {
+        'id': usuario.id,
+        'nombre': f"{usuario.nombre} {usuario.apellido}",
+        'correo': usuario.correo_electronico,
+        'fecha_conexion': fecha_conexion.isoformat(),
+    }
+
+
+class PresenciaMemoria:
+    """
+    Presencia por proceso: diagrama -> {canal: (info, expira)}.
+
+    Válida con un solo worker ASGI (InMemoryChannelLayer); las conexiones
+    sin latido durante `ttl` segundos se descartan al leer.
+    """
+
+    def __init__(self, ttl=TTL_PRESENCIA, reloj=time.monotonic):
+        self._ttl = ttl
+        self._reloj = reloj
+        self._salas = {}
+
+    async def registrar(self, diagrama_id, canal, info):
+        self._salas.setdefault(str(diagrama_id), {})[canal] = (info, self._reloj() + self._ttl)
+
+    async def latido(self, diagrama_id, canal):
+        sala = self._salas.get(str(diagrama_id), {})
+        if canal in sala:
+            sala[canal] = (sala[canal][0], self._reloj() + self._ttl)
+
+    async def eliminar(self, diagrama_id, canal):
+        clave = str(diagrama_id)
+        sala = self._salas.get(clave)
+        if sala is not None:
+            sala.pop(canal, None)
+            if not sala:
+                del self._salas[clave]
+
+    async def usuarios(self, diagrama_id):
+        clave = str(diagrama_id)
+        sala = self._salas.get(clave)
+        if not sala:
+            return []
+        ahora = self._reloj()
+        for canal in [c for c, (_, expira) in sala.items() if expira <= ahora]:
+            del sala[canal]
+        if not sala:
+            del self._salas[clave]
+        return _unicos_por_usuario(info for info, _ in sala.values())
+
+    # Con un solo proceso todas las salas son suyas
+    async def tomar_sala(self, diagrama_id):
+        return True
+
+    async def renovar_sala(self, diagrama_id):
+        return True
+
+    async def soltar_sala(self, diagrama_id):
+        pass
+
+
+class PresenciaRedis:
+    """
+    Presencia compartida entre workers en Redis, por diagrama:
+
+    - `presencia:diagrama:<id>`: sorted set canal -> instante de expiración
+    - `presencia:diagrama:<id>:info`: hash canal -> JSON con los datos del usuario
+
+    - `sala:diagrama:<id>:proceso`: worker que tiene la sala en memoria
+
+    Cada latido mueve la expiración del canal; al leer se descartan los
+    vencidos, así que las conexiones de un worker caído desaparecen solas.
+    Las claves completas también expiran si nadie las renueva.
+    """
+
+    def __init__(self, cliente=None, url=None, ttl=TTL_PRESENCIA, reloj=time.time):
+        self._cliente = cliente
+        self._url = url or getattr(settings, 'REDIS_URL', None)
+        self._ttl = ttl
+        self._reloj = reloj
+
+    def _redis(self):
+        if self._cliente is None:
+            # Import diferido: redis sólo es necesario con este backend
+            import redis.asyncio as redis
+            self._cliente = redis.from_url(self._url, decode_responses=True)
+        return self._cliente
+
+    @staticmethod
+    def _claves(diagrama_id):
+        clave = f'presencia:diagrama:{diagrama_id}'
+        return clave, f'{clave}:info'
+
+    async def registrar(self, diagrama_id, canal, info):
+        clave, clave_info = self._claves(diagrama_id)
+        async with self._redis().pipeline(transaction=False) as pipe:
+            pipe.zadd(clave, {canal: self._reloj() + self._ttl})
+            pipe.hset(clave_info, canal, json.dumps(info))
+            pipe.expire(clave, self._ttl)
+            pipe.expire(clave_info, self._ttl)
+            await pipe.execute()
+
+    async def latido(self, diagrama_id, canal):
+        clave, clave_info = self._claves(diagrama_id)
+        async with self._redis().pipeline(transaction=False) as pipe:
+            pipe.zadd(clave, {canal: self._reloj() + self._ttl}, xx=True)
+            pipe.expire(clave, self._ttl)
+            pipe.expire(clave_info, self._ttl)
+            await pipe.execute()
+
+    async def eliminar(self, diagrama_id, canal):
+        clave, clave_info = self._claves(diagrama_id)
+        async with self._redis().pipeline(transaction=False) as pipe:
+            pipe.zrem(clave, canal)
+            pipe.hdel(clave_info, canal)
+            await pipe.execute()
+
+    async def usuarios(self, diagrama_id):
+        clave, clave_info = self._claves(diagrama_id)
+        ahora = self._reloj()
+        async with self._redis().pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(clave, '-inf', ahora)
+            pipe.zrangebyscore(clave, f'({ahora}', '+inf')
+            vencidos, vigentes = await pipe.execute()
+        redis = self._redis()
+        if vencidos:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.zrem(clave, *vencidos)
+                pipe.hdel(clave_info, *vencidos)
+                await pipe.execute()
+        if not vigentes:
+            return []
+        infos = await redis.hmget(clave_info, vigentes)
+        return _unicos_por_usuario(json.loads(info) for info in infos if info)
+
+    # ========== PROPIEDAD DE LAS SALAS ==========
+
+    # El estado de una sala vive en la memoria de un único worker: el
+    # primero que la abre la reclama y los demás rechazan sus conexiones
+    # hasta que la suelte o deje de renovarla durante `ttl` segundos.
+
+    @staticmethod
+    def _clave_sala(diagrama_id):
+        return f'sala:diagrama:{diagrama_id}:proceso'
+
+    async def tomar_sala(self, diagrama_id):
+        """True si este proceso queda como dueño de la sala."""
+        clave = self._clave_sala(diagrama_id)
+        redis = self._redis()
+        if await redis.set(clave, PROCESO, nx=True, ex=self._ttl):
+            return True
+        return await self.renovar_sala(diagrama_id)
+
+    async def renovar_sala(self, diagrama_id):
+        clave = self._clave_sala(diagrama_id)
+        redis = self._redis()
+        if await redis.get(clave) != PROCESO:
+            return False
+        await redis.expire(clave, self._ttl)
+        return True
+
+    async def soltar_sala(self, diagrama_id):
+        clave = self._clave_sala(diagrama_id)
+        redis = self._redis()
+        if await redis.get(clave) == PROCESO:
+            await redis.delete(clave)
+
+
+def crear_presencia():
+    """
+    Backend según COLABORACION_PRESENCIA_BACKEND ('memoria' o 'redis');
+    por defecto Redis si hay REDIS_URL, igual que el channel layer.
+    """
+    backend = getattr(settings, 'COLABORACION_PRESENCIA_BACKEND', None)
+    if backend is None:
+        backend = 'redis' if getattr(settings, 'REDIS_URL', None) else 'memoria'
+    if backend == 'redis':
+        return PresenciaRedis()
+    return PresenciaMemoria()
+
+
+presencia = crear_presencia()
@@ -1,3 +1,747 @@
-from django.test import TestCase
+import asyncio
+import importlib.util
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models import Exists, F, OuterRef
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from proyecto.models import Proyecto, DiagramaClase, Invitation
+
+from colaboracion_tiempo_real import metricas
+from colaboracion_tiempo_real.consumers import CODIGO_SALA_EN_OTRO_PROCESO, es_movimiento_nodo
+from colaboracion_tiempo_real.diagrama_db import (
+    cargar_estado_diagrama,
+    insertar_cambios_diagrama,
+    obtener_cambios_desde,
+    obtener_timestamp_actual,
+    volcar_actividad_conexiones,
+)
+from colaboracion_tiempo_real.models import CambioDiagrama, ConexionUsuario, InstantaneaDiagrama, SesionColaborativa
+from colaboracion_tiempo_real.protocolo import FORMATO_MSGPACK, codificar, codificar_difusion, decodificar, negociar_formato
+from colaboracion_tiempo_real.routing import websocket_urlpatterns
+from colaboracion_tiempo_real.services.actividad_conexiones import RegistroActividad
+from colaboracion_tiempo_real.services.cola_salida import ColaSalida
+from colaboracion_tiempo_real.services.diagrama_indexado import DiagramaIndexado
+from colaboracion_tiempo_real.services.escritor_cambios import EscritorCambios
+from colaboracion_tiempo_real.services.estado_diagrama import EstadoDiagrama, RegistroEstadosDiagrama, registro_estados
+from colaboracion_tiempo_real.services.historial import CompactadorHistorial, HistorialIncompleto, reconstruir_diagrama
+from colaboracion_tiempo_real.services.presencia import PresenciaMemoria, PresenciaRedis
+from colaboracion_tiempo_real.services.sincronizacion import ServicioSincronizacion
+
+User = get_user_model()
+
+
+class RegistroEstadosDiagramaTest(SimpleTestCase):
+    def setUp(self):
+        self.guardados = []
+        self.cargas = 0
+
+        async def cargar(diagrama_id):
+            self.cargas += 1
+            return {'nodos': [], 'relaciones': [], 'version': 3}, 7, 3
+
+        async def guardar(diagrama_id, estructura, version):
+            self.guardados.append((diagrama_id, estructura))
+            return True
+
+        # intervalo amplio: la persistencia sólo ocurre al liberar
+        self.registro = RegistroEstadosDiagrama(cargar=cargar, guardar=guardar, intervalo=60)
+
+    async def test_conexiones_comparten_estado_y_cargan_una_vez(self):
+        estado_a = await self.registro.adquirir(1)
+        estado_b = await self.registro.adquirir('1')
+        self.assertIs(estado_a, estado_b)
+        self.assertEqual(self.cargas, 1)
+        self.assertEqual(estado_a.conexiones, 2)
+
+    async def test_revision_continua_desde_la_ultima_registrada(self):
+        estado = await self.registro.adquirir(1)
+        estado.aplicar_cambio({'tipo': 'crear_nodo', 'datos': {'id': 'a'}})
+        estado.aplicar_cambio({'tipo': 'crear_nodo', 'datos': {'id': 'a'}})
+        estado.aplicar_cambio({'tipo': 'eliminar_nodo', 'datos': {'id': 'a'}})
+        self.assertEqual(estado.revision, 9)
+
+    async def test_cambios_se_persisten_una_vez_al_liberar_la_ultima_conexion(self):
+        estado = await self.registro.adquirir(1)
+        await self.registro.adquirir(1)
+        for i in range(10):
+            estado.aplicar_cambio({'tipo': 'crear_nodo', 'datos': {'id': f'n{i}'}})
+
+        await self.registro.liberar(1)
+        self.assertEqual(self.guardados, [])
+
+        await self.registro.liberar(1)
+        self.assertEqual(len(self.guardados), 1)
+        self.assertEqual(len(self.guardados[0][1]['nodos']), 10)
+        self.assertIsNone(self.registro.obtener(1))
+
+    async def test_los_locks_de_salas_cerradas_no_se_acumulan(self):
+        await asyncio.gather(*(self.registro.adquirir(i % 3) for i in range(9)))
+        self.assertEqual(self.registro._locks, {})
+        await asyncio.gather(*(self.registro.liberar(i % 3) for i in range(9)))
+        self.assertEqual((self.registro._locks, self.registro._estados), ({}, {}))
+
+    async def test_sin_cambios_no_escribe(self):
+        await self.registro.adquirir(1)
+        await self.registro.liberar(1)
+        self.assertEqual(self.guardados, [])
+
+
+class DiagramaIndexadoTest(SimpleTestCase):
+    def setUp(self):
+        self.modelo = DiagramaIndexado({
+            'nodos': [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}],
+            'relaciones': [
+                {'id': 'r1', 'source': 'a', 'target': 'b'},
+                {'id': 'r2', 'source': 'b', 'target': 'c'},
+            ],
+            'ultima_modificacion': 'x',
+        })
+
+    def test_serializa_en_el_formato_original(self):
+        estructura = self.modelo.a_estructura()
+        self.assertEqual([n['id'] for n in estructura['nodos']], ['a', 'b', 'c'])
+        self.assertEqual([r['id'] for r in estructura['relaciones']], ['r1', 'r2'])
+        self.assertEqual(estructura['ultima_modificacion'], 'x')
+
+    def test_crear_duplicado_no_modifica(self):
+        self.assertFalse(self.modelo.crear_nodo({'id': 'a', 'nombre': 'otro'}))
+        self.assertFalse(self.modelo.crear_relacion({'id': 'r1'}))
+        self.assertNotIn('nombre', self.modelo.nodos['a'])
+
+    def test_actualizar_nodo_conserva_posicion_y_mezcla_datos(self):
+        self.assertTrue(self.modelo.actualizar_nodo({'id': 'b', 'position': {'x': 1, 'y': 2}}))
+        nodos = self.modelo.a_estructura()['nodos']
+        self.assertEqual(nodos[1], {'id': 'b', 'position': {'x': 1, 'y': 2}})
+        self.assertFalse(self.modelo.actualizar_nodo({'id': 'z'}))
+
+    def test_eliminar_nodo_elimina_relaciones_incidentes(self):
+        self.assertTrue(self.modelo.eliminar_nodo({'id': 'b'}))
+        self.assertEqual(self.modelo.a_estructura()['relaciones'], [])
+        self.assertEqual(self.modelo.relaciones_de_nodo('a'), frozenset())
+        self.assertEqual(self.modelo.relaciones_de_nodo('c'), frozenset())
+
+    def test_actualizar_relacion_reindexa_extremos(self):
+        self.modelo.actualizar_relacion({'id': 'r1', 'target': 'c'})
+        self.assertEqual(self.modelo.relaciones_de_nodo('b'), frozenset({'r2'}))
+        self.assertEqual(self.modelo.relaciones_de_nodo('c'), frozenset({'r1', 'r2'}))
+        self.modelo.eliminar_nodo({'id': 'c'})
+        self.assertEqual(self.modelo.relaciones, {})
+
+
+class ServicioSincronizacionTest(SimpleTestCase):
+    def test_todos_los_tipos_de_cambio_tienen_operacion(self):
+        tipos = {tipo for tipo, _ in CambioDiagrama.TIPOS_CAMBIO}
+        self.assertEqual(set(ServicioSincronizacion.OPERACIONES), tipos)
+
+    def test_aplica_cada_tipo_y_descarta_los_que_no_tienen_efecto(self):
+        modelo = DiagramaIndexado()
+        aplicar = ServicioSincronizacion.aplicar_en_modelo
+        self.assertTrue(aplicar(modelo, {'tipo': 'crear_nodo', 'datos': {'id': 'a'}}))
+        self.assertTrue(aplicar(modelo, {'tipo': 'crear_nodo', 'datos': {'id': 'b'}}))
+        self.assertTrue(aplicar(modelo, {'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'nombre': 'A'}}))
+        self.assertTrue(aplicar(modelo, {'tipo': 'crear_relacion', 'datos': {'id': 'r', 'source': 'a', 'target': 'b'}}))
+        self.assertTrue(aplicar(modelo, {'tipo': 'actualizar_relacion', 'datos': {'id': 'r', 'tipo': 'herencia'}}))
+        self.assertTrue(aplicar(modelo, {'tipo': 'eliminar_relacion', 'datos': {'id': 'r'}}))
+        self.assertTrue(aplicar(modelo, {'tipo': 'eliminar_nodo', 'datos': {'id': 'b'}}))
+
+        self.assertFalse(aplicar(modelo, {'tipo': 'crear_nodo', 'datos': {'id': 'a'}}))
+        self.assertFalse(aplicar(modelo, {'tipo': 'eliminar_nodo', 'datos': {'id': 'b'}}))
+        self.assertFalse(aplicar(modelo, {'tipo': 'batch_cambios', 'datos': []}))
+        self.assertFalse(aplicar(modelo, {'tipo': 'actualizar_nodo', 'datos': 'a'}))
+        self.assertEqual(modelo.a_estructura()['nodos'], [{'id': 'a', 'nombre': 'A'}])
+
+    def test_cambios_desde_devuelve_solo_el_hueco_en_memoria(self):
+        async def guardar(diagrama_id, estructura, version):
+            return True
+
+        estado = EstadoDiagrama(1, None, guardar, intervalo=60, revision=10)
+        self.assertIsNone(estado.cambios_desde(5))
+        with mock.patch.object(estado, '_programar_persistencia'):
+            for i in range(3):
+                estado.aplicar_cambio({'tipo': 'crear_nodo', 'datos': {'id': i}})
+        self.assertEqual([c['revision'] for c in estado.cambios_desde(11)], [12, 13])
+        self.assertEqual([c['revision'] for c in estado.cambios_desde(10)], [11, 12, 13])
+        self.assertEqual(estado.cambios_desde(13), [])
+        self.assertIsNone(estado.cambios_desde(9))
+
+    def test_solo_los_cambios_de_posicion_se_agrupan(self):
+        self.assertTrue(es_movimiento_nodo({'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'position': {'x': 1, 'y': 1}}}))
+        # Forma que envía el cliente (CreadorDeCambios.nodo.actualizar)
+        self.assertTrue(es_movimiento_nodo(
+            {'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'position': {'x': 1, 'y': 1}, 'timestamp': 1700000000000}}
+        ))
+        self.assertFalse(es_movimiento_nodo({'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'timestamp': 1700000000000}}))
+        self.assertFalse(es_movimiento_nodo({'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'nombre': 'A'}}))
+        self.assertFalse(es_movimiento_nodo({'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'position': {}, 'nombre': 'A'}}))
+        self.assertFalse(es_movimiento_nodo({'tipo': 'crear_nodo', 'datos': {'id': 'a', 'position': {}}}))
+
+    async def test_instantanea_cada_n_revisiones(self):
+        instantaneas = []
+
+        async def guardar(diagrama_id, estructura, version):
+            return True
+
+        async def guardar_instantanea(diagrama_id, revision, estructura):
+            instantaneas.append((revision, [n['id'] for n in estructura['nodos']], estructura['revision']))
+
+        estado = EstadoDiagrama(1, None, guardar, intervalo=60, guardar_instantanea=guardar_instantanea, cada_instantanea=2)
+        for i in range(5):
+            estado.aplicar_cambio({'tipo': 'crear_nodo', 'datos': {'id': i}})
+        await asyncio.sleep(0)
+        self.assertEqual(instantaneas, [(2, [0, 1], 2), (4, [0, 1, 2, 3], 4)])
+        await estado.cerrar()
+
+    async def test_cambio_sin_efecto_no_programa_persistencia(self):
+        guardados = []
+
+        async def guardar(diagrama_id, estructura, version):
+            guardados.append(estructura)
+            return True
+
+        estado = EstadoDiagrama(1, {'nodos': [{'id': 'a'}]}, guardar, intervalo=60)
+        self.assertFalse(estado.aplicar_cambio({'tipo': 'crear_nodo', 'datos': {'id': 'a'}}))
+        self.assertFalse(estado.pendiente)
+        await estado.cerrar()
+        self.assertEqual(guardados, [])
+
+
+class ProtocoloTest(SimpleTestCase):
+    def test_json_por_defecto(self):
+        self.assertEqual(negociar_formato({'subprotocols': [], 'query_string': b''}), ('json', None))
+        mensaje = {'tipo': 'cambio_recibido', 'cambio_id': 3}
+        self.assertEqual(decodificar(**codificar(mensaje)), mensaje)
+
+    @skipUnless(importlib.util.find_spec('msgpack'), 'msgpack no instalado')
+    def test_msgpack_negociado_con_claves_cortas(self):
+        self.assertEqual(
+            negociar_formato({'subprotocols': ['diagrama.msgpack']}), (FORMATO_MSGPACK, 'diagrama.msgpack')
+        )
+        self.assertEqual(negociar_formato({'query_string': b'formato=msgpack'}), (FORMATO_MSGPACK, None))
+        mensaje = {
+            'tipo': 'cambio_recibido', 'usuario_nombre': 'Ana', 'cambio_id': 3, 'revision': 3,
+            'cambio': {'tipo': 'crear_nodo', 'datos': {'id': 'n1', 'tipo': 'clase'}},
+        }
+        codificado = codificar(mensaje, FORMATO_MSGPACK)
+        self.assertEqual(decodificar(**codificado), {
+            't': 'cr', 'n': 'Ana', 'i': 3, 'r': 3, 'c': {'t': 'crear_nodo', 'd': {'id': 'n1', 'tipo': 'clase'}},
+        })
+        self.assertLess(len(codificado['bytes_data']), len(codificar(mensaje)['text_data']))
+
+        # Difusión: un frame por formato, idéntico al de la codificación individual
+        frames = codificar_difusion(mensaje)
+        self.assertEqual(frames, {'json': codificar(mensaje)['text_data'], FORMATO_MSGPACK: codificado['bytes_data']})
+        # Sólo los formatos de las conexiones de la sala
+        self.assertEqual(codificar_difusion(mensaje, ['json']), {'json': frames['json']})
+        self.assertEqual(codificar_difusion(mensaje, [FORMATO_MSGPACK]), {FORMATO_MSGPACK: frames[FORMATO_MSGPACK]})
+
+
+class ColaSalidaTest(SimpleTestCase):
+    def crear_cola(self, formato='json', **opciones):
+        enviados = []
+
+        async def enviar(frame):
+            enviados.append(frame)
+
+        return ColaSalida(enviar, formato, **opciones), enviados
+
+    async def test_agrupa_mensajes_en_un_lote(self):
+        cola, enviados = self.crear_cola(ventana=0.01)
+        mensajes = [{'tipo': 'cambio_recibido', 'cambio_id': i, 'usuario_nombre': 'Ñandú'} for i in range(3)]
+        for mensaje in mensajes:
+            cola.encolar(codificar_difusion(mensaje)['json'])
+        self.assertEqual(enviados, [])
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(enviados), 1)
+        self.assertEqual(decodificar(enviados[0]), {'tipo': 'lote', 'mensajes': mensajes})
+
+        # Un mensaje suelto no se envuelve; al llegar al máximo no se espera la ventana
+        cola.encolar(codificar_difusion(mensajes[0])['json'])
+        self.assertEqual(await cola.vaciar(), 1)
+        self.assertEqual(decodificar(enviados[1]), mensajes[0])
+        cola, enviados = self.crear_cola(ventana=10, maximo=2)
+        cola.encolar('{"tipo":"a"}')
+        cola.encolar('{"tipo":"b"}')
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(len(enviados), 1)
+
+    @skipUnless(importlib.util.find_spec('msgpack'), 'msgpack no instalado')
+    async def test_lote_msgpack(self):
+        cola, enviados = self.crear_cola(FORMATO_MSGPACK)
+        mensajes = [{'tipo': 'usuario_desconectado', 'usuario_id': i} for i in range(2)]
+        for mensaje in mensajes:
+            cola.encolar(codificar_difusion(mensaje)[FORMATO_MSGPACK])
+        await cola.vaciar()
+        self.assertEqual(decodificar(bytes_data=enviados[0]), {'tipo': 'lote', 'mensajes': mensajes})
+
+    async def test_cola_saturada_pide_resincronizar(self):
+        cola, enviados = self.crear_cola(ventana=10, limite=3)
+        for i in range(5):
+            cola.encolar(f'{{"tipo":"m","i":{i}}}')
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual([decodificar(f)['tipo'] for f in enviados], ['resincronizar'])
+
+        # Hasta que el cliente resincroniza no se le encola nada
+        cola.encolar('{"tipo":"m"}')
+        self.assertEqual(await cola.vaciar(), 0)
+        cola.reanudar()
+        cola.encolar('{"tipo":"m"}')
+        self.assertEqual(await cola.vaciar(), 1)
+        cola.cerrar()
+
+
+class PresenciaTestMixin:
+    """Mismos casos para cada backend; `crear_presencia(reloj)` lo define la subclase."""
+
+    def setUp(self):
+        self.ahora = 1000.0
+        self.presencia = self.crear_presencia(lambda: self.ahora)
+
+    async def test_usuario_con_varias_conexiones_aparece_una_vez(self):
+        await self.presencia.registrar(1, 'canal-a', {'id': 7, 'nombre': 'Ana'})
+        await self.presencia.registrar(1, 'canal-b', {'id': 7, 'nombre': 'Ana'})
+        await self.presencia.registrar(1, 'canal-c', {'id': 8, 'nombre': 'Beto'})
+        self.assertEqual(sorted(u['id'] for u in await self.presencia.usuarios(1)), [7, 8])
+        await self.presencia.eliminar(1, 'canal-a')
+        self.assertEqual(sorted(u['id'] for u in await self.presencia.usuarios(1)), [7, 8])
+        self.assertEqual(await self.presencia.usuarios(2), [])
+
+    async def test_conexiones_sin_latido_expiran(self):
+        await self.presencia.registrar(1, 'canal-a', {'id': 7})
+        await self.presencia.registrar(1, 'canal-b', {'id': 8})
+        self.ahora += 60
+        await self.presencia.latido(1, 'canal-a')
+        self.ahora += 60
+        self.assertEqual([u['id'] for u in await self.presencia.usuarios(1)], [7])
+
+
+class PresenciaMemoriaTest(PresenciaTestMixin, SimpleTestCase):
+    def crear_presencia(self, reloj):
+        return PresenciaMemoria(ttl=90, reloj=reloj)
+
+
+@skipUnless(importlib.util.find_spec('fakeredis'), 'fakeredis no instalado')
+class PresenciaRedisTest(PresenciaTestMixin, SimpleTestCase):
+    def crear_presencia(self, reloj):
+        from fakeredis import FakeAsyncRedis
+        return PresenciaRedis(cliente=FakeAsyncRedis(decode_responses=True), ttl=90, reloj=reloj)
+
+    async def test_la_sala_pertenece_a_un_solo_proceso(self):
+        self.assertTrue(await self.presencia.tomar_sala(1))
+        with mock.patch('colaboracion_tiempo_real.services.presencia.PROCESO', 'otro:1'):
+            self.assertFalse(await self.presencia.tomar_sala(1))
+            await self.presencia.soltar_sala(1)
+        self.assertTrue(await self.presencia.renovar_sala(1))
+        await self.presencia.soltar_sala(1)
+        with mock.patch('colaboracion_tiempo_real.services.presencia.PROCESO', 'otro:1'):
+            self.assertTrue(await self.presencia.tomar_sala(1))
+
+
+class EscritorCambiosTest(TestCase):
+    def setUp(self):
+        self.usuario = User.objects.create_user(username='u', correo_electronico='u@example.com', password='pass1234')
+        proyecto = Proyecto.objects.create(nombre='P', creador=self.usuario)
+        self.diagrama = DiagramaClase.objects.create(nombre='D', proyecto=proyecto)
+
+    async def test_inserta_en_lote_al_vaciar(self):
+        escritor = EscritorCambios(lote_maximo=1000, intervalo=60)
+        for revision in range(1, 6):
+            escritor.encolar(str(self.diagrama.id), revision, {'tipo': 'crear_nodo', 'datos': {'id': revision}}, self.usuario.id)
+        self.assertEqual(escritor.pendientes, 5)
+
+        self.assertEqual(await escritor.vaciar(), 5)
+        self.assertEqual(escritor.pendientes, 0)
+        revisiones = await database_sync_to_async(list)(
+            CambioDiagrama.objects.filter(sesion__diagrama=self.diagrama).order_by('revision').values_list('revision', flat=True)
+        )
+        self.assertEqual(revisiones, [1, 2, 3, 4, 5])
+
+        cambios = await obtener_cambios_desde(self.diagrama.id, 3, limite=10)
+        self.assertEqual(cambios, [
+            {'revision': 4, 'cambio': {'tipo': 'crear_nodo', 'datos': {'id': 4}}},
+            {'revision': 5, 'cambio': {'tipo': 'crear_nodo', 'datos': {'id': 5}}},
+        ])
+        self.assertIsNone(await obtener_cambios_desde(self.diagrama.id, 0, limite=4))
+
+    async def test_solo_las_consultas_pasan_por_el_hilo_de_bd(self):
+        antes = metricas.obtener()
+        await obtener_timestamp_actual()
+        await obtener_cambios_desde(self.diagrama.id, 0, limite=10)
+        despues = metricas.obtener()
+        self.assertEqual(despues['bd_llamadas'] - antes.get('bd_llamadas', 0), 1)
+        self.assertEqual(despues['bd_en_curso'], 0)
+        self.assertGreaterEqual(despues['bd_en_curso_max'], 1)
+
+
+
+    async def test_un_lote_fallido_se_reintenta(self):
+        fallos = []
+
+        async def insertar(lote):
+            if not fallos:
+                fallos.append(len(lote))
+                raise DatabaseError('conexión perdida')
+            return await insertar_cambios_diagrama(lote)
+
+        escritor = EscritorCambios(insertar=insertar, lote_maximo=1000, intervalo=0.01)
+        escritor.encolar(str(self.diagrama.id), 1, {'tipo': 'crear_nodo', 'datos': {'id': 'a'}}, self.usuario.id)
+        self.assertEqual(await escritor.vaciar(), 0)
+        self.assertEqual((fallos, escritor.pendientes), ([1], 1))
+        await asyncio.sleep(0.1)
+        self.assertEqual(escritor.pendientes, 0)
+        self.assertEqual(await CambioDiagrama.objects.filter(sesion__diagrama=self.diagrama).acount(), 1)
+
+    async def test_un_registro_que_siempre_falla_se_aparta_del_lote(self):
+        intentos = []
+
+        async def insertar(lote):
+            intentos.append(len(lote))
+            if any(registro['revision'] == 3 for registro in lote):
+                raise DatabaseError('valor no válido')
+            return await insertar_cambios_diagrama(lote)
+
+        escritor = EscritorCambios(insertar=insertar, lote_maximo=1000, intervalo=60, espera_maxima=120)
+        for revision in range(1, 6):
+            escritor.encolar(str(self.diagrama.id), revision, {'tipo': 'crear_nodo', 'datos': {'id': revision}}, self.usuario.id)
+        # Reintento con la espera máxima y, si vuelve a fallar, por mitades
+        self.assertEqual(await escritor.vaciar(), 0)
+        self.assertEqual(escritor.pendientes, 5)
+        self.assertEqual(await escritor.vaciar(), 4)
+        self.assertEqual(intentos, [5, 5, 2, 3, 1, 2])
+        self.assertEqual(escritor.pendientes, 0)
+        self.assertEqual([registro['revision'] for registro in escritor.descartados], [3])
+        revisiones = await database_sync_to_async(list)(
+            CambioDiagrama.objects.filter(sesion__diagrama=self.diagrama).order_by('revision').values_list('revision', flat=True)
+        )
+        self.assertEqual(revisiones, [1, 2, 4, 5])
+
+        # Pasado el lote problemático la espera vuelve a la inicial
+        escritor.encolar(str(self.diagrama.id), 6, {'tipo': 'crear_nodo', 'datos': {'id': 6}}, self.usuario.id)
+        self.assertEqual(await escritor.vaciar(), 1)
+
+
+class HistorialTest(TestCase):
+    def setUp(self):
+        self.usuario = User.objects.create_user(username='u', correo_electronico='u@example.com', password='pass1234')
+        proyecto = Proyecto.objects.create(nombre='P', creador=self.usuario)
+        self.diagrama = DiagramaClase.objects.create(
+            nombre='D', proyecto=proyecto, estructura={'nodos': [{'id': 'a'}, {'id': 'b'}], 'relaciones': []}
+        )
+        self.sesion = SesionColaborativa.objects.create(diagrama=self.diagrama, activa=False)
+
+    def registrar(self, revision, cambio, dias):
+        cambio = CambioDiagrama.objects.create(
+            sesion=self.sesion, usuario=self.usuario, tipo_cambio=cambio['tipo'], datos_cambio=cambio, revision=revision
+        )
+        CambioDiagrama.objects.filter(pk=cambio.pk).update(timestamp=timezone.now() - timedelta(days=dias))
+
+    def revisiones(self):
+        return list(CambioDiagrama.objects.order_by('revision').values_list('revision', flat=True))
+
+    def test_pliega_cambios_antiguos_sobre_la_instantanea_anterior(self):
+        InstantaneaDiagrama.objects.create(diagrama=self.diagrama, revision=1, estructura={'nodos': [{'id': 'a'}]})
+        self.registrar(1, {'tipo': 'crear_nodo', 'datos': {'id': 'a'}}, dias=60)
+        self.registrar(2, {'tipo': 'crear_nodo', 'datos': {'id': 'b'}}, dias=50)
+        self.registrar(3, {'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'nombre': 'A'}}, dias=40)
+        self.registrar(4, {'tipo': 'eliminar_nodo', 'datos': {'id': 'b'}}, dias=1)
+        archivados = []
+
+        resumen = CompactadorHistorial(retencion_dias=30, lote=2, archivar=archivados.extend).ejecutar()
+
+        self.assertEqual(resumen, {'diagramas': 1, 'instantaneas': 1, 'eliminados': 3})
+        self.assertEqual([fila['revision'] for fila in archivados], [1, 2, 3])
+        self.assertEqual(self.revisiones(), [4])
+        instantanea = InstantaneaDiagrama.objects.get(diagrama=self.diagrama, revision=3)
+        self.assertEqual(instantanea.estructura['nodos'], [{'id': 'a', 'nombre': 'A'}, {'id': 'b'}])
+
+    def test_reconstruye_cualquier_revision_desde_la_instantanea_mas_cercana(self):
+        InstantaneaDiagrama.objects.create(diagrama=self.diagrama, revision=2, estructura={'nodos': [{'id': 'a'}, {'id': 'b'}]})
+        self.registrar(3, {'tipo': 'actualizar_nodo', 'datos': {'id': 'a', 'nombre': 'A'}}, dias=0)
+        self.registrar(4, {'tipo': 'eliminar_nodo', 'datos': {'id': 'b'}}, dias=0)
+
+        with self.assertNumQueries(2):
+            estructura, revision = reconstruir_diagrama(self.diagrama.id, 3)
+        self.assertEqual((revision, estructura['nodos']), (3, [{'id': 'a', 'nombre': 'A'}, {'id': 'b'}]))
+        estructura, revision = reconstruir_diagrama(self.diagrama.id)
+        self.assertEqual((revision, estructura['nodos']), (4, [{'id': 'a', 'nombre': 'A'}]))
+        for revision in (1, 5):
+            with self.assertRaises(HistorialIncompleto):
+                reconstruir_diagrama(self.diagrama.id, revision)
+
+    async def test_cada_revision_de_una_sala_se_puede_reconstruir(self):
+        comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/diagrama/{self.diagrama.id}/')
+        comunicador.scope['user'] = self.usuario
+        conectado, _ = await comunicador.connect()
+        self.assertTrue(conectado)
+        await comunicador.receive_json_from()
+        for i in range(5):
+            cambio = {'tipo': 'crear_nodo', 'datos': {'id': f'n{i}'}}
+            await comunicador.send_json_to({'tipo': 'cambio_diagrama', 'cambio': cambio})
+            self.assertEqual((await comunicador.receive_json_from())['revision'], i + 1)
+        await comunicador.disconnect()
+
+        cliente = APIClient()
+        cliente.force_authenticate(user=self.usuario)
+        for revision in range(6):
+            url = reverse('diagrama-revision', kwargs={'pk': self.diagrama.pk, 'revision': revision})
+            resp = await database_sync_to_async(cliente.get)(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.data['estructura']['nodos']), 2 + revision)
+
+    async def test_la_sala_recupera_los_cambios_no_persistidos(self):
+        # El proceso terminó con la estructura guardada en la revisión 1 y el registro en la 3
+        estructura = {'nodos': [{'id': 'a'}], 'relaciones': [], 'revision': 1}
+        await DiagramaClase.objects.filter(pk=self.diagrama.pk).aupdate(estructura=estructura)
+        await database_sync_to_async(self.registrar)(2, {'tipo': 'crear_nodo', 'datos': {'id': 'c'}}, dias=0)
+        await database_sync_to_async(self.registrar)(3, {'tipo': 'eliminar_nodo', 'datos': {'id': 'a'}}, dias=0)
+
+        estructura, revision, _ = await cargar_estado_diagrama(self.diagrama.id)
+        self.assertEqual((revision, estructura['nodos'], estructura['revision']), (3, [{'id': 'c'}], 3))
+
+    async def test_la_numeracion_sigue_a_la_estructura_si_el_registro_va_detras(self):
+        # Lote de CambioDiagrama aún sin insertar (o perdido): no se repiten revisiones
+        estructura = {'nodos': [{'id': 'a'}], 'relaciones': [], 'revision': 5}
+        await DiagramaClase.objects.filter(pk=self.diagrama.pk).aupdate(estructura=estructura)
+        self.assertEqual((await cargar_estado_diagrama(self.diagrama.id))[1], 5)
+
+    async def test_sin_instantanea_solo_compacta_diagramas_inactivos(self):
+        for revision in (1, 2):
+            await database_sync_to_async(self.registrar)(revision, {'tipo': 'crear_nodo', 'datos': {'id': revision}}, dias=40)
+        compactador = CompactadorHistorial(retencion_dias=30)
+
+        # Con la sala abierta la estructura guardada puede no corresponder a la revisión 2
+        await SesionColaborativa.objects.filter(pk=self.sesion.pk).aupdate(activa=True)
+        self.assertEqual((await database_sync_to_async(compactador.ejecutar)())['eliminados'], 0)
+
+        await SesionColaborativa.objects.filter(pk=self.sesion.pk).aupdate(activa=False)
+        self.assertEqual((await database_sync_to_async(compactador.ejecutar)())['eliminados'], 2)
+        instantanea = await InstantaneaDiagrama.objects.aget(diagrama=self.diagrama)
+        self.assertEqual((instantanea.revision, instantanea.estructura), (2, self.diagrama.estructura))
+        # La numeración de revisiones continúa después de la compactación
+        self.assertEqual((await cargar_estado_diagrama(self.diagrama.id))[1], 2)
+
+
+class EscrituraExternaTest(TestCase):
+    def setUp(self):
+        usuario = User.objects.create_user(username='u', correo_electronico='u@example.com', password='pass1234')
+        proyecto = Proyecto.objects.create(nombre='P', creador=usuario)
+        self.diagrama = DiagramaClase.objects.create(
+            nombre='D', proyecto=proyecto, estructura={'nodos': [{'id': 'a'}], 'relaciones': []}
+        )
+
+    async def test_la_sala_rehace_sus_cambios_sobre_una_escritura_rest(self):
+        registro = RegistroEstadosDiagrama(intervalo=60)
+        estado = await registro.adquirir(self.diagrama.id)
+        # Creada por la API REST: abrir la sala no gasta revisión, la de partida queda como instantánea
+        self.assertEqual((estado.revision, estado.revision_minima), (0, 1))
+        estado.aplicar_cambio({'tipo': 'crear_nodo', 'datos': {'id': 'sala'}})
+        generacion = estado.generacion
+
+        # PUT por la API REST con la sala abierta
+        await DiagramaClase.objects.filter(pk=self.diagrama.pk).aupdate(
+            estructura={'nodos': [{'id': 'a'}, {'id': 'rest'}], 'relaciones': []}, version=F('version') + 1
+        )
+        await registro.liberar(self.diagrama.id)
+        await estado._tarea_instantanea
+
+        diagrama = await DiagramaClase.objects.aget(pk=self.diagrama.pk)
+        self.assertEqual([n['id'] for n in diagrama.estructura['nodos']], ['a', 'rest', 'sala'])
+        self.assertEqual((diagrama.estructura['version'], diagrama.estructura['revision']), (diagrama.version, 2))
+        self.assertEqual((estado.generacion, estado.revision_minima), (generacion + 1, 2))
+        self.assertIsNone(estado.cambios_desde(1))
+        # La escritura externa queda en el historial como instantánea de su revisión
+        instantaneas = [i async for i in InstantaneaDiagrama.objects.order_by('revision').values_list('revision', flat=True)]
+        self.assertEqual(instantaneas, [0, 2])
+        estructura, _ = await database_sync_to_async(reconstruir_diagrama)(self.diagrama.id, 2)
+        self.assertEqual([n['id'] for n in estructura['nodos']], ['a', 'rest', 'sala'])
+
+    async def test_recargar_adopta_un_parche_sin_cambios_pendientes(self):
+        registro = RegistroEstadosDiagrama(intervalo=60)
+        estado = await registro.adquirir(self.diagrama.id)
+        await estado.persistir()
+        generacion = estado.generacion
+
+        await DiagramaClase.objects.filter(pk=self.diagrama.pk).aupdate(
+            estructura={'nodos': [{'id': 'a', 'nombre': 'A'}], 'relaciones': []}, version=F('version') + 1
+        )
+        await estado.recargar(estado.version + 1)
+        self.assertEqual((estado.generacion, estado.estructura['nodos']), (generacion + 1, [{'id': 'a', 'nombre': 'A'}]))
+        # Un aviso repetido (u otra conexión de la sala) no vuelve a recargar
+        await estado.recargar(estado.version)
+        self.assertEqual(estado.generacion, generacion + 1)
+        await registro.liberar(self.diagrama.id)
+
+
+class AgrupacionMovimientosTest(TestCase):
+    def setUp(self):
+        self.usuario = User.objects.create_user(username='u', correo_electronico='u@example.com', password='pass1234')
+        proyecto = Proyecto.objects.create(nombre='P', creador=self.usuario)
+        self.diagrama = DiagramaClase.objects.create(
+            nombre='D', proyecto=proyecto, estructura={'nodos': [{'id': 'a'}], 'relaciones': []}
+        )
+
+    async def test_los_movimientos_del_cliente_se_agrupan_antes_del_siguiente_cambio(self):
+        comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/diagrama/{self.diagrama.id}/')
+        comunicador.scope['user'] = self.usuario
+        conectado, _ = await comunicador.connect()
+        self.assertTrue(conectado)
+        await comunicador.receive_json_from()
+        for i in range(5):
+            movimiento = {'id': 'a', 'position': {'x': i, 'y': i}, 'timestamp': 1700000000000 + i}
+            await comunicador.send_json_to({'tipo': 'cambio_diagrama', 'cambio': {'tipo': 'actualizar_nodo', 'datos': movimiento}})
+        renombrar = {'id': 'a', 'nombre': 'A', 'timestamp': 1700000000005}
+        await comunicador.send_json_to({'tipo': 'cambio_diagrama', 'cambio': {'tipo': 'actualizar_nodo', 'datos': renombrar}})
+
+        # Un único movimiento (el último) y después el cambio de nombre
+        self.assertEqual((await comunicador.receive_json_from())['revision'], 1)
+        self.assertEqual((await comunicador.receive_json_from())['revision'], 2)
+        self.assertTrue(await comunicador.receive_nothing())
+        nodo = registro_estados.obtener(self.diagrama.id).estructura['nodos'][0]
+        self.assertEqual((nodo['position'], nodo['nombre']), ({'x': 4, 'y': 4}, 'A'))
+        await comunicador.disconnect()
+
+
+    async def test_las_difusiones_solo_se_codifican_en_los_formatos_de_la_sala(self):
+        otro = await database_sync_to_async(User.objects.create_user)(
+            username='v', correo_electronico='v@example.com', password='pass1234'
+        )
+        comunicadores = []
+        for usuario in (self.usuario, otro):
+            comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/diagrama/{self.diagrama.id}/')
+            comunicador.scope['user'] = usuario
+            self.assertTrue((await comunicador.connect())[0])
+            comunicadores.append(comunicador)
+        estado = registro_estados.obtener(self.diagrama.id)
+        self.assertEqual(estado.formatos_activos(), ['json'])
+
+        with mock.patch('colaboracion_tiempo_real.consumers.codificar_difusion', wraps=codificar_difusion) as codificar_mock:
+            cambio = {'tipo': 'crear_nodo', 'datos': {'id': 'b'}}
+            await comunicadores[0].send_json_to({'tipo': 'cambio_diagrama', 'cambio': cambio})
+            recibido = await comunicadores[1].receive_json_from()
+            while recibido['tipo'] != 'cambio_recibido':
+                recibido = await comunicadores[1].receive_json_from()
+        self.assertEqual(recibido['cambio'], cambio)
+        self.assertEqual(codificar_mock.call_args.args[1], ['json'])
+
+        for comunicador in comunicadores:
+            await comunicador.disconnect()
+        self.assertIsNone(registro_estados.obtener(self.diagrama.id))
+
+
+class SalaEnOtroProcesoTest(TestCase):
+    async def test_la_conexion_se_cierra_con_el_codigo_de_espera(self):
+        usuario = await database_sync_to_async(User.objects.create_user)(
+            username='u', correo_electronico='u@example.com', password='pass1234'
+        )
+        proyecto = await Proyecto.objects.acreate(nombre='P', creador=usuario)
+        diagrama = await DiagramaClase.objects.acreate(nombre='D', proyecto=proyecto, estructura={'nodos': [], 'relaciones': []})
+        comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/diagrama/{diagrama.id}/')
+        comunicador.scope['user'] = usuario
+
+        with mock.patch.object(registro_estados._salas, 'tomar_sala', mock.AsyncMock(return_value=False)):
+            conectado, _ = await comunicador.connect()
+            self.assertTrue(conectado)
+            salida = await comunicador.receive_output()
+        self.assertEqual(salida, {'type': 'websocket.close', 'code': CODIGO_SALA_EN_OTRO_PROCESO})
+        self.assertIsNone(registro_estados.obtener(diagrama.id))
+        await comunicador.disconnect(code=CODIGO_SALA_EN_OTRO_PROCESO)
+
+
+class RegistroActividadTest(TestCase):
+    def setUp(self):
+        self.usuario = User.objects.create_user(username='u', correo_electronico='u@example.com', password='pass1234')
+        proyecto = Proyecto.objects.create(nombre='P', creador=self.usuario)
+        self.diagrama = DiagramaClase.objects.create(nombre='D', proyecto=proyecto)
+        self.registro = RegistroActividad(intervalo=60, inactividad=90)
+        # El ciclo periódico no se ejecuta en los tests
+        self.registro._tarea = mock.Mock(done=lambda: False)
+
+    def conexion(self):
+        return ConexionUsuario.objects.values_list('desconectado', 'canal_id').get()
+
+    async def test_varias_pestanas_se_vuelcan_en_una_fila(self):
+        self.registro.conectar(str(self.diagrama.id), self.usuario.id, 'canal-a')
+        self.registro.conectar(str(self.diagrama.id), self.usuario.id, 'canal-b')
+        self.assertEqual(await self.registro.vaciar(), 1)
+
+        self.registro.desconectar('canal-a')
+        await self.registro.vaciar()
+        self.assertEqual(await database_sync_to_async(self.conexion)(), (False, 'canal-b'))
+
+        self.registro.desconectar('canal-b')
+        await self.registro.vaciar()
+        self.assertEqual((await database_sync_to_async(self.conexion)())[0], True)
+        self.assertEqual(await self.registro.vaciar(), 0)
+
+    async def test_recolector_cierra_conexiones_sin_latido_y_sesiones_vacias(self):
+        hace_rato = timezone.now() - timedelta(minutes=5)
+        await volcar_actividad_conexiones([{
+            'diagrama_id': self.diagrama.id, 'usuario_id': self.usuario.id, 'canal_id': 'canal-caido',
+            'ultima_actividad': hace_rato, 'desconectado': False,
+        }])
+        # Se guarda el último latido visto, no la hora del volcado
+        guardada = await database_sync_to_async(ConexionUsuario.objects.values_list('fecha_ultima_actividad', flat=True).get)()
+        self.assertEqual(guardada, hace_rato)
+
+        self.assertEqual(await self.registro.recolectar(), (1, 1))
+        self.assertEqual((await database_sync_to_async(self.conexion)())[0], True)
+        activa = await database_sync_to_async(SesionColaborativa.objects.values_list('activa', flat=True).get)()
+        self.assertFalse(activa)
+        self.assertEqual(await self.registro.recolectar(), (0, 0))
+
+    def test_el_comando_recolecta_sin_conexiones_en_el_proceso(self):
+        async_to_sync(volcar_actividad_conexiones)([{
+            'diagrama_id': self.diagrama.id, 'usuario_id': self.usuario.id, 'canal_id': 'canal-caido',
+            'ultima_actividad': timezone.now() - timedelta(minutes=5), 'desconectado': False,
+        }])
+        salida = StringIO()
+        call_command('cerrar_conexiones_inactivas', '--inactividad=60', stdout=salida)
+        self.assertEqual(salida.getvalue().strip(), '1 conexiones cerradas, 1 sesiones desactivadas')
+        self.assertEqual(self.conexion()[0], True)
+
+
+class IndicesTest(TestCase):
+    """Las consultas de diagrama_db y de invitaciones usan los índices declarados en Meta."""
+
+    def plan(self, queryset):
+        if connection.vendor == 'postgresql':
+            # Con tablas casi vacías el planificador prefiere leerlas enteras
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def test_consultas_usan_indices(self):
+        abiertas = ConexionUsuario.objects.filter(sesion=OuterRef('pk'), desconectado=False)
+        casos = [
+            (CambioDiagrama.objects.filter(sesion_id=1), 'cambio_sesion_timestamp_idx'),
+            (CambioDiagrama.objects.filter(sesion_id=1, revision__gt=5).order_by('revision'), 'cambio_sesion_revision_idx'),
+            (
+                ConexionUsuario.objects.filter(desconectado=False, fecha_ultima_actividad__lt=timezone.now()),
+                'conexion_abierta_actividad_idx',
+            ),
+            (SesionColaborativa.objects.filter(activa=True).exclude(Exists(abiertas)), 'conexion_sesion_desconect_idx'),
+            (Invitation.objects.filter(proyecto_id=1).con_correo('Ana@Example.com'), 'invitacion_proyecto_correo_idx'),
+        ]
+        for queryset, indice in casos:
+            with self.subTest(indice=indice):
+                self.assertIn(indice, self.plan(queryset))
+
+    def test_con_correo_no_distingue_mayusculas(self):
+        creador = User.objects.create_user(username='c', correo_electronico='c@example.com', password='x')
+        proyecto = Proyecto.objects.create(nombre='P', creador=creador)
+        invitacion = Invitation.objects.create(proyecto=proyecto, correo_electronico='ana@example.com')
+        self.assertEqual(list(Invitation.objects.filter(proyecto=proyecto).con_correo(' Ana@Example.COM ')), [invitacion])
@@ -0,0 +1,112 @@
+"""
+Control de concurrencia optimista con la columna `version`: la versión se
+publica como ETag y el cliente la devuelve en If-Match al escribir.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+
+def etag(version):
+    return f'"{version}"'
+
+
+def if_match_coincide(request, version):
+    """
+    True si la cabecera If-Match de `request` incluye la versión actual (o es
+    `*`). La comparación es fuerte (RFC 7232): un ETag débil W/"n" no coincide.
+    """
+    etiquetas = parse_etags(request.headers.get('If-Match', ''))
+    return '*' in etiquetas or etag(version) in etiquetas
+
+
+def campos_a_guardar(instancia, datos):
+    """
+    `update_fields` para guardar una actualización: las columnas enviadas,
+    `version` y los campos auto_now. Así un PATCH de `nombre` no reescribe
+    la `estructura` leída antes, que la sala pudo cambiar entretanto.
+    """
+    return [
+        campo.name for campo in instancia._meta.concrete_fields
+        if campo.name in datos or campo.name == 'version' or getattr(campo, 'auto_now', False)
+    ]
+
+
+class VersionDesactualizada(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'El recurso fue modificado por otro usuario.'
+    default_code = 'precondition_failed'
+
+
+class VersionOptimistaMixin:
+    """
+    Para vistas RetrieveUpdateDestroy de modelos con columna `version`:
+
+    - GET responde con ETag, o 304 sin cuerpo si coincide If-None-Match.
+    - PUT/PATCH/DELETE con un If-Match de otra versión responden 412 antes
+      de validar nada.
+    - La escritura toma la fila con un UPDATE condicionado a la versión
+      leída (`WHERE version = n`): si otra escritura REST se coló entre la
+      lectura y el guardado también es 412, nunca una sobrescritura
+      silenciosa. Sin If-Match se mantiene el comportamiento anterior (la
+      última escritura gana), pero la versión avanza igual y sólo se
+      escriben los campos enviados (el serializer guarda con
+      `campos_a_guardar`).
+    - Las salas WebSocket escriben también condicionadas a la versión
+      (diagrama_db.guardar_estructura_diagrama): no reciben 412, rehacen sus
+      cambios sobre lo escrito por REST. Una escritura de la sala hace que
+      el siguiente If-Match con la versión anterior reciba 412.
+    """
+
+    def get_object(self):
+        instancia = super().get_object()
+        if self.request.method in ('PUT', 'PATCH', 'DELETE') and 'If-Match' in self.request.headers:
+            if not if_match_coincide(self.request, instancia.version):
+                raise VersionDesactualizada()
+        return instancia
+
+    def respuesta_con_etag(self, instancia):
+        etiqueta = etag(instancia.version)
+        no_modificado = get_conditional_response(self.request, etag=etiqueta)
+        if no_modificado is not None:
+            no_modificado['ETag'] = etiqueta
+            return no_modificado
+        return Response(self.get_serializer(instancia).data, headers={'ETag': etiqueta})
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.respuesta_con_etag(self.get_object())
+
+    def reservar_version(self, instancia):
+        """Bloquea la fila y avanza `instancia.version`; llamar dentro de transaction.atomic()."""
+        filas = type(instancia).objects.filter(pk=instancia.pk)
+        if 'If-Match' in self.request.headers:
+            if not filas.filter(version=instancia.version).update(version=F('version') + 1):
+                raise VersionDesactualizada()
+            instancia.version += 1
+        else:
+            instancia.version = filas.select_for_update().values_list('version', flat=True).get() + 1
+
+    def update(self, request, *args, **kwargs):
+        respuesta = super().update(request, *args, **kwargs)
+        respuesta['ETag'] = etag(respuesta.data['version'])
+        return respuesta
+
+    def perform_update(self, serializer):
+        instancia = serializer.instance
+        with transaction.atomic():
+            leida = instancia.version
+            self.reservar_version(instancia)
+            serializer.save()
+            if instancia.version != leida + 1:
+                # Otra escritura entre la lectura y el bloqueo: la respuesta
+                # (y su ETag) deben mostrar la fila que quedó, no la leída
+                instancia.refresh_from_db()
+
+    def perform_destroy(self, instancia):
+        with transaction.atomic():
+            self.reservar_version(instancia)
+            instancia.delete()
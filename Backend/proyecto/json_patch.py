@@ -0,0 +1,163 @@
+"""
+Parches parciales sobre `DiagramaClase.estructura`:
+
+- JSON Patch (RFC 6902): lista de operaciones add/remove/replace/move/copy/test
+  con rutas JSON Pointer (RFC 6901), p. ej. `/nodos/3/data/nombre`.
+- JSON Merge Patch (RFC 7396): objeto que se fusiona; `null` borra la clave.
+
+Los parches se aplican sobre la estructura recién leída de la BD, que se
+descarta si alguna operación falla (todo o nada).
+"""
+import copy
+
+from Backend.codec_json import ParserJSON
+
+MEDIA_JSON_PATCH = 'application/json-patch+json'
+MEDIA_MERGE_PATCH = 'application/merge-patch+json'
+
+
+class ParcheInvalido(ValueError):
+    """El parche no es válido o no se puede aplicar sobre la estructura actual."""
+
+
+class ParserJSONPatch(ParserJSON):
+    media_type = MEDIA_JSON_PATCH
+
+
+class ParserMergePatch(ParserJSON):
+    media_type = MEDIA_MERGE_PATCH
+
+
+def _tokens(puntero):
+    if puntero == '':
+        return []
+    if not isinstance(puntero, str) or not puntero.startswith('/'):
+        raise ParcheInvalido(f'Ruta inválida: {puntero!r}')
+    return [token.replace('~1', '/').replace('~0', '~') for token in puntero[1:].split('/')]
+
+
+def _indice(lista, token, puntero, para_insertar=False):
+    if para_insertar and token == '-':
+        return len(lista)
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise ParcheInvalido(f'Índice inválido en {puntero}')
+    indice = int(token)
+    if indice > len(lista) or (indice == len(lista) and not para_insertar):
+        raise ParcheInvalido(f'Índice fuera de rango en {puntero}')
+    return indice
+
+
+def _contenedor(documento, puntero):
+    """Devuelve (contenedor padre, último token) de `puntero`."""
+    tokens = _tokens(puntero)
+    actual = documento
+    for token in tokens[:-1]:
+        if isinstance(actual, dict) and token in actual:
+            actual = actual[token]
+        elif isinstance(actual, list):
+            actual = actual[_indice(actual, token, puntero)]
+        else:
+            raise ParcheInvalido(f'La ruta {puntero} no existe')
+    if not isinstance(actual, (dict, list)):
+        raise ParcheInvalido(f'La ruta {puntero} no existe')
+    return actual, tokens[-1]
+
+
+def _obtener(documento, puntero):
+    if puntero == '':
+        return documento
+    padre, token = _contenedor(documento, puntero)
+    if isinstance(padre, list):
+        return padre[_indice(padre, token, puntero)]
+    if token not in padre:
+        raise ParcheInvalido(f'La ruta {puntero} no existe')
+    return padre[token]
+
+
+def _agregar(documento, puntero, valor):
+    if puntero == '':
+        return valor
+    padre, token = _contenedor(documento, puntero)
+    if isinstance(padre, list):
+        padre.insert(_indice(padre, token, puntero, para_insertar=True), valor)
+    else:
+        padre[token] = valor
+    return documento
+
+
+def _quitar(documento, puntero):
+    if puntero == '':
+        raise ParcheInvalido('No se puede eliminar la raíz')
+    padre, token = _contenedor(documento, puntero)
+    if isinstance(padre, list):
+        return padre.pop(_indice(padre, token, puntero))
+    if token not in padre:
+        raise ParcheInvalido(f'La ruta {puntero} no existe')
+    return padre.pop(token)
+
+
+def aplicar_json_patch(documento, operaciones):
+    """
+    Aplica las operaciones RFC 6902 en orden y devuelve el documento
+    resultante (puede ser el mismo objeto, modificado).
+
+    Raises:
+        ParcheInvalido: operación desconocida, ruta inexistente o `test` fallido
+    """
+    if not isinstance(operaciones, list):
+        raise ParcheInvalido('Un JSON Patch debe ser una lista de operaciones')
+    for numero, operacion in enumerate(operaciones):
+        if not isinstance(operacion, dict) or 'path' not in operacion:
+            raise ParcheInvalido(f'Operación {numero}: falta `path`')
+        op, ruta = operacion.get('op'), operacion['path']
+        if op in ('add', 'replace', 'test') and 'value' not in operacion:
+            raise ParcheInvalido(f'Operación {numero}: falta `value`')
+        if op in ('move', 'copy') and 'from' not in operacion:
+            raise ParcheInvalido(f'Operación {numero}: falta `from`')
+
+        if op == 'add':
+            documento = _agregar(documento, ruta, operacion['value'])
+        elif op == 'remove':
+            _quitar(documento, ruta)
+        elif op == 'replace':
+            _obtener(documento, ruta)
+            if ruta != '':
+                _quitar(documento, ruta)
+            documento = _agregar(documento, ruta, operacion['value'])
+        elif op == 'move':
+            origen = operacion['from']
+            if ruta.startswith(origen + '/'):
+                raise ParcheInvalido(f'Operación {numero}: no se puede mover {origen} dentro de sí mismo')
+            if ruta != origen:
+                documento = _agregar(documento, ruta, _quitar(documento, origen))
+        elif op == 'copy':
+            documento = _agregar(documento, ruta, copy.deepcopy(_obtener(documento, operacion['from'])))
+        elif op == 'test':
+            if _obtener(documento, ruta) != operacion['value']:
+                raise ParcheInvalido(f'Operación {numero}: test fallido en {ruta}')
+        else:
+            raise ParcheInvalido(f'Operación {numero}: `op` desconocida {op!r}')
+    return documento
+
+
+def aplicar_merge_patch(objetivo, parche):
+    """Aplica un JSON Merge Patch (RFC 7396) y devuelve el resultado."""
+    if not isinstance(parche, dict):
+        return parche
+    if not isinstance(objetivo, dict):
+        objetivo = {}
+    for clave, valor in parche.items():
+        if valor is None:
+            objetivo.pop(clave, None)
+        else:
+            objetivo[clave] = aplicar_merge_patch(objetivo.get(clave), valor)
+    return objetivo
+
+
+def validar_estructura(estructura):
+    """La estructura parcheada debe seguir teniendo la forma {'nodos': [...], 'relaciones': [...]}."""
+    if not isinstance(estructura, dict):
+        raise ParcheInvalido('La estructura debe ser un objeto')
+    for clave in ('nodos', 'relaciones'):
+        if clave in estructura and not isinstance(estructura[clave], list):
+            raise ParcheInvalido(f'`{clave}` debe ser una lista')
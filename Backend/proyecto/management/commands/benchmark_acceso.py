@@ -0,0 +1,97 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from proyecto.models import Proyecto, DiagramaClase
+
+User = get_user_model()
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _ids_proyectos_accesibles(usuario_id):
+    """
+    Alternativa medida: `SELECT id ... WHERE creador = X UNION SELECT
+    proyecto_id FROM colaboradores WHERE usuario = X`.
+    """
+    campo = Proyecto._meta.get_field('colaboradores')
+    intermedia = campo.remote_field.through
+    creados = Proyecto.objects.filter(creador_id=usuario_id).order_by().values('pk')
+    colaborando = intermedia.objects.filter(
+        **{f'{campo.m2m_reverse_field_name()}_id': usuario_id}
+    ).order_by().values(f'{campo.m2m_field_name()}_id')
+    return creados.union(colaborando)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara el tiempo de los listados de proyectos/diagramas con el plan "
+        "anterior (JOIN + DISTINCT), con OR EXISTS (accesibles_por) y con id IN (... UNION ...). "
+        "Los datos de prueba se crean dentro de una transacción que se revierte al terminar."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--proyectos', type=int, default=300, help='Proyectos accesibles para el usuario de prueba')
+        parser.add_argument('--nodos', type=int, default=50, help='Nodos en la estructura de cada diagrama')
+        parser.add_argument('--repeticiones', type=int, default=20)
+        parser.add_argument('--explain', action='store_true', help='Mostrar EXPLAIN de cada consulta')
+
+    def handle(self, *args, **opciones):
+        try:
+            with transaction.atomic():
+                usuario = self._crear_datos(opciones['proyectos'], opciones['nodos'])
+                self._comparar(usuario, opciones['repeticiones'], opciones['explain'])
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def _crear_datos(self, total, nodos):
+        sufijo = time.time_ns()
+        usuario = User.objects.create_user(
+            username=f'benchmark_{sufijo}', correo_electronico=f'benchmark_{sufijo}@example.com', password=None
+        )
+        otro = User.objects.create_user(
+            username=f'benchmark_otro_{sufijo}', correo_electronico=f'benchmark_otro_{sufijo}@example.com', password=None
+        )
+        # mitad creados por el usuario, mitad como colaborador (con varios colaboradores por proyecto)
+        proyectos = Proyecto.objects.bulk_create([
+            Proyecto(nombre=f'Proyecto {i}', creador=usuario if i % 2 else otro)
+            for i in range(total)
+        ])
+        usuario.proyectos_colaborando.add(*proyectos)
+        otro.proyectos_colaborando.add(*proyectos)
+        estructura = {
+            'nodos': [{'id': f'n{i}', 'nombre': f'Clase{i}', 'atributos': ['id: int'] * 5} for i in range(nodos)],
+            'relaciones': [{'id': f'r{i}', 'source': f'n{i}', 'target': f'n{i + 1}'} for i in range(nodos - 1)],
+        }
+        DiagramaClase.objects.bulk_create([
+            DiagramaClase(nombre=f'Diagrama {p.id}', proyecto=p, estructura=estructura)
+            for p in proyectos
+        ])
+        return usuario
+
+    def _comparar(self, usuario, repeticiones, explain):
+        casos = [
+            ('proyectos JOIN+DISTINCT', Proyecto.objects.filter(Q(creador=usuario) | Q(colaboradores=usuario)).distinct()),
+            ('proyectos OR EXISTS', Proyecto.objects.filter(Proyecto.objects.condicion_acceso(usuario.pk))),
+            ('proyectos UNION', Proyecto.objects.filter(pk__in=_ids_proyectos_accesibles(usuario.pk))),
+            ('diagramas JOIN+DISTINCT', DiagramaClase.objects.filter(
+                Q(proyecto__creador=usuario) | Q(proyecto__colaboradores=usuario)).distinct()),
+            ('diagramas OR EXISTS', DiagramaClase.objects.filter(DiagramaClase.objects.condicion_acceso(usuario.pk))),
+            ('diagramas UNION', DiagramaClase.objects.filter(proyecto_id__in=_ids_proyectos_accesibles(usuario.pk))),
+        ]
+        self.stdout.write(f'{connection.vendor}, {repeticiones} repeticiones')
+        for nombre, queryset in casos:
+            filas = len(list(queryset.all()))
+            inicio = time.perf_counter()
+            for _ in range(repeticiones):
+                list(queryset.all())
+            ms = (time.perf_counter() - inicio) * 1000 / repeticiones
+            self.stdout.write(f'{nombre:<26} filas={filas:<6} {ms:8.2f} ms/consulta')
+            if explain:
+                self.stdout.write(queryset.explain())
@@ -0,0 +1,121 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from Backend import codec_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def estructura_realista(nodos):
+    """Estructura con la forma que guarda el editor de diagramas (React Flow)."""
+    return {
+        'nodos': [
+            {
+                'id': f'n{i}',
+                'type': 'claseNode',
+                'position': {'x': 120.5 * (i % 10), 'y': 90.25 * (i // 10)},
+                'data': {
+                    'nombre': f'Clase{i}',
+                    'estereotipo': 'entidad' if i % 3 else 'interfaz',
+                    'atributos': [
+                        {'visibilidad': '-', 'nombre': f'atributo_{j}', 'tipo': 'String', 'multiplicidad': '1'}
+                        for j in range(6)
+                    ],
+                    'metodos': [
+                        {'visibilidad': '+', 'nombre': f'operacion_{j}', 'firma': f'operacion_{j}(id: int): bool'}
+                        for j in range(4)
+                    ],
+                    'color': '#e8f0fe',
+                },
+            }
+            for i in range(nodos)
+        ],
+        'relaciones': [
+            {
+                'id': f'r{i}',
+                'source': f'n{i}',
+                'target': f'n{(i * 7 + 1) % nodos}',
+                'type': 'relacionEdge',
+                'data': {
+                    'tipo': ('asociacion', 'herencia', 'composicion', 'agregacion')[i % 4],
+                    'multiplicidadOrigen': '1',
+                    'multiplicidadDestino': '0..*',
+                    'etiqueta': f'relación {i}',
+                },
+            }
+            for i in range(nodos)
+        ],
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara json (librería estándar) con orjson sobre estructuras de diagrama "
+        "realistas: dumps, loads, render de la API y frame de difusión del WebSocket."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodos', type=int, default=200, help='Nodos (y relaciones) de la estructura')
+        parser.add_argument('--repeticiones', type=int, default=200)
+
+    def handle(self, *args, **opciones):
+        if orjson is None:
+            raise CommandError('orjson no está instalado')
+
+        estructura = estructura_realista(opciones['nodos'])
+        # Respuesta de DiagramaDetalle y mensaje de cambio difundido por el consumer
+        respuesta = {'id': 1, 'nombre': 'Diagrama', 'proyecto': 1, 'estructura': estructura}
+        mensaje = {
+            'tipo': 'cambio_recibido',
+            'usuario_nombre': 'Ana Pérez',
+            'cambio': {'tipo': 'actualizar_estructura', 'datos': estructura},
+            'cambio_id': 1,
+            'revision': 1,
+        }
+        texto = json.dumps(estructura)
+        renderer = JSONRenderer()
+
+        casos = [
+            (
+                'dumps estructura',
+                lambda: json.dumps(estructura, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')),
+                lambda: orjson.dumps(estructura, option=orjson.OPT_NON_STR_KEYS),
+            ),
+            ('loads estructura', lambda: json.loads(texto), lambda: orjson.loads(texto)),
+            (
+                'render API',
+                lambda: renderer.render(respuesta),
+                lambda: codec_json.RendererJSON().render(respuesta),
+            ),
+            (
+                'frame difusión',
+                lambda: json.dumps(mensaje),
+                lambda: orjson.dumps(mensaje).decode('utf-8'),
+            ),
+        ]
+
+        self.stdout.write(
+            f"{opciones['nodos']} nodos, {len(texto) / 1024:.0f} KiB, {opciones['repeticiones']} repeticiones "
+            f"(codec activo: {'orjson' if codec_json.USA_ORJSON else 'json'})"
+        )
+        for nombre, estandar, rapido in casos:
+            ms_estandar = self._medir(estandar, opciones['repeticiones'])
+            ms_rapido = self._medir(rapido, opciones['repeticiones'])
+            self.stdout.write(
+                f'{nombre:<18} json={ms_estandar:8.3f} ms  orjson={ms_rapido:8.3f} ms  x{ms_estandar / ms_rapido:5.1f}'
+            )
+
+    @staticmethod
+    def _medir(funcion, repeticiones):
+        funcion()
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            funcion()
+        return (time.perf_counter() - inicio) * 1000 / repeticiones
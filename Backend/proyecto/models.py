@@ -1,8 +1,103 @@
 from django.db import models
+from django.db.models import Exists, ExpressionWrapper, F, OuterRef, Q
+from django.db.models.fields.json import KeyTransform
+from django.db.models.functions import Coalesce, Lower
 from django.conf import settings
 from django.utils import timezone
 import secrets
 
+
+def _es_colaborador(usuario_id, proyecto_ref):
+    """
+    EXISTS sobre la tabla intermedia de colaboradores; usa su índice único
+    (proyecto, usuario) sin unir la tabla de usuarios.
+    """
+    campo = Proyecto._meta.get_field('colaboradores')
+    intermedia = campo.remote_field.through
+    return Exists(intermedia.objects.filter(**{
+        f'{campo.m2m_field_name()}_id': OuterRef(proyecto_ref),
+        f'{campo.m2m_reverse_field_name()}_id': usuario_id,
+    }))
+
+
+class ProyectoQuerySet(models.QuerySet):
+    """
+    El acceso se filtra con `creador = X OR EXISTS(...)`: cada proyecto
+    aparece una vez, sin JOIN + DISTINCT (ver benchmark_acceso).
+    """
+
+    def condicion_acceso(self, usuario_id):
+        return Q(creador_id=usuario_id) | Q(_es_colaborador(usuario_id, 'pk'))
+
+    def accesibles_por_id(self, usuario_id):
+        return self.filter(self.condicion_acceso(usuario_id))
+
+    def accesibles_por(self, usuario):
+        """Proyectos donde el usuario es creador o colaborador, en una sola consulta."""
+        if not usuario or not usuario.is_authenticated:
+            return self.none()
+        return self.accesibles_por_id(usuario.pk)
+
+    def con_relaciones(self):
+        """
+        Carga lo que renderiza ProyectoSerializer (creador y colaboradores)
+        en un número fijo de consultas, sin importar cuántos proyectos haya.
+        """
+        return self.select_related('creador').prefetch_related('colaboradores')
+
+
+class LongitudArregloJSON(models.Func):
+    """
+    Longitud del arreglo JSON `campo[clave]` calculada en la BD.
+    NULL si la clave no existe o no es un arreglo.
+    """
+    function = 'json_array_length'
+    output_field = models.IntegerField()
+
+    def __init__(self, campo, clave, **extra):
+        super().__init__(KeyTransform(clave, campo), **extra)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return (
+            f"CASE WHEN jsonb_typeof({sql}) = 'array' THEN jsonb_array_length({sql}) END",
+            (*params, *params),
+        )
+
+
+class DiagramaClaseQuerySet(models.QuerySet):
+    def condicion_acceso(self, usuario_id):
+        return Q(proyecto__creador_id=usuario_id) | Q(_es_colaborador(usuario_id, 'proyecto_id'))
+
+    def accesibles_por(self, usuario):
+        """Diagramas de proyectos donde el usuario es creador o colaborador."""
+        if not usuario or not usuario.is_authenticated:
+            return self.none()
+        return self.filter(self.condicion_acceso(usuario.pk))
+
+    def resumen(self):
+        """
+        Para listados: no lee la columna `estructura` y anota num_nodos /
+        num_relaciones calculados en la BD.
+        """
+        return self.defer('estructura').annotate(
+            num_nodos=Coalesce(
+                LongitudArregloJSON('estructura', 'nodos'),
+                LongitudArregloJSON('estructura', 'clases'),
+                0
+            ),
+            num_relaciones=Coalesce(LongitudArregloJSON('estructura', 'relaciones'), 0),
+        )
+
+    def anotar_acceso(self, usuario):
+        """Anota `tiene_acceso` (bool) sin filtrar, para distinguir inexistente de prohibido."""
+        if not usuario or not usuario.is_authenticated:
+            return self.annotate(tiene_acceso=models.Value(False))
+        return self.annotate(tiene_acceso=ExpressionWrapper(
+            self.condicion_acceso(usuario.pk), output_field=models.BooleanField()
+        ))
+
+
 class Proyecto(models.Model):
     nombre = models.CharField(max_length=100)
     descripcion = models.TextField(blank=True)
@@ -24,6 +119,10 @@ class Proyecto(models.Model):
     
     fecha_creacion = models.DateTimeField(auto_now_add=True)
     fecha_actualizacion = models.DateTimeField(auto_now=True)
+    # Se incrementa en cada modificación (control de concurrencia optimista, ETag)
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    objects = ProyectoQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Proyecto"
@@ -47,8 +146,8 @@ class Proyecto(models.Model):
         if not usuario or not usuario.is_authenticated:
             return False
         
-        # El creador siempre tiene acceso
-        if self.creador and usuario == self.creador:
+        # El creador siempre tiene acceso (comparar ids evita cargar self.creador)
+        if self.creador_id is not None and self.creador_id == usuario.pk:
             return True
         
         # Verificar si es colaborador
@@ -72,6 +171,13 @@ class Proyecto(models.Model):
         # Eliminar duplicados (por si el creador también está en colaboradores)
         return list(set(usuarios))
 
+    def incrementar_version(self):
+        """
+        Invalida el ETag del proyecto tras cambios que no pasan por save(),
+        como altas y bajas de colaboradores.
+        """
+        Proyecto.objects.filter(pk=self.pk).update(version=F('version') + 1)
+
     # NUEVO: Método para agregar colaborador
     def agregar_colaborador(self, usuario):
         """
@@ -85,6 +191,7 @@ class Proyecto(models.Model):
         """
         if usuario and usuario.is_authenticated:
             self.colaboradores.add(usuario)
+            self.incrementar_version()
             return True
         return False
 
@@ -101,6 +208,7 @@ class Proyecto(models.Model):
         """
         if usuario and self.colaboradores.filter(id=usuario.id).exists():
             self.colaboradores.remove(usuario)
+            self.incrementar_version()
             return True
         return False
 
@@ -117,6 +225,10 @@ class DiagramaClase(models.Model):
     fecha_actualizacion = models.DateTimeField(auto_now=True)
     # Campo para almacenar la estructura del diagrama (ejemplo: JSON)
     estructura = models.JSONField(default=dict, blank=True)
+    # Se incrementa en cada escritura de la estructura (control de concurrencia optimista)
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    objects = DiagramaClaseQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Diagrama de Clase"
@@ -137,7 +249,20 @@ class DiagramaClase(models.Model):
         Returns:
             bool: True si el usuario tiene acceso al proyecto padre
         """
-        return self.proyecto.usuario_tiene_acceso(usuario)
+        # Una sola consulta, sin cargar self.proyecto
+        return DiagramaClase.objects.accesibles_por(usuario).filter(pk=self.pk).exists()
+
+class InvitationQuerySet(models.QuerySet):
+    def con_correo(self, correo):
+        """
+        Invitaciones para `correo` sin distinguir mayúsculas. Compara
+        LOWER(correo_electronico), que es la expresión del índice
+        invitacion_proyecto_correo_idx; `__iexact` usa UPPER y no lo aprovecha.
+        """
+        return self.alias(correo_normalizado=Lower('correo_electronico')).filter(
+            correo_normalizado=(correo or '').strip().lower()
+        )
+
 
 # NUEVO: Modelo Invitation para gestionar invitaciones a proyectos
 class Invitation(models.Model):
@@ -158,8 +283,14 @@ class Invitation(models.Model):
     creado_por = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
     creado_en = models.DateTimeField(default=timezone.now)
 
+    objects = InvitationQuerySet.as_manager()
+
     class Meta:
         unique_together = ('proyecto', 'correo_electronico')
+        indexes = [
+            # Búsqueda de invitaciones de un correo en un proyecto (ver InvitationQuerySet.con_correo)
+            models.Index('proyecto', Lower('correo_electronico'), name='invitacion_proyecto_correo_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.token:
@@ -176,3 +307,4 @@ class Invitation(models.Model):
         self.estado = self.ESTADO_ACEPTADA
         self.save()
         self.proyecto.colaboradores.add(usuario)
+        self.proyecto.incrementar_version()
@@ -2,6 +2,7 @@ from rest_framework import serializers
 from proyecto.models import Proyecto, DiagramaClase, Invitation
 from django.contrib.auth import get_user_model
 from django.db import transaction, IntegrityError
+from proyecto.concurrencia import campos_a_guardar
 
 User = get_user_model()
 
@@ -13,7 +14,7 @@ class ProyectoSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Proyecto
-        fields = ['id', 'nombre', 'descripcion', 'creador', 'colaboradores_ids']
+        fields = ['id', 'nombre', 'descripcion', 'creador', 'colaboradores_ids', 'version']
 
     def create(self, validated_data):
         colaboradores = validated_data.pop('colaboradores', [])
@@ -26,7 +27,7 @@ class ProyectoSerializer(serializers.ModelSerializer):
         colaboradores = validated_data.pop('colaboradores', None)
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
-        instance.save()
+        instance.save(update_fields=campos_a_guardar(instance, validated_data))
         if colaboradores is not None:
             instance.colaboradores.set(colaboradores)
         return instance
@@ -36,11 +37,29 @@ class DiagramaClaseSerializer(serializers.ModelSerializer):
         model = DiagramaClase
         fields = '__all__'
 
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=campos_a_guardar(instance, validated_data))
+        return instance
+
+class DiagramaClaseResumenSerializer(serializers.ModelSerializer):
+    """
+    Versión liviana para listados: sin `estructura`, con los conteos que
+    anota DiagramaClase.objects.resumen().
+    """
+    num_nodos = serializers.IntegerField(read_only=True)
+    num_relaciones = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = DiagramaClase
+        fields = ['id', 'nombre', 'descripcion', 'proyecto', 'fecha_creacion', 'fecha_actualizacion', 'num_nodos', 'num_relaciones']
+
 # Serializer para Invitation
 class InvitationSerializer(serializers.ModelSerializer):
     # campo explícito writeable para proyecto (PrimaryKey)
     proyecto = serializers.PrimaryKeyRelatedField(queryset=Proyecto.objects.all(), write_only=True)
-    proyecto_id = serializers.IntegerField(source='proyecto.id', read_only=True)
+    proyecto_id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Invitation
@@ -54,7 +73,7 @@ class InvitationSerializer(serializers.ModelSerializer):
         if not correo or (isinstance(correo, str) and not correo.strip()):
             raise serializers.ValidationError({'correo_electronico': 'Este campo es requerido.'})
         # evitar duplicados: si ya existe una invitación para ese par, devolver error de validación
-        if Invitation.objects.filter(proyecto=proyecto, correo_electronico__iexact=correo).exists():
+        if Invitation.objects.filter(proyecto=proyecto).con_correo(correo).exists():
             raise serializers.ValidationError({'detail': 'Ya existe una invitación para ese correo en este proyecto.'})
         return super().validate(attrs)
 
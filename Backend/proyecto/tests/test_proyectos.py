@@ -0,0 +1,296 @@
+from unittest import mock
+
+from django.db.models import F
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase, APIClient
+from django.contrib.auth import get_user_model
+from Backend import codec_json
+from Backend.presupuesto_consultas import ConsultasFueraDePresupuesto, verificar_presupuesto
+from proyecto.concurrencia import VersionOptimistaMixin
+from proyecto.models import Proyecto, DiagramaClase, Invitation
+from proyecto.views_proyectos import DiagramaClaseListaCrear
+from colaboracion_tiempo_real.models import CambioDiagrama, InstantaneaDiagrama, SesionColaborativa
+
+User = get_user_model()
+
+class ColaboradoresAPITest(APITestCase):
+    def setUp(self):
+        self.creador = User.objects.create_user(username='creador', correo_electronico='creador@example.com', password='pass1234')
+        self.colaborador = User.objects.create_user(username='colab', correo_electronico='colab@example.com', password='pass1234')
+        self.proyecto = Proyecto.objects.create(nombre='Prueba', descripcion='Proj', creador=self.creador)
+        self.proyecto.colaboradores.add(self.colaborador)
+        self.client = APIClient()
+
+    @mock.patch('proyecto.views_proyectos.notificar_cambio_acceso')
+    def test_eliminar_colaborador_invalida_acceso_en_websocket(self, notificar):
+        self.client.force_authenticate(user=self.creador)
+        url = reverse('eliminar-colaborador', kwargs={'pk': self.proyecto.id, 'user_id': self.colaborador.id})
+        resp = self.client.delete(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(self.proyecto.colaboradores.filter(pk=self.colaborador.pk).exists())
+        notificar.assert_called_once_with(self.proyecto.id, self.colaborador.id)
+
+
+class DiagramaAPITestCase(APITestCase):
+    """Creador, colaborador y usuario ajeno de un proyecto con un diagrama."""
+
+    def setUp(self):
+        self.creador = User.objects.create_user(username='creador', correo_electronico='creador@example.com', password='pass1234')
+        self.colaborador = User.objects.create_user(username='colab', correo_electronico='colab@example.com', password='pass1234')
+        self.ajeno = User.objects.create_user(username='ajeno', correo_electronico='ajeno@example.com', password='pass1234')
+        self.proyecto = Proyecto.objects.create(nombre='Prueba', creador=self.creador)
+        self.proyecto.colaboradores.add(self.colaborador)
+        self.diagrama = DiagramaClase.objects.create(nombre='D', proyecto=self.proyecto)
+
+
+class AccesoQuerysetTest(DiagramaAPITestCase):
+    def test_accesibles_por_creador_y_colaborador(self):
+        for usuario in (self.creador, self.colaborador):
+            self.assertEqual(list(Proyecto.objects.accesibles_por(usuario)), [self.proyecto])
+            self.assertEqual(list(DiagramaClase.objects.accesibles_por(usuario)), [self.diagrama])
+        self.assertFalse(Proyecto.objects.accesibles_por(self.ajeno).exists())
+        self.assertFalse(DiagramaClase.objects.accesibles_por(self.ajeno).exists())
+
+    def test_listados_sin_duplicados_si_el_creador_tambien_es_colaborador(self):
+        self.proyecto.colaboradores.add(self.creador)
+        self.client.force_authenticate(user=self.creador)
+        resp = self.client.get(reverse('proyecto-lista-crear'))
+        self.assertEqual([p['id'] for p in resp.data['results']], [self.proyecto.id])
+        resp = self.client.get(reverse('diagrama-lista-crear'))
+        self.assertEqual([d['id'] for d in resp.data['results']], [self.diagrama.id])
+
+    def test_acceso_a_diagrama_en_una_consulta(self):
+        diagrama = DiagramaClase.objects.get(pk=self.diagrama.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(diagrama.usuario_tiene_acceso(self.colaborador))
+        with self.assertNumQueries(1):
+            self.assertFalse(diagrama.usuario_tiene_acceso(self.ajeno))
+
+    def test_anotar_acceso(self):
+        fila = DiagramaClase.objects.filter(pk=self.diagrama.pk).anotar_acceso(self.ajeno).values_list('proyecto_id', 'tiene_acceso').get()
+        self.assertEqual(fila, (self.proyecto.id, False))
+
+
+class ListadoDiagramasTest(DiagramaAPITestCase):
+    def test_listado_resumen_sin_estructura_y_con_conteos(self):
+        self.diagrama.estructura = {'nodos': [{'id': 'a'}, {'id': 'b'}], 'relaciones': [{'id': 'r'}]}
+        self.diagrama.save()
+        DiagramaClase.objects.create(nombre='Vacio', proyecto=self.proyecto, estructura={'nodos': {}})
+        self.client.force_authenticate(user=self.colaborador)
+        resp = self.client.get(reverse('diagrama-lista-crear'), {'resumen': '1'})
+        self.assertEqual(resp.status_code, 200)
+        por_nombre = {d['nombre']: d for d in resp.data['results']}
+        self.assertNotIn('estructura', por_nombre['D'])
+        self.assertEqual((por_nombre['D']['num_nodos'], por_nombre['D']['num_relaciones']), (2, 1))
+        self.assertEqual(por_nombre['Vacio']['num_relaciones'], 0)
+
+    def test_listado_paginado_por_cursor(self):
+        extras = [Proyecto.objects.create(nombre=f'P{i}', creador=self.creador) for i in range(4)]
+        self.client.force_authenticate(user=self.creador)
+        resp = self.client.get(reverse('proyecto-lista-crear'), {'page_size': 2})
+        ids = [p['id'] for p in resp.data['results']]
+        while resp.data['next']:
+            resp = self.client.get(resp.data['next'])
+            ids += [p['id'] for p in resp.data['results']]
+        esperados = sorted([self.proyecto.id] + [p.id for p in extras], reverse=True)
+        self.assertEqual(ids, esperados)
+
+
+class EstructuraJSONTest(DiagramaAPITestCase):
+    def test_estructura_json_ida_y_vuelta(self):
+        estructura = {'nodos': [{'id': 'n1', 'data': {'nombre': 'Categoría', 'posición': [1.5, -2]}}], 'relaciones': []}
+        self.client.force_authenticate(user=self.creador)
+        url = reverse('diagrama-detalle', kwargs={'pk': self.diagrama.pk})
+        resp = self.client.patch(url, {'estructura': estructura}, format='json')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(url)
+        self.assertEqual(codec_json.loads(resp.content)['estructura'], estructura)
+        resp = self.client.patch(url, b'{"estructura":', content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+
+
+class RevisionDiagramaTest(DiagramaAPITestCase):
+    def test_estructura_en_una_revision_anterior(self):
+        sesion = SesionColaborativa.objects.create(diagrama=self.diagrama)
+        InstantaneaDiagrama.objects.create(diagrama=self.diagrama, revision=1, estructura={'nodos': [{'id': 'a'}]})
+        cambio = {'tipo': 'crear_nodo', 'datos': {'id': 'b'}}
+        CambioDiagrama.objects.create(sesion=sesion, usuario=self.creador, tipo_cambio='crear_nodo', datos_cambio=cambio, revision=2)
+
+        self.client.force_authenticate(user=self.colaborador)
+        resp = self.client.get(reverse('diagrama-revision', kwargs={'pk': self.diagrama.pk, 'revision': 2}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([n['id'] for n in resp.data['estructura']['nodos']], ['a', 'b'])
+        verificar_presupuesto(resp)
+        resp = self.client.get(reverse('diagrama-revision', kwargs={'pk': self.diagrama.pk, 'revision': 3}))
+        self.assertEqual(resp.status_code, 404)
+        self.client.force_authenticate(user=self.ajeno)
+        resp = self.client.get(reverse('diagrama-revision', kwargs={'pk': self.diagrama.pk, 'revision': 2}))
+        self.assertEqual(resp.status_code, 404)
+
+
+class ParcheEstructuraTest(DiagramaAPITestCase):
+    def test_parche_de_estructura_con_version(self):
+        self.diagrama.estructura = {'nodos': [{'id': 'a', 'data': {'nombre': 'A'}}], 'relaciones': []}
+        self.diagrama.save()
+        self.client.force_authenticate(user=self.colaborador)
+        url = reverse('diagrama-estructura', kwargs={'pk': self.diagrama.pk})
+        operaciones = [
+            {'op': 'test', 'path': '/nodos/0/id', 'value': 'a'},
+            {'op': 'replace', 'path': '/nodos/0/data/nombre', 'value': 'Cliente'},
+            {'op': 'add', 'path': '/nodos/-', 'value': {'id': 'b'}},
+        ]
+        cuerpo = codec_json.dumps(operaciones)
+
+        resp = self.client.patch(url, cuerpo, content_type='application/json-patch+json')
+        self.assertEqual(resp.status_code, 428)
+        resp = self.client.patch(url, cuerpo, content_type='application/json-patch+json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['ETag'], '"2"')
+        verificar_presupuesto(resp)
+        # Con la versión ya superada: 412 y el ETag vigente
+        resp = self.client.patch(url, cuerpo, content_type='application/json-patch+json', HTTP_IF_MATCH='"1"')
+        self.assertEqual((resp.status_code, resp['ETag']), (412, '"2"'))
+        resp = self.client.patch(
+            url, codec_json.dumps({'relaciones': [{'id': 'r'}]}),
+            content_type='application/merge-patch+json', HTTP_IF_MATCH='"2"',
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        self.diagrama.refresh_from_db()
+        self.assertEqual(self.diagrama.version, 3)
+        self.assertEqual(self.diagrama.estructura, {
+            'nodos': [{'id': 'a', 'data': {'nombre': 'Cliente'}}, {'id': 'b'}],
+            'relaciones': [{'id': 'r'}],
+        })
+        # Ruta inexistente: 422 y la estructura no cambia
+        resp = self.client.patch(
+            url, codec_json.dumps([{'op': 'remove', 'path': '/nodos/7'}]),
+            content_type='application/json-patch+json', HTTP_IF_MATCH='"3"',
+        )
+        self.assertEqual(resp.status_code, 422)
+        self.client.force_authenticate(user=self.ajeno)
+        resp = self.client.patch(url, cuerpo, content_type='application/json-patch+json', HTTP_IF_MATCH='*')
+        self.assertEqual(resp.status_code, 404)
+
+
+class VersionOptimistaTest(DiagramaAPITestCase):
+    def test_etag_get_condicional_e_if_match(self):
+        self.client.force_authenticate(user=self.creador)
+        for url in (reverse('diagrama-detalle', kwargs={'pk': self.diagrama.pk}),
+                    reverse('proyecto-detalle', kwargs={'pk': self.proyecto.pk})):
+            resp = self.client.get(url)
+            self.assertEqual((resp.status_code, resp['ETag']), (200, '"1"'))
+            verificar_presupuesto(resp)
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH='"1"')
+            self.assertEqual((resp.status_code, resp.content, resp['ETag']), (304, b'', '"1"'))
+
+            resp = self.client.patch(url, {'nombre': 'Nuevo'}, format='json', HTTP_IF_MATCH='"1"')
+            self.assertEqual((resp.status_code, resp['ETag'], resp.data['version']), (200, '"2"', 2))
+            verificar_presupuesto(resp)
+            # Otro cliente con la versión anterior no pisa el cambio
+            resp = self.client.put(url, {'nombre': 'Viejo'}, format='json', HTTP_IF_MATCH='"1"')
+            self.assertEqual(resp.status_code, 412)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"1"').status_code, 200)
+            resp = self.client.delete(url, HTTP_IF_MATCH='"1"')
+            self.assertEqual(resp.status_code, 412)
+
+            # Comparación fuerte: un ETag débil no sirve como precondición
+            resp = self.client.patch(url, {'nombre': 'Otro'}, format='json', HTTP_IF_MATCH='W/"2"')
+            self.assertEqual(resp.status_code, 412)
+
+        # Los cambios de colaboradores también invalidan el ETag del proyecto
+        self.proyecto.remover_colaborador(self.colaborador)
+        resp = self.client.get(reverse('proyecto-detalle', kwargs={'pk': self.proyecto.pk}), HTTP_IF_NONE_MATCH='"2"')
+        self.assertEqual((resp.status_code, resp['ETag']), (200, '"3"'))
+
+
+    def test_patch_sin_if_match_solo_escribe_los_campos_enviados(self):
+        self.client.force_authenticate(user=self.creador)
+        url = reverse('diagrama-detalle', kwargs={'pk': self.diagrama.pk})
+        de_la_sala = {'nodos': [{'id': 'sala'}], 'relaciones': []}
+        reservar = VersionOptimistaMixin.reservar_version
+
+        def sala_escribe_antes(vista, instancia):
+            # La sala persiste su estructura entre la lectura y el guardado del PATCH
+            DiagramaClase.objects.filter(pk=instancia.pk).update(estructura=de_la_sala, version=F('version') + 1)
+            reservar(vista, instancia)
+
+        with mock.patch.object(VersionOptimistaMixin, 'reservar_version', sala_escribe_antes):
+            resp = self.client.patch(url, {'nombre': 'Nuevo'}, format='json')
+        self.assertEqual((resp.status_code, resp.data['version'], resp.data['estructura']), (200, 3, de_la_sala))
+        self.diagrama.refresh_from_db()
+        self.assertEqual((self.diagrama.nombre, self.diagrama.estructura, self.diagrama.version), ('Nuevo', de_la_sala, 3))
+
+
+class SalaAbiertaTest(DiagramaAPITestCase):
+    @mock.patch('proyecto.views_proyectos.notificar_estructura_modificada')
+    def test_put_de_estructura_avisa_a_la_sala(self, notificar):
+        self.client.force_authenticate(user=self.colaborador)
+        url = reverse('diagrama-detalle', kwargs={'pk': self.diagrama.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(url, {'nombre': 'Nuevo'}, format='json')
+        notificar.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.put(url, {'estructura': {'nodos': [{'id': 'a'}], 'relaciones': []}}, format='json')
+        self.assertEqual(resp.status_code, 200)
+        notificar.assert_called_once_with(self.diagrama.pk, 3)
+
+    @mock.patch('proyecto.views_proyectos.notificar_estructura_modificada')
+    def test_parche_de_estructura_avisa_a_la_sala(self, notificar):
+        self.client.force_authenticate(user=self.colaborador)
+        url = reverse('diagrama-estructura', kwargs={'pk': self.diagrama.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.patch(
+                url, codec_json.dumps({'nodos': [{'id': 'a'}]}),
+                content_type='application/merge-patch+json', HTTP_IF_MATCH='"1"',
+            )
+        self.assertEqual(resp.status_code, 200)
+        notificar.assert_called_once_with(self.diagrama.pk, 2)
+
+
+@override_settings(PRESUPUESTO_CONSULTAS_ESTRICTO=True)
+class PresupuestoConsultasTest(APITestCase):
+    def setUp(self):
+        self.creador = User.objects.create_user(username='creador', correo_electronico='creador@example.com', password='pass1234')
+        self.proyecto = Proyecto.objects.create(nombre='Prueba', creador=self.creador)
+        for i in range(5):
+            colaborador = User.objects.create_user(username=f'c{i}', correo_electronico=f'c{i}@example.com', password='pass1234')
+            self.proyecto.colaboradores.add(colaborador)
+            DiagramaClase.objects.create(nombre=f'D{i}', proyecto=self.proyecto)
+            Invitation.objects.create(proyecto=self.proyecto, correo_electronico=f'i{i}@example.com', creado_por=self.creador)
+        self.client.force_authenticate(user=colaborador)
+
+    def test_listados_dentro_de_presupuesto(self):
+        urls = [
+            reverse('diagrama-lista-crear'),
+            reverse('listar-colaboradores', kwargs={'pk': self.proyecto.id}),
+            reverse('proyecto-invitaciones-list', kwargs={'pk': self.proyecto.id}),
+            reverse('usuario-lista-crear'),
+        ]
+        for url in urls:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.data['results']), 5 if 'usuarios' not in url else 6)
+            verificar_presupuesto(resp)
+
+    def test_listado_de_proyectos_en_consultas_constantes(self):
+        urls = [reverse('proyecto-lista-crear'), reverse('proyectos-por-usuario', kwargs={'usuario_id': self.creador.id})]
+        self.client.force_authenticate(user=self.creador)
+        for url in urls:
+            with self.assertNumQueries(2):
+                self.assertEqual(len(self.client.get(url).data['results']), 1)
+        for i in range(4):
+            proyecto = Proyecto.objects.create(nombre=f'P{i}', creador=self.creador)
+            proyecto.colaboradores.set(self.proyecto.colaboradores.all())
+        for url in urls:
+            with self.assertNumQueries(2):
+                resp = self.client.get(url)
+            self.assertEqual(len(resp.data['results']), 5)
+            self.assertEqual(len(resp.data['results'][0]['colaboradores_ids']), 5)
+            verificar_presupuesto(resp)
+
+    def test_exceder_presupuesto_falla(self):
+        with mock.patch.object(DiagramaClaseListaCrear, 'presupuesto_consultas', {'GET': 0}):
+            with self.assertRaises(ConsultasFueraDePresupuesto):
+                self.client.get(reverse('diagrama-lista-crear'))
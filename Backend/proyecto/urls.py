@@ -6,6 +6,8 @@ from .views_proyectos import (
     ProyectoDetalleActualizarEliminar,
     DiagramaClaseListaCrear,
     DiagramaClaseDetalleActualizarEliminar,
+    DiagramaClaseEstructuraParche,
+    DiagramaClaseRevision,
     ColaboradorEliminarAPIView,
     ProyectosPorUsuario,
     ColaboradoresListAPIView,  # <-- nuevo
@@ -27,6 +29,8 @@ urlpatterns = [
     # diagramas
     path('diagramas/', DiagramaClaseListaCrear.as_view(), name='diagrama-lista-crear'),
     path('diagramas/<int:pk>/', DiagramaClaseDetalleActualizarEliminar.as_view(), name='diagrama-detalle'),
+    path('diagramas/<int:pk>/estructura/', DiagramaClaseEstructuraParche.as_view(), name='diagrama-estructura'),
+    path('diagramas/<int:pk>/revisiones/<int:revision>/', DiagramaClaseRevision.as_view(), name='diagrama-revision'),
 
     # colaboradores: eliminar colaborador
     # DELETE /api/proyectos/<pk>/colaboradores/<user_id>/
@@ -12,6 +12,7 @@ from rest_framework.views import APIView
 
 from .models import Proyecto, Invitation
 from .serializer import InvitationSerializer
+from colaboracion_tiempo_real.acceso import notificar_cambio_acceso
 
 logger = logging.getLogger(__name__)
 
@@ -48,6 +49,8 @@ class InvitacionCrearAPIView(generics.ListCreateAPIView):
     """
     serializer_class = InvitationSerializer
     permission_classes = [IsAuthenticated]
+    orden_cursor = '-id'
+    presupuesto_consultas = {'GET': 2, 'POST': 10}
 
     def get_proyecto(self):
         proyecto_id = self.kwargs.get('pk')
@@ -103,6 +106,7 @@ class InvitacionAceptarAPIView(APIView):
       { "detail": "Invitación aceptada.", "proyecto_id": 1 }
     """
     permission_classes = [IsAuthenticated]
+    presupuesto_consultas = 6
 
     def post(self, request, *args, **kwargs):
         token = request.data.get('token')
@@ -131,6 +135,7 @@ class InvitacionAceptarAPIView(APIView):
 
         # marcar aceptada en el modelo (metodo del modelo)
         invitacion.marcar_aceptada(request.user)
+        notificar_cambio_acceso(invitacion.proyecto.id, request.user.id)
 
         # Notificar por Channels
         try:
@@ -161,6 +166,8 @@ class InvitacionesPorUsuarioProyectoAPIView(generics.ListAPIView):
     """
     serializer_class = InvitationSerializer
     permission_classes = [IsAuthenticated]
+    orden_cursor = '-id'
+    presupuesto_consultas = {'GET': 3}
 
     def get_queryset(self):
         proyecto = get_object_or_404(Proyecto, pk=self.kwargs.get('pk'))
@@ -176,6 +183,8 @@ class InvitacionListAPIView(generics.ListAPIView):
     """
     serializer_class = InvitationSerializer
     permission_classes = [IsAuthenticated]
+    orden_cursor = '-id'
+    presupuesto_consultas = {'GET': 2}
 
     def get_queryset(self):
         proyecto_id = self.kwargs.get('pk')
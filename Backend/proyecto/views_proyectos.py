@@ -1,5 +1,7 @@
+from django.db import transaction
+from django.db.models import F
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.utils import timezone
 from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
@@ -8,10 +10,19 @@ from django.contrib.auth import get_user_model
 from rest_framework.exceptions import PermissionDenied
 
 from .models import Proyecto, DiagramaClase, Invitation
-from .serializer import ProyectoSerializer, DiagramaClaseSerializer
+from .serializer import ProyectoSerializer, DiagramaClaseSerializer, DiagramaClaseResumenSerializer
+from .concurrencia import VersionOptimistaMixin, etag, if_match_coincide
+from .json_patch import (
+    MEDIA_MERGE_PATCH, ParcheInvalido, ParserJSONPatch, ParserMergePatch,
+    aplicar_json_patch, aplicar_merge_patch, validar_estructura,
+)
 from usuario.serializer import UsuarioPersonalizadoSerializer
+from colaboracion_tiempo_real.acceso import notificar_cambio_acceso
+from colaboracion_tiempo_real.salas import notificar_estructura_modificada
+from colaboracion_tiempo_real.services.historial import HistorialIncompleto, reconstruir_diagrama
 import logging
 logger = logging.getLogger(__name__)
+User = get_user_model()
 
 class ProyectoListaCrear(generics.ListCreateAPIView):
     """
@@ -20,13 +31,15 @@ class ProyectoListaCrear(generics.ListCreateAPIView):
     """
     serializer_class = ProyectoSerializer
     permission_classes = [AllowAny]
+    orden_cursor = '-id'
+    presupuesto_consultas = {'GET': 3, 'POST': 6}
 
     def get_queryset(self):
         user = getattr(self.request, 'user', None)
         if getattr(user, 'is_authenticated', False):
-            return Proyecto.objects.filter(Q(creador=user) | Q(colaboradores=user)).distinct()
+            return Proyecto.objects.accesibles_por(user).con_relaciones()
         if hasattr(Proyecto, 'public'):
-            return Proyecto.objects.filter(public=True)
+            return Proyecto.objects.filter(public=True).con_relaciones()
         return Proyecto.objects.none()
 
     def perform_create(self, serializer):
@@ -35,19 +48,24 @@ class ProyectoListaCrear(generics.ListCreateAPIView):
         else:
             serializer.save()
 
-class ProyectoDetalleActualizarEliminar(generics.RetrieveUpdateDestroyAPIView):
+class ProyectoDetalleActualizarEliminar(VersionOptimistaMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     GET/PUT/DELETE para un proyecto (requiere autenticación).
+    - ETag / If-None-Match / If-Match con la versión del proyecto (ver VersionOptimistaMixin).
     """
     serializer_class = ProyectoSerializer
     permission_classes = [IsAuthenticated]
+    presupuesto_consultas = {'GET': 3, 'PUT': 8, 'PATCH': 8}
 
     def get_queryset(self):
-        user = self.request.user
-        return Proyecto.objects.filter(Q(creador=user) | Q(colaboradores=user)).distinct()
+        return Proyecto.objects.accesibles_por(self.request.user).con_relaciones()
 
     def perform_update(self, serializer):
-        serializer.save()
+        super().perform_update(serializer)
+        proyecto = serializer.instance
+        # la lista de colaboradores puede haber cambiado: revalidar accesos en WebSocket
+        if 'colaboradores' in serializer.validated_data:
+            notificar_cambio_acceso(proyecto.id)
 
     def retrieve(self, request, *args, **kwargs):
         """
@@ -56,8 +74,7 @@ class ProyectoDetalleActualizarEliminar(generics.RetrieveUpdateDestroyAPIView):
         instancia = self.get_object()
         creador_id = getattr(instancia.creador, 'id', None)
         logger.debug("ProyectoDetalle: id=%s, creador_id=%s", instancia.pk, creador_id)
-        serializer = self.get_serializer(instancia)
-        return Response(serializer.data)
+        return self.respuesta_con_etag(instancia)
 
 class ColaboradorEliminarAPIView(APIView):
     """
@@ -66,6 +83,7 @@ class ColaboradorEliminarAPIView(APIView):
     - Al eliminar, borra también las invitaciones asociadas al correo del usuario en ese proyecto.
     """
     permission_classes = [IsAuthenticated]
+    presupuesto_consultas = 8
 
     def delete(self, request, pk, user_id, *args, **kwargs):
         proyecto = get_object_or_404(Proyecto, pk=pk)
@@ -79,6 +97,8 @@ class ColaboradorEliminarAPIView(APIView):
 
         # remover colaborador
         proyecto.colaboradores.remove(usuario)
+        proyecto.incrementar_version()
+        notificar_cambio_acceso(proyecto.id, usuario.id)
 
         # eliminar invitaciones pendientes/registradas para ese correo en este proyecto
         try:
@@ -88,30 +108,133 @@ class ColaboradorEliminarAPIView(APIView):
             email = getattr(usuario, 'correo_electronico', '') or getattr(usuario, 'email', '')
             email = str(email).strip().lower()
 
-        Invitation.objects.filter(proyecto=proyecto, correo_electronico__iexact=email).delete()
+        Invitation.objects.filter(proyecto=proyecto).con_correo(email).delete()
 
         return Response({'detail': 'Colaborador eliminado y sus invitaciones asociadas borradas.'}, status=status.HTTP_200_OK)
 
 class DiagramaClaseListaCrear(generics.ListCreateAPIView):
+    """
+    GET /diagramas/ -> lista completa (incluye estructura)
+    GET /diagramas/?resumen=1 -> lista liviana: sin estructura, con num_nodos/num_relaciones
+    POST /diagramas/ -> crea diagrama
+    """
     serializer_class = DiagramaClaseSerializer
     permission_classes = [IsAuthenticated]
+    orden_cursor = '-id'
+    presupuesto_consultas = {'GET': 2, 'POST': 3}
+
+    def es_resumen(self):
+        return (
+            self.request.method == 'GET'
+            and self.request.query_params.get('resumen', '').lower() in ('1', 'true')
+        )
+
+    def get_serializer_class(self):
+        if self.es_resumen():
+            return DiagramaClaseResumenSerializer
+        return super().get_serializer_class()
 
     def get_queryset(self):
-        user = self.request.user
-        return DiagramaClase.objects.filter(Q(proyecto__creador=user) | Q(proyecto__colaboradores=user)).distinct()
+        qs = DiagramaClase.objects.accesibles_por(self.request.user)
+        if self.es_resumen():
+            qs = qs.resumen()
+        return qs
 
-class DiagramaClaseDetalleActualizarEliminar(generics.RetrieveUpdateDestroyAPIView):
+class DiagramaClaseDetalleActualizarEliminar(VersionOptimistaMixin, generics.RetrieveUpdateDestroyAPIView):
+    """
+    GET/PUT/PATCH/DELETE de un diagrama.
+    - ETag / If-None-Match / If-Match con la versión del diagrama (ver VersionOptimistaMixin).
+    - Si cambia `estructura`, la sala abierta del diagrama la adopta.
+    """
     serializer_class = DiagramaClaseSerializer
     permission_classes = [IsAuthenticated]
+    presupuesto_consultas = {'GET': 2, 'PUT': 5, 'PATCH': 5}
 
     def get_queryset(self):
-        user = self.request.user
-        return DiagramaClase.objects.filter(Q(proyecto__creador=user) | Q(proyecto__colaboradores=user)).distinct()
+        return DiagramaClase.objects.accesibles_por(self.request.user)
 
     def put(self, request, *args, **kwargs):
         # permitir partial update vía PUT para estructura
         return self.partial_update(request, *args, **kwargs)
 
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        if 'estructura' in serializer.validated_data:
+            diagrama = serializer.instance
+            transaction.on_commit(lambda: notificar_estructura_modificada(diagrama.id, diagrama.version))
+
+class DiagramaClaseEstructuraParche(APIView):
+    """
+    PATCH /diagramas/<pk>/estructura/
+    - Modifica sólo una parte de `estructura` en lugar de reenviarla entera.
+    - Content-Type application/json-patch+json (RFC 6902) o
+      application/merge-patch+json (RFC 7396).
+    - Requiere If-Match con el ETag (versión) que conoce el cliente: si el
+      diagrama cambió entretanto responde 412 y el cliente debe recargarlo.
+    - La sala abierta del diagrama adopta el parche y reenvía la estructura
+      a sus clientes.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = [ParserJSONPatch, ParserMergePatch]
+    presupuesto_consultas = 4
+
+    def patch(self, request, pk):
+        if 'If-Match' not in request.headers:
+            return Response(
+                {'detail': 'Falta la cabecera If-Match con la versión del diagrama.'},
+                status=status.HTTP_428_PRECONDITION_REQUIRED,
+            )
+        parche = request.data
+
+        with transaction.atomic():
+            diagrama = get_object_or_404(
+                DiagramaClase.objects.accesibles_por(request.user).select_for_update().only('id', 'version', 'estructura'),
+                pk=pk,
+            )
+            if not if_match_coincide(request, diagrama.version):
+                return Response(
+                    {'detail': 'El diagrama fue modificado por otro usuario.', 'version': diagrama.version},
+                    status=status.HTTP_412_PRECONDITION_FAILED,
+                    headers={'ETag': etag(diagrama.version)},
+                )
+            try:
+                estructura = diagrama.estructura or {}
+                if request.content_type.startswith(MEDIA_MERGE_PATCH):
+                    estructura = aplicar_merge_patch(estructura, parche)
+                else:
+                    estructura = aplicar_json_patch(estructura, parche)
+                validar_estructura(estructura)
+            except ParcheInvalido as e:
+                return Response({'detail': str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+            DiagramaClase.objects.filter(pk=diagrama.pk).update(
+                estructura=estructura,
+                version=F('version') + 1,
+                fecha_actualizacion=timezone.now(),
+            )
+            version = diagrama.version + 1
+            # La sala abierta del diagrama adopta el parche en lugar de pisarlo
+            transaction.on_commit(lambda: notificar_estructura_modificada(diagrama.pk, version))
+        return Response({'id': diagrama.pk, 'version': version}, headers={'ETag': etag(version)})
+
+class DiagramaClaseRevision(APIView):
+    """
+    GET /diagramas/<pk>/revisiones/<revision>/
+    - Estructura del diagrama tal como quedó en esa revisión, reconstruida
+      desde la instantánea más cercana y los cambios posteriores.
+    """
+    permission_classes = [IsAuthenticated]
+    presupuesto_consultas = 3
+
+    def get(self, request, pk, revision):
+        get_object_or_404(DiagramaClase.objects.accesibles_por(request.user).only('id'), pk=pk)
+        try:
+            estructura, revision = reconstruir_diagrama(pk, revision)
+        except HistorialIncompleto:
+            # Revisión futura, anterior a la primera instantánea o con cambios ya compactados
+            return Response({'detail': 'El historial no conserva esa revisión.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'id': pk, 'revision': revision, 'estructura': estructura})
+
 class ColaboradoresListAPIView(generics.ListAPIView):
     """
     GET /proyectos/<pk>/colaboradores/
@@ -120,14 +243,16 @@ class ColaboradoresListAPIView(generics.ListAPIView):
     """
     serializer_class = UsuarioPersonalizadoSerializer
     permission_classes = [IsAuthenticated]
+    orden_cursor = 'id'
+    presupuesto_consultas = {'GET': 5}
 
     def get_queryset(self):
         proyecto = get_object_or_404(Proyecto, pk=self.kwargs.get('pk'))
         user = self.request.user
         # permiso: solo creador o colaborador pueden ver la lista
-        if not (proyecto.creador == user or proyecto.colaboradores.filter(pk=user.pk).exists()):
+        if not proyecto.usuario_tiene_acceso(user):
             raise PermissionDenied('No tiene permiso para ver los colaboradores de este proyecto.')
-        return proyecto.colaboradores.all().order_by('id')
+        return proyecto.colaboradores.prefetch_related('roles')
 
 class ProyectosPorUsuario(generics.ListAPIView):
     """
@@ -136,6 +261,8 @@ class ProyectosPorUsuario(generics.ListAPIView):
     """
     serializer_class = ProyectoSerializer
     permission_classes = [AllowAny]
+    orden_cursor = '-id'
+    presupuesto_consultas = {'GET': 3}
 
     def get_queryset(self):
         usuario_id = self.kwargs.get('usuario_id')
@@ -143,6 +270,4 @@ class ProyectosPorUsuario(generics.ListAPIView):
         if usuario_id is None:
             logger.debug("ProyectosPorUsuario: usuario_id es None -> retornar queryset vacío")
             return Proyecto.objects.none()
-        qs = Proyecto.objects.filter(Q(creador_id=usuario_id) | Q(colaboradores__id=usuario_id)).distinct()
-        logger.debug("ProyectosPorUsuario: encontrado count=%s ids=%s", qs.count(), list(qs.values_list('id', flat=True)))
-        return qs
\ No newline at end of file
+        return Proyecto.objects.accesibles_por_id(usuario_id).con_relaciones()
\ No newline at end of file
@@ -17,9 +17,11 @@ class UsuarioListaCrear(generics.ListCreateAPIView):
     Listado y creación de usuarios.
     POST /api/usuarios/  -> crea usuario (no se registra la contraseña en logs).
     """
-    queryset = UsuarioPersonalizado.objects.all()
+    queryset = UsuarioPersonalizado.objects.prefetch_related('roles')
     serializer_class = UsuarioPersonalizadoSerializer
     permission_classes = [AllowAny]  # Permite acceso sin autenticación
+    orden_cursor = 'id'
+    presupuesto_consultas = {'GET': 3, 'POST': 9}
 
     def post(self, request, *args, **kwargs):
         safe_data = request.data.copy()
@@ -32,9 +34,10 @@ class UsuarioDetalleActualizarEliminar(generics.RetrieveUpdateDestroyAPIView):
     """
     Recuperar, actualizar o eliminar un usuario por PK.
     """
-    queryset = UsuarioPersonalizado.objects.all()
+    queryset = UsuarioPersonalizado.objects.prefetch_related('roles')
     serializer_class = UsuarioPersonalizadoSerializer
     permission_classes = [AllowAny]  # Permite acceso sin autenticación
+    presupuesto_consultas = {'GET': 3, 'PUT': 8, 'PATCH': 8}
 
 
 @api_view(['GET'])
@@ -21,6 +21,7 @@ const ColaboracionWrapper = ({
     usuariosConectados,
     usuariosEditando,
     ultimoCambio,
+    estructuraSincronizada,
     errores,
     enviarCambio,
     sincronizarEstado,
@@ -193,6 +194,15 @@ const ColaboracionWrapper = ({
     }
   }, [ultimoCambio, aplicarCambioRemoto]);
 
+  // La estructura completa reemplaza la del editor (hueco demasiado grande o modificada fuera de la sala)
+  useEffect(() => {
+    if (!estructuraSincronizada) return;
+    const { estructura } = estructuraSincronizada;
+    editorState.setNodes(estructura.nodos || []);
+    editorState.setEdges(estructura.relaciones || []);
+    // eslint-disable-next-line
+  }, [estructuraSincronizada]);
+
   // Escuchar eventos del servicio de colaboración
   useEffect(() => {
     const unsubscribeConflicto = colaboracionService.on(
@@ -1,4 +1,5 @@
 import { useEffect, useRef, useState, useCallback } from 'react';
+import { flushSync } from 'react-dom';
 import { getToken } from '../../../services/apiConfig'; // <-- usar getter centralizado de token
 
 /**
@@ -23,12 +24,17 @@ export const useWebSocket = (diagramaIdOrOptions) => {
     const [estaConectado, setEstaConectado] = useState(false);
     const [usuariosConectados, setUsuariosConectados] = useState([]);
     const [ultimoCambio, setUltimoCambio] = useState(null);
+    const [estructuraSincronizada, setEstructuraSincronizada] = useState(null); // Estructura completa enviada por el servidor
     const [errores, setErrores] = useState([]);
     const [usuariosEditando, setUsuariosEditando] = useState({}); // Nuevo: rastrear quién está editando
     
     const ws = useRef(null);
+    const ultimaRevision = useRef(null); // Última revisión del diagrama vista (para resincronización incremental)
     const reconnectAttempts = useRef(0);
     const maxReconnectAttempts = 5;
+    // Código con el que el servidor cierra si el diagrama está abierto en otro worker
+    const CODIGO_SALA_EN_OTRO_PROCESO = 4009;
+    const esperaSalaOcupada = 60000;
     const reconnectTimeout = useRef(null);
 
     /**
@@ -51,7 +57,8 @@ export const useWebSocket = (diagramaIdOrOptions) => {
 
             // elegir protocolo WS seguro según la página
             const wsProtocol = (typeof window !== 'undefined' && window.location && window.location.protocol === 'https:') ? 'wss' : 'ws';
-            const url = `${wsProtocol}://localhost:8000/ws/diagrama/${diagramaId}/${token ? `?token=${encodeURIComponent(token)}` : ''}`;
+            // lotes=1: el servidor puede agrupar varios mensajes en un frame 'lote'
+            const url = `${wsProtocol}://localhost:8000/ws/diagrama/${diagramaId}/?lotes=1${token ? `&token=${encodeURIComponent(token)}` : ''}`;
             ws.current = new WebSocket(url);
 
             ws.current.onopen = () => {
@@ -75,7 +82,12 @@ export const useWebSocket = (diagramaIdOrOptions) => {
             ws.current.onmessage = (event) => {
                 try {
                     const data = JSON.parse(event.data);
-                    manejarMensaje(data);
+                    if (data.tipo === 'lote') {
+                        // Un render por mensaje para que ningún cambio_recibido se pierda al agrupar estados
+                        data.mensajes.forEach((mensaje) => flushSync(() => manejarMensaje(mensaje)));
+                    } else {
+                        manejarMensaje(data);
+                    }
                 } catch (error) {
                     console.error('❌ Error parseando mensaje WebSocket:', error);
                     agregarError('parse', 'Error procesando mensaje del servidor');
@@ -86,6 +98,14 @@ export const useWebSocket = (diagramaIdOrOptions) => {
                 console.log('🔌 WebSocket desconectado:', event.code, event.reason);
                 setEstaConectado(false);
                 setUsuariosEditando({}); // Limpiar usuarios editando
+
+                // Sala en otro worker: reconectar enseguida no sirve, se espera sin gastar reintentos
+                if (event.code === CODIGO_SALA_EN_OTRO_PROCESO) {
+                    agregarError('conexion', 'El diagrama está abierto en otro servidor; se reintentará en un minuto.');
+                    const delay = esperaSalaOcupada + Math.random() * esperaSalaOcupada / 2;
+                    reconnectTimeout.current = setTimeout(conectar, delay);
+                    return;
+                }
                 
                 // Reconexión automática con backoff exponencial
                 if (reconnectAttempts.current < maxReconnectAttempts) {
@@ -127,6 +147,11 @@ export const useWebSocket = (diagramaIdOrOptions) => {
      * Procesa mensajes recibidos del WebSocket
      */
     const manejarMensaje = useCallback((data) => {
+        // estado_sincronizado fija la revisión después de aplicar lo que trae
+        if (typeof data.revision === 'number' && data.tipo !== 'estado_sincronizado') {
+            ultimaRevision.current = data.revision;
+        }
+
         switch (data.tipo) {
             case 'conexion_establecida':
                 console.log('✅ Conexión establecida con el diagrama');
@@ -152,7 +177,21 @@ export const useWebSocket = (diagramaIdOrOptions) => {
                 break;
                 
             case 'estado_sincronizado':
-                console.log('🔄 Estado del diagrama sincronizado');
+                // Con `revision` en la solicitud el servidor envía sólo los cambios que faltan
+                if (Array.isArray(data.cambios)) {
+                    // Cada cambio sigue el camino de cambio_recibido, con un render por cambio
+                    data.cambios.forEach(({ revision, cambio }) => {
+                        flushSync(() => setUltimoCambio({ tipo: 'cambio_recibido', cambio, cambio_id: revision, revision }));
+                        ultimaRevision.current = revision;
+                    });
+                    console.log(`🔄 Estado sincronizado: ${data.cambios.length} cambios pendientes`);
+                } else if (data.estructura) {
+                    setEstructuraSincronizada({ estructura: data.estructura, revision: data.revision });
+                    console.log('🔄 Estado del diagrama sincronizado');
+                }
+                if (typeof data.revision === 'number') {
+                    ultimaRevision.current = data.revision;
+                }
                 break;
                 
             case 'usuario_editando':
@@ -172,6 +211,17 @@ export const useWebSocket = (diagramaIdOrOptions) => {
                 agregarError('servidor', data.mensaje);
                 break;
                 
+            case 'resincronizar':
+                // El servidor descartó mensajes (cola saturada): pedir lo que falta desde la última revisión
+                if (ws.current && ws.current.readyState === WebSocket.OPEN) {
+                    const mensaje = { tipo: 'sincronizar_estado' };
+                    if (ultimaRevision.current !== null) {
+                        mensaje.revision = ultimaRevision.current;
+                    }
+                    ws.current.send(JSON.stringify(mensaje));
+                }
+                break;
+
             case 'pong':
                 // Respuesta al ping - mantener conexión viva
                 break;
@@ -204,7 +254,11 @@ export const useWebSocket = (diagramaIdOrOptions) => {
      */
     const sincronizarEstado = useCallback(() => {
         if (ws.current && ws.current.readyState === WebSocket.OPEN) {
-            ws.current.send(JSON.stringify({ tipo: 'sincronizar_estado' }));
+            const mensaje = { tipo: 'sincronizar_estado' };
+            if (ultimaRevision.current !== null) {
+                mensaje.revision = ultimaRevision.current;
+            }
+            ws.current.send(JSON.stringify(mensaje));
             console.log('🔄 Solicitando sincronización de estado');
         } else {
             console.warn('⚠️ No conectado, no se solicitó sincronización');
@@ -273,6 +327,7 @@ export const useWebSocket = (diagramaIdOrOptions) => {
         usuariosConectados,
         usuariosEditando, // Nuevo
         ultimoCambio,
+        estructuraSincronizada,
         errores,
         enviarCambio,
         sincronizarEstado,
@@ -53,4 +53,36 @@ test('useWebSocket crea conexión y puede enviar mensajes', async () => {
 
   // cleanup
   localStorage.removeItem('access_token');
-});
\ No newline at end of file
+});
+
+test('estado_sincronizado entrega cada cambio antes de avanzar la revisión', async () => {
+  const recibidos = [];
+  function Receptor() {
+    const { ultimoCambio } = useWebSocket({ diagramaId: 4, token: 'test-token' });
+    useEffect(() => { if (ultimoCambio) recibidos.push(ultimoCambio.revision); }, [ultimoCambio]);
+    return null;
+  }
+
+  await act(async () => {
+    render(<Receptor />);
+    await new Promise((r) => setTimeout(r, 20));
+  });
+  const socket = MockWebSocket.instances[0];
+
+  await act(async () => {
+    socket.onmessage({ data: JSON.stringify({
+      tipo: 'estado_sincronizado',
+      revision: 6,
+      cambios: [
+        { revision: 5, cambio: { tipo: 'crear_nodo', datos: { id: 'a' } } },
+        { revision: 6, cambio: { tipo: 'crear_nodo', datos: { id: 'b' } } },
+      ],
+    }) });
+  });
+  expect(recibidos).toEqual([5, 6]);
+
+  await act(async () => {
+    socket.onmessage({ data: JSON.stringify({ tipo: 'resincronizar' }) });
+  });
+  expect(JSON.parse(socket.sent[socket.sent.length - 1])).toEqual({ tipo: 'sincronizar_estado', revision: 6 });
+});
@@ -7,7 +7,7 @@ export const invitacionService = {
    */
   obtenerInvitaciones(idProyecto) {
     const path = API_ENDPOINTS.INVITACIONES_LISTAR.replace('{pk}', encodeURIComponent(idProyecto));
-    return apiClient.get(path);
+    return apiClient.getAll(path);
   },
 
   /**
@@ -18,7 +18,7 @@ export const invitacionService = {
     const path = API_ENDPOINTS.INVITACIONES_POR_USUARIO
       .replace('{pk}', encodeURIComponent(idProyecto))
       .replace('{usuario_id}', encodeURIComponent(usuarioId));
-    return apiClient.get(path);
+    return apiClient.getAll(path);
   },
 
   /**
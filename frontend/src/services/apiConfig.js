@@ -157,6 +157,21 @@ export const apiClient = {
   },
 
   get(path) { return this.request('GET', path); },
+  /**
+   * GET de un listado paginado por cursor: sigue los enlaces `next` y devuelve
+   * { status, data: [...] } con todos los resultados concatenados.
+   * Si la respuesta no viene paginada se devuelve tal cual.
+   */
+  async getAll(path) {
+    let resp = await this.get(path);
+    if (!resp.data || !Array.isArray(resp.data.results)) return resp;
+    const resultados = [...resp.data.results];
+    while (resp.data.next) {
+      resp = await this.get(resp.data.next);
+      resultados.push(...resp.data.results);
+    }
+    return { status: resp.status, data: resultados };
+  },
   post(path, body) { return this.request('POST', path, body); },
   put(path, body) { return this.request('PUT', path, body); },
   delete(path) { return this.request('DELETE', path); },
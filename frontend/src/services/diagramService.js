@@ -7,7 +7,7 @@ import { apiClient, API_ENDPOINTS } from './apiConfig';
  * Obtiene todos los diagramas
  */
 export const obtenerDiagramas = async () => {
-  return await apiClient.get(API_ENDPOINTS.DIAGRAMAS);
+  return await apiClient.getAll(API_ENDPOINTS.DIAGRAMAS);
 };
 
 /**
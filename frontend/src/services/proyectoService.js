@@ -10,9 +10,9 @@ export const proyectoService = {
   async obtenerProyectos(usuarioId = null) {
     if (usuarioId) {
       const url = `${API_ENDPOINTS.PROYECTOS}usuario/${encodeURIComponent(usuarioId)}/`;
-      return await apiClient.get(url);
+      return await apiClient.getAll(url);
     }
-    return await apiClient.get(API_ENDPOINTS.PROYECTOS);
+    return await apiClient.getAll(API_ENDPOINTS.PROYECTOS);
   },
 
   /**
@@ -66,7 +66,7 @@ export const proyectoService = {
    * @returns {Promise<Object>}
    */
   async obtenerInvitaciones(idProyecto) {
-    return await apiClient.get(`${API_ENDPOINTS.PROYECTOS}${idProyecto}/invitaciones/`);
+    return await apiClient.getAll(`${API_ENDPOINTS.PROYECTOS}${idProyecto}/invitaciones/`);
   },
 
   /**
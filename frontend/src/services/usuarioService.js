@@ -4,7 +4,7 @@ import { API_URL, API_ENDPOINTS, apiClient } from './apiConfig';
  * Lista todos los usuarios
  */
 export const listarUsuarios = async () => {
-  return await apiClient.get(API_ENDPOINTS.USUARIO);
+  return await apiClient.getAll(API_ENDPOINTS.USUARIO);
 };
 
 /**